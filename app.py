@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g, abort, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g, abort, send_file, Response
 import sqlite3
 import os
 import hashlib
@@ -12,7 +12,11 @@ import shutil
 import json
 import time
 import re
+import queue
 import threading
+import db_utils
+import email_outbox
+import mail_events
 try:
     import db_backup
 except ImportError:
@@ -96,6 +100,10 @@ def init_db():
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
+    # Only takes effect on a new database; existing ones are converted with
+    # mail_retention.py --enable-incremental-vacuum
+    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    
     # Create tables if they don't exist
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -141,6 +149,11 @@ def init_db():
     )
     ''')
     
+    # Indexes for points-ordered team lists; the teams listing pages on
+    # COALESCE(points, 0) so teams with NULL points still get a cursor
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_teams_points ON teams(points DESC)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_teams_points_page ON teams(COALESCE(points, 0) DESC, id)')
+    
     # Create team members table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS team_members (
@@ -166,7 +179,7 @@ def init_db():
         is_read INTEGER DEFAULT 0,
         mail_type TEXT DEFAULT 'message',
         related_id INTEGER,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY (sender_id) REFERENCES users (id),
         FOREIGN KEY (recipient_id) REFERENCES users (id)
     )
@@ -200,16 +213,19 @@ def init_db():
     )
     ''')
     
+    # Create outgoing email queue (sent by the outbox worker)
+    cursor.execute(email_outbox.OUTBOX_TABLE_SQL)
+    cursor.execute(email_outbox.OUTBOX_INDEX_SQL)
+    
     conn.commit()
     conn.close()
+    
+    # Mailbox indexes and unread mail counters
+    db_utils.initialize_mail_schema()
 
 def get_db():
-    """Get a database connection"""
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DB_PATH)
-        db.row_factory = sqlite3.Row
-    return db
+    """Get the request's database connection (pooled, one per request)"""
+    return db_utils.get_db_connection()
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -224,6 +240,25 @@ app.config['SESSION_PERMANENT'] = True
 # Initialize database on startup
 init_db()
 
+@app.before_request
+def open_db_scope():
+    """Give every request (greenlet) its own reusable database connection"""
+    # Waits briefly if another worker is restoring the database
+    db_utils.check_generation()
+    db_utils.begin_scope()
+
+@app.after_request
+def report_db_connections(response):
+    """Expose how many SQLite connections this request had to open"""
+    stats = db_utils.scope_stats()
+    response.headers['X-DB-Connections-Opened'] = str(stats['opened'])
+    return response
+
+@app.teardown_request
+def close_db_scope(exception=None):
+    """Return the request's connection to the pool"""
+    db_utils.end_scope()
+
 def login_required(f):
     """Decorator to require login for certain routes"""
     @wraps(f)
@@ -242,7 +277,7 @@ def admin_required(f):
             flash('Please log in to access this page', 'error')
             return redirect(url_for('login'))
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute('SELECT is_admin FROM users WHERE id = ?', (session['user_id'],))
         user = cursor.fetchone()
@@ -257,8 +292,7 @@ def admin_required(f):
 
 def get_user(user_id):
     """Get user data from database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row  # This enables column access by name
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
@@ -270,8 +304,7 @@ def get_user(user_id):
 
 def get_all_users():
     """Get all users from database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -328,8 +361,7 @@ def save_team_logo(file_data, team_name):
 
 def get_user_team(user_id):
     """Get the team a user belongs to"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row  # Use Row factory to access columns by name
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -351,8 +383,7 @@ def get_user_team(user_id):
 
 def get_team(team_id):
     """Get team by ID"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row  # Use Row factory to access columns by name
+    conn = get_db()
     cursor = conn.cursor()
     
     # Get basic team info and leader info
@@ -375,8 +406,7 @@ def get_team(team_id):
 
 def get_team_members(team_id):
     """Get all members of a team"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -397,20 +427,47 @@ def get_team_members(team_id):
     
     return result
 
-def get_user_mail(user_id, mail_type=None, is_read=None, limit=20):
-    """Get mail for a user with optional filters"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+# Messages shown per inbox/sent page
+MAIL_PAGE_SIZE = 20
+
+def encode_mail_cursor(message):
+    """Make a pager cursor pointing at a message"""
+    return f"{message['sent_at']}|{message['id']}"
+
+def decode_mail_cursor(value):
+    """Parse a pager cursor into (sent_at, id), or None if it is missing or malformed"""
+    try:
+        sent_at, mail_id = value.rsplit('|', 1)
+        return sent_at, int(mail_id)
+    except (AttributeError, ValueError):
+        return None
+
+def get_mail_page(user_id, folder='inbox', before=None, after=None, limit=MAIL_PAGE_SIZE,
+                  mail_type=None, is_read=None):
+    """Get one page of a user's inbox, sent or archived mail, newest first
+
+    Pages are addressed by cursors (the sent_at and id of the last message
+    seen), not offsets, so every page is a single range scan of the
+    (recipient_id or sender_id, sent_at, id) index no matter how deep it is.
+    The archive folder reads the recipient's messages from mail_archive.
+    before gives the next older page, after the next newer one. Returns
+    (mail, older_cursor, newer_cursor); a cursor is None when there is
+    nothing more in that direction.
+    """
+    before = decode_mail_cursor(before)
+    after = decode_mail_cursor(after) if before is None else None
+    
+    conn = get_db()
     cursor = conn.cursor()
     
-    query = '''
+    query = f'''
         SELECT m.*, 
                s.username as sender_username, s.profile_pic as sender_pic,
                r.username as recipient_username, r.profile_pic as recipient_pic
-        FROM mail m
+        FROM {'mail_archive' if folder == 'archive' else 'mail'} m
         JOIN users s ON m.sender_id = s.id
         JOIN users r ON m.recipient_id = r.id
-        WHERE m.recipient_id = ?
+        WHERE {'m.sender_id' if folder == 'sent' else 'm.recipient_id'} = ?
     '''
     params = [user_id]
     
@@ -422,164 +479,83 @@ def get_user_mail(user_id, mail_type=None, is_read=None, limit=20):
         query += ' AND m.is_read = ?'
         params.append(1 if is_read else 0)
     
-    query += ' ORDER BY m.sent_at DESC LIMIT ?'
-    params.append(limit)
+    if after:
+        query += ' AND (m.sent_at, m.id) > (?, ?) ORDER BY m.sent_at, m.id LIMIT ?'
+        params.extend(after)
+    elif before:
+        query += ' AND (m.sent_at, m.id) < (?, ?) ORDER BY m.sent_at DESC, m.id DESC LIMIT ?'
+        params.extend(before)
+    else:
+        query += ' ORDER BY m.sent_at DESC, m.id DESC LIMIT ?'
     
+    # One extra row tells us whether there is another page
+    params.append(limit + 1)
     cursor.execute(query, params)
     mail = cursor.fetchall()
-    
     conn.close()
+    
+    more = len(mail) > limit
+    mail = mail[:limit]
+    
+    if after:
+        mail.reverse()
+        if not more and len(mail) < limit:
+            # Reached the newest messages; show a full first page instead
+            return get_mail_page(user_id, folder, limit=limit, mail_type=mail_type, is_read=is_read)
+        older = encode_mail_cursor(mail[-1]) if mail else None
+        newer = encode_mail_cursor(mail[0]) if more else None
+    else:
+        older = encode_mail_cursor(mail[-1]) if more else None
+        newer = None
+        if before:
+            newer = encode_mail_cursor(mail[0]) if mail else '|'.join(map(str, before))
+    
+    return mail, older, newer
+
+def get_user_mail(user_id, mail_type=None, is_read=None, limit=20):
+    """Get mail for a user with optional filters"""
+    mail, _, _ = get_mail_page(user_id, mail_type=mail_type, is_read=is_read, limit=limit)
     return mail
 
 def send_team_invitation(sender_id, recipient_id, team_id):
     """Send a team invitation to a user via in-app mail and email notification"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    # Get sender info
-    cursor.execute('SELECT username FROM users WHERE id = ?', (sender_id,))
-    sender = cursor.fetchone()
-    
-    # Get recipient info
-    cursor.execute('SELECT username, email FROM users WHERE id = ?', (recipient_id,))
-    recipient = cursor.fetchone()
-    
-    # Get team info
-    cursor.execute('SELECT name, description FROM teams WHERE id = ?', (team_id,))
-    team = cursor.fetchone()
-    
-    if not sender or not recipient or not team:
-        conn.close()
-        return False
-    
-    # Create mail subject and content
-    subject = f"Team Invitation: {team['name']}"
-    content = f"""
-    Hello {recipient['username']},
-    
-    You have been invited to join the team "{team['name']}" by {sender['username']}.
-    
-    Team Description:
-    {team['description']}
-    
-    To accept or decline this invitation, please check your in-app mail.
-    
-    Best regards,
-    The TeamSync Team
-    """
-    
-    # Send in-app mail
-    cursor.execute('''
-        INSERT INTO mail (sender_id, recipient_id, subject, content, mail_type, related_id)
-        VALUES (?, ?, ?, ?, 'team_invite', ?)
-    ''', (sender_id, recipient_id, subject, content, team_id))
-    
-    mail_id = cursor.lastrowid
-    
-    conn.commit()
-    conn.close()
-    
-    # Send email notification (in a real app, you would use an email service like SendGrid, Mailgun, etc.)
-    try:
-        import smtplib
-        from email.mime.text import MIMEText
-        from email.mime.multipart import MIMEMultipart
-        
-        # Update SMTP configuration with correct values
-        SMTP_SERVER = "smtp.gmail.com"  # Update with your SMTP server
-        SMTP_PORT = 587
-        SMTP_USERNAME = "your_email@gmail.com"  # Update with your email
-        SMTP_PASSWORD = "your_app_password"  # Update with your app password
-        
-        msg = MIMEMultipart()
-        msg['Subject'] = subject
-        msg['From'] = f"TeamSync <{SMTP_USERNAME}>"
-        msg['To'] = recipient['email']
-        
-        # Email content
-        html = f"""
-        <html>
-        <head>
-            <style>
-                body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-                .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-                .header {{ background-color: #0a1128; color: white; padding: 10px 20px; text-align: center; }}
-                .content {{ padding: 20px; background-color: #f9f9f9; }}
-                .footer {{ font-size: 12px; text-align: center; margin-top: 20px; color: #777; }}
-                .button {{ display: inline-block; padding: 10px 20px; background-color: #4a6ac8; color: white; 
-                          text-decoration: none; border-radius: 4px; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>TeamSync</h1>
-                </div>
-                <div class="content">
-                    <h2>Team Invitation</h2>
-                    <p>Hello {recipient['username']},</p>
-                    <p>{content}</p>
-                    <p>Please log in to your account to accept or decline this invitation.</p>
-                    <p><a href="http://yourwebsite.com/login" class="button">Go to TeamSync</a></p>
-                </div>
-                <div class="footer">
-                    <p>This is an automated message from TeamSync. Please do not reply to this email.</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-        
-        msg.attach(MIMEText(html, 'html'))
-        
-        # Connect to SMTP server and send email
-        try:
-            server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-            server.starttls()
-            server.login(SMTP_USERNAME, SMTP_PASSWORD)
-            server.send_message(msg)
-            server.quit()
-            print(f"Email sent successfully to {recipient['email']}")
-        except Exception as e:
-            print(f"Error sending email: {e}")
-            # Log the error but continue execution
-            logging.error(f"Failed to send email: {str(e)}")
-    except Exception as e:
-        print(f"Error sending email: {e}")
-        # Log the error but continue execution
-        logging.error(f"Email setup error: {str(e)}")
-    
-    return mail_id
+    mail_ids = email_outbox.send_team_invitations(sender_id, [recipient_id], team_id)
+    return mail_ids.get(int(recipient_id), False)
+
+def get_unread_mail_count(user_id=None):
+    """Get the count of unread mail for a user (the current user by default)
 
-def get_unread_mail_count(user_id):
-    """Get the count of unread mail for a user"""
+    Read once per request from the user's counter and remembered in g, so the
+    context processor and the view share a single lookup.
+    """
+    if user_id is None:
+        user_id = session.get('user_id')
     if not user_id:
         return 0
     
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM mail WHERE recipient_id = ? AND is_read = 0", (user_id,))
-        count = cursor.fetchone()[0]
-        return count
-    except Exception as e:
-        print(f"Error getting unread mail count: {str(e)}")
-        return 0
+    counts = g.setdefault('unread_mail_counts', {})
+    if user_id not in counts:
+        try:
+            counts[user_id] = db_utils.get_unread_mail_count(user_id)
+        except Exception as e:
+            print(f"Error getting unread mail count: {str(e)}")
+            return 0
+    return counts[user_id]
 
 def send_mail(sender_id, recipient_id, subject, content, mail_type='message', related_id=None):
     """Send a mail message from one user to another"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO mail (sender_id, recipient_id, subject, content, mail_type, related_id)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (sender_id, recipient_id, subject, content, mail_type, related_id))
+    with db_utils.write_transaction() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO mail (sender_id, recipient_id, subject, content, mail_type, related_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (sender_id, recipient_id, subject, content, mail_type, related_id))
+        
+        mail_id = cursor.lastrowid
     
-    mail_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    # Update the recipient's badge in any page they have open
+    mail_events.publish(recipient_id, 'unread')
     
     return mail_id
 
@@ -607,8 +583,7 @@ def login():
         # Hash the password for comparison
         hashed_password = hash_password(password)
         
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
+        conn = get_db()
         cursor = conn.cursor()
         
         # Check if user exists and password matches
@@ -679,8 +654,7 @@ def register():
             return render_template('login.html')
         
         # Check if username or email already exists
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('SELECT id FROM users WHERE username = ? OR email = ?', (username, email))
@@ -695,12 +669,12 @@ def register():
         hashed_password = hash_password(password)
         
         try:
-            cursor.execute('''
-            INSERT INTO users (username, email, password, profile_pic, bio, is_admin, can_create_team)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (username, email, hashed_password, 'default_avatar.png', 'New user', 0, 0))
-            conn.commit()
-            
+            with db_utils.write_transaction():
+                cursor.execute('''
+                INSERT INTO users (username, email, password, profile_pic, bio, is_admin, can_create_team)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (username, email, hashed_password, 'default_avatar.png', 'New user', 0, 0))
+
             # Get the new user ID
             cursor.execute('SELECT id FROM users WHERE username = ?', (username,))
             user = cursor.fetchone()
@@ -733,8 +707,7 @@ def main():
         can_create_team = session.get('can_create_team', False)
     
     # Get top teams
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -775,8 +748,7 @@ def profile():
     user_id = session.get('user_id')
     
     # Get user details
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
@@ -874,10 +846,6 @@ def profile_update():
         except Exception as e:
             flash(f'Error uploading profile music: {str(e)}', 'error')
     
-    # Update user in database
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
     # Build the update query dynamically based on what was provided
     update_fields = []
     params = []
@@ -931,14 +899,16 @@ def profile_update():
     params.append(user_id)
     
     # Execute the update query
-    cursor.execute(f'''
-        UPDATE users 
-        SET {', '.join(update_fields)}
-        WHERE id = ?
-    ''', params)
-    
-    conn.commit()
-    conn.close()
+    with db_utils.write_transaction() as conn:
+        conn.execute(f'''
+            UPDATE users 
+            SET {', '.join(update_fields)}
+            WHERE id = ?
+        ''', params)
+        
+        # Keep the tier tables in step with the legacy columns
+        if 'TierManager' in globals():
+            TierManager.sync_legacy_tiers(conn.cursor(), user_id)
     
     flash('Profile updated successfully', 'success')
     return redirect(url_for('profile'))
@@ -961,7 +931,7 @@ def change_password():
         return redirect(url_for('profile'))
     
     # Check current password
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('SELECT password FROM users WHERE id = ?', (session.get('user_id'),))
@@ -975,11 +945,11 @@ def change_password():
     # Update password
     try:
         hashed_password = hash_password(new_password)
-        cursor.execute(
-            'UPDATE users SET password = ? WHERE id = ?',
-            (hashed_password, session.get('user_id'))
-        )
-        conn.commit()
+        with db_utils.write_transaction():
+            cursor.execute(
+                'UPDATE users SET password = ? WHERE id = ?',
+                (hashed_password, session.get('user_id'))
+            )
         flash('Password changed successfully', 'success')
     except Exception as e:
         flash(f'Failed to change password: {str(e)}', 'error')
@@ -998,8 +968,7 @@ def admin_dashboard():
 @admin_required
 def admin_view_user(user_id):
     """Admin view user details"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     # Get user details
@@ -1060,7 +1029,7 @@ def admin_delete_user(user_id):
         flash('You cannot delete your own admin account', 'error')
         return redirect(url_for('admin_dashboard'))
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Get user profile pic path before deleting
@@ -1069,8 +1038,9 @@ def admin_delete_user(user_id):
     
     try:
         # Delete user
-        cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
-        conn.commit()
+        with db_utils.write_transaction():
+            cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
+            cursor.execute('DELETE FROM skill_leaderboard WHERE user_id = ?', (user_id,))
         
         # Delete profile picture if exists
         if user and user[0]:
@@ -1094,7 +1064,7 @@ def admin_toggle_admin(user_id):
         flash('You cannot remove your own admin status', 'error')
         return redirect(url_for('admin_dashboard'))
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Get current admin status
@@ -1110,8 +1080,8 @@ def admin_toggle_admin(user_id):
     new_status = 0 if user[0] == 1 else 1
     
     try:
-        cursor.execute('UPDATE users SET is_admin = ? WHERE id = ?', (new_status, user_id))
-        conn.commit()
+        with db_utils.write_transaction():
+            cursor.execute('UPDATE users SET is_admin = ? WHERE id = ?', (new_status, user_id))
         flash(f'User admin status updated successfully', 'success')
     except Exception as e:
         flash(f'Failed to update user admin status: {str(e)}', 'error')
@@ -1127,7 +1097,7 @@ def admin_toggle_team_creation(user_id):
         flash('You cannot modify your own team creation permissions', 'error')
         return redirect(url_for('admin_view_user', user_id=user_id))
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Get current status
@@ -1144,9 +1114,9 @@ def admin_toggle_team_creation(user_id):
     
     # Toggle status
     new_status = 0 if current_status else 1
-    cursor.execute("UPDATE users SET can_create_team = ? WHERE id = ?", (new_status, user_id))
+    with db_utils.write_transaction():
+        cursor.execute("UPDATE users SET can_create_team = ? WHERE id = ?", (new_status, user_id))
     
-    conn.commit()
     conn.close()
     
     action = "granted" if new_status else "revoked"
@@ -1159,7 +1129,7 @@ def check_username():
     """API endpoint to check if a username is available"""
     username = request.json.get('username')
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('SELECT id FROM users WHERE username = ?', (username,))
@@ -1174,7 +1144,7 @@ def check_email():
     """API endpoint to check if an email is available"""
     email = request.json.get('email')
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
@@ -1185,38 +1155,86 @@ def check_email():
     return jsonify({'available': not existing_email})
 
 # Team Routes
-@app.route('/teams')
-def teams():
-    """View all teams"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+TEAMS_PER_PAGE = 24
+
+def parse_teams_cursor(cursor_value):
+    """Parse a teams page cursor of the form "<points>:<team_id>" """
+    try:
+        points, team_id = cursor_value.split(':', 1)
+        return int(points), int(team_id)
+    except (AttributeError, ValueError):
+        return None
+
+def get_teams_page(after=None, limit=TEAMS_PER_PAGE):
+    """Get one page of teams ordered by points with member IDs and counts
+
+    Uses keyset pagination on (points DESC, id) so the cost of a page does not
+    depend on how many teams come before it. NULL points sort as 0, otherwise
+    those teams would fall outside every cursor. Returns (teams, next_cursor).
+    """
+    conn = get_db()
     cursor = conn.cursor()
     
-    # Get all teams with member count and leader name
-    cursor.execute('''
-        SELECT t.id, t.name, t.description, t.logo, t.points, t.created_at,
+    keyset_filter = ''
+    params = []
+    if after:
+        after_points, after_id = after
+        keyset_filter = 'WHERE COALESCE(points, 0) <= ? AND (COALESCE(points, 0) < ? OR id > ?)'
+        params.extend([after_points, after_points, after_id])
+    
+    # Fetch one extra row to know whether there is a next page
+    params.append(limit + 1)
+    
+    # Page the teams first, then aggregate members only for that page
+    cursor.execute(f'''
+        WITH page AS (
+            SELECT id, name, description, logo, COALESCE(points, 0) AS points, created_at
+            FROM teams
+            {keyset_filter}
+            ORDER BY COALESCE(points, 0) DESC, id
+            LIMIT ?
+        )
+        SELECT page.id, page.name, page.description, page.logo, page.points, page.created_at,
                leader.username as leader_name, leader.id as leader_id,
-               (SELECT COUNT(*) FROM team_members WHERE team_id = t.id) as member_count
-        FROM teams t
-        LEFT JOIN team_members leader_rel ON t.id = leader_rel.team_id AND leader_rel.is_leader = 1
-        LEFT JOIN users leader ON leader_rel.user_id = leader.id
-        ORDER BY t.points DESC
-    ''')
+               COUNT(tm.user_id) as member_count,
+               GROUP_CONCAT(tm.user_id) as member_ids
+        FROM page
+        LEFT JOIN team_members tm ON tm.team_id = page.id
+        LEFT JOIN users leader ON leader.id = (
+            SELECT user_id FROM team_members
+            WHERE team_id = page.id AND is_leader = 1
+            LIMIT 1
+        )
+        GROUP BY page.id
+        ORDER BY page.points DESC, page.id
+    ''', params)
     
-    all_teams = cursor.fetchall()
+    rows = cursor.fetchall()
+    conn.close()
     
-    # Convert teams to list of dicts and get member IDs for each team
     teams_list = []
-    for team in all_teams:
+    for team in rows[:limit]:
         team_dict = dict(team)
-        
-        # Get all members of this team
-        cursor.execute('SELECT user_id FROM team_members WHERE team_id = ?', (team['id'],))
-        members = cursor.fetchall()
-        team_dict['member_ids'] = [member[0] for member in members]
-        
+        member_ids = team_dict['member_ids']
+        team_dict['member_ids'] = [int(member_id) for member_id in member_ids.split(',')] if member_ids else []
         teams_list.append(team_dict)
     
+    next_cursor = None
+    if len(rows) > limit:
+        last = teams_list[-1]
+        next_cursor = f"{last['points']}:{last['id']}"
+    
+    return teams_list, next_cursor
+
+@app.route('/teams')
+def teams():
+    """View all teams"""
+    after = parse_teams_cursor(request.args.get('after'))
+    teams_list, next_cursor = get_teams_page(after)
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    
     # Check if user can create teams
     can_create_team = False
     if session.get('user_id'):
@@ -1233,6 +1251,8 @@ def teams():
     
     return render_template('teams.html', 
                            teams=teams_list,
+                           next_cursor=next_cursor,
+                           is_first_page=after is None,
                            can_create_team=can_create_team,
                            unread_mail_count=unread_mail_count)
 
@@ -1246,8 +1266,7 @@ def create_team():
         flash('You must be logged in to create a team', 'error')
         return redirect(url_for('login'))
     
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
@@ -1300,21 +1319,20 @@ def create_team():
                 if team_logo and team_logo.filename:
                     logo_path = save_team_logo(team_logo, team_name)
                 
-                # Create the team
-                cursor.execute('''
-                    INSERT INTO teams (name, description, logo, points)
-                    VALUES (?, ?, ?, ?)
-                ''', (team_name, description, logo_path, 0))
-                
-                team_id = cursor.lastrowid
+                with db_utils.write_transaction():
+                    # Create the team
+                    cursor.execute('''
+                        INSERT INTO teams (name, description, logo, points)
+                        VALUES (?, ?, ?, ?)
+                    ''', (team_name, description, logo_path, 0))
                 
-                # Add the current user as the team leader
-                cursor.execute('''
-                    INSERT INTO team_members (team_id, user_id, is_leader)
-                    VALUES (?, ?, 1)
-                ''', (team_id, user_id))
+                    team_id = cursor.lastrowid
                 
-                conn.commit()
+                    # Add the current user as the team leader
+                    cursor.execute('''
+                        INSERT INTO team_members (team_id, user_id, is_leader)
+                        VALUES (?, ?, 1)
+                    ''', (team_id, user_id))
                 
                 # Update session to reflect changes
                 session.modified = True
@@ -1343,8 +1361,7 @@ def view_team(team_id):
         flash('You must be logged in to view team details', 'error')
         return redirect(url_for('login'))
     
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
@@ -1436,11 +1453,17 @@ def edit_team(team_id):
         points = request.form.get('points')
         team_logo = request.files.get('team_logo')
         
+        # Points must be a non-negative integer; keep the current value if missing
+        try:
+            points = max(int(points), 0)
+        except (TypeError, ValueError):
+            points = team['points'] or 0
+        
         if not team_name:
             flash('Team name is required', 'error')
             return redirect(url_for('edit_team', team_id=team_id))
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         cursor = conn.cursor()
         
         # Check if team name already exists (for another team)
@@ -1455,14 +1478,13 @@ def edit_team(team_id):
         if team_logo and team_logo.filename:
             logo_path = save_team_logo(team_logo, team_name)
         
-        # Update the team
-        cursor.execute('''
-            UPDATE teams
-            SET name = ?, description = ?, logo = ?, points = ?
-            WHERE id = ?
-        ''', (team_name, description, logo_path, points, team_id))
-        
-        conn.commit()
+        with db_utils.write_transaction():
+            # Update the team
+            cursor.execute('''
+                UPDATE teams
+                SET name = ?, description = ?, logo = ?, points = ?
+                WHERE id = ?
+            ''', (team_name, description, logo_path, points, team_id))
         conn.close()
         
         flash('Team updated successfully', 'success')
@@ -1475,8 +1497,7 @@ def edit_team(team_id):
 def invite_to_team(team_id):
     """Invite a user to join a team (team leaders only)"""
     user_id = session.get('user_id')
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     # Check if team exists
@@ -1553,6 +1574,76 @@ def invite_to_team(team_id):
     conn.close()
     return redirect(url_for('search_users_for_team', team_id=team_id))
 
+# Most users a single bulk invite request may invite
+BULK_INVITE_LIMIT = 200
+
+@app.route('/teams/<int:team_id>/invite/bulk', methods=['POST'])
+@login_required
+def bulk_invite_to_team(team_id):
+    """Invite several users to a team in one request (team leaders only)
+
+    Takes user_ids as a JSON list or repeated form fields and returns which
+    users were invited and which were skipped.
+    """
+    user_id = session.get('user_id')
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT id FROM teams WHERE id = ?', (team_id,))
+    if not cursor.fetchone():
+        conn.close()
+        return jsonify({'error': 'Team not found'}), 404
+
+    # Only team leaders can invite users
+    cursor.execute('''
+        SELECT is_leader FROM team_members
+        WHERE team_id = ? AND user_id = ? AND is_leader = 1
+    ''', (team_id, user_id))
+    if cursor.fetchone() is None and not session.get('is_admin'):
+        conn.close()
+        return jsonify({'error': 'Only team leaders can invite users to join the team'}), 403
+
+    data = request.get_json(silent=True) or {}
+    try:
+        recipient_ids = [int(r) for r in (data.get('user_ids') or request.form.getlist('user_ids'))]
+    except (TypeError, ValueError):
+        conn.close()
+        return jsonify({'error': 'user_ids must be a list of user IDs'}), 400
+    recipient_ids = list(dict.fromkeys(recipient_ids))
+
+    if not recipient_ids:
+        conn.close()
+        return jsonify({'error': 'user_ids is required'}), 400
+    if len(recipient_ids) > BULK_INVITE_LIMIT:
+        conn.close()
+        return jsonify({'error': f'At most {BULK_INVITE_LIMIT} users can be invited at once'}), 400
+
+    # Skip current members and users with an invitation still pending
+    placeholders = ','.join('?' * len(recipient_ids))
+    cursor.execute(f'''
+        SELECT user_id FROM team_members WHERE team_id = ? AND user_id IN ({placeholders})
+    ''', (team_id, *recipient_ids))
+    skipped = {row['user_id'] for row in cursor.fetchall()}
+
+    cursor.execute(f'''
+        SELECT recipient_id FROM mail
+        WHERE sender_id = ? AND mail_type = 'team_invite' AND related_id = ?
+        AND recipient_id IN ({placeholders})
+        AND id NOT IN (
+            SELECT mail_id FROM team_invite_responses WHERE mail_id = mail.id
+        )
+    ''', (user_id, team_id, *recipient_ids))
+    skipped.update(row['recipient_id'] for row in cursor.fetchall())
+    conn.close()
+
+    to_invite = [r for r in recipient_ids if r not in skipped]
+    mail_ids = email_outbox.send_team_invitations(user_id, to_invite, team_id) if to_invite else {}
+
+    return jsonify({
+        'invited': sorted(mail_ids),
+        'skipped': [r for r in recipient_ids if r not in mail_ids]
+    })
+
 @app.route('/teams/<int:team_id>/leave', methods=['POST'])
 @login_required
 def leave_team(team_id):
@@ -1569,12 +1660,12 @@ def leave_team(team_id):
         flash('Team leaders cannot leave their team. Transfer leadership first or delete the team.', 'error')
         return redirect(url_for('view_team', team_id=team_id))
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
-    # Remove user from team
-    cursor.execute('DELETE FROM team_members WHERE team_id = ? AND user_id = ?', (team_id, user_id))
-    conn.commit()
+    with db_utils.write_transaction():
+        # Remove user from team
+        cursor.execute('DELETE FROM team_members WHERE team_id = ? AND user_id = ?', (team_id, user_id))
     conn.close()
     
     flash('You have left the team', 'success')
@@ -1602,12 +1693,12 @@ def remove_from_team(team_id, user_id):
         flash('Team leaders cannot be removed', 'error')
         return redirect(url_for('view_team', team_id=team_id))
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
-    # Remove user from team
-    cursor.execute('DELETE FROM team_members WHERE team_id = ? AND user_id = ?', (team_id, user_id))
-    conn.commit()
+    with db_utils.write_transaction():
+        # Remove user from team
+        cursor.execute('DELETE FROM team_members WHERE team_id = ? AND user_id = ?', (team_id, user_id))
     conn.close()
     
     flash('Member removed from team', 'success')
@@ -1620,8 +1711,7 @@ def delete_team(team_id):
     user_id = session.get('user_id')
     is_admin = session.get('is_admin', 0)
     
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
@@ -1665,23 +1755,22 @@ def delete_team(team_id):
         
         # Delete all related records in proper order to maintain database integrity
         
-        # 1. Delete team invitations and related mails if tables exist
-        if mail_table_exists:
-            # Delete team invitation mails - only use basic query without JSON extraction
-            cursor.execute('DELETE FROM mail WHERE mail_type = ? AND related_id = ?', 
-                          ('team_invite', team_id))
-        
-        if team_invitations_exists:
-            # Delete team invitations
-            cursor.execute('DELETE FROM team_invitations WHERE team_id = ?', (team_id,))
+        with db_utils.write_transaction():
+            # 1. Delete team invitations and related mails if tables exist
+            if mail_table_exists:
+                # Delete team invitation mails - only use basic query without JSON extraction
+                cursor.execute('DELETE FROM mail WHERE mail_type = ? AND related_id = ?', 
+                              ('team_invite', team_id))
         
-        # 2. Delete team members
-        cursor.execute('DELETE FROM team_members WHERE team_id = ?', (team_id,))
+            if team_invitations_exists:
+                # Delete team invitations
+                cursor.execute('DELETE FROM team_invitations WHERE team_id = ?', (team_id,))
         
-        # 3. Delete team
-        cursor.execute('DELETE FROM teams WHERE id = ?', (team_id,))
+            # 2. Delete team members
+            cursor.execute('DELETE FROM team_members WHERE team_id = ?', (team_id,))
         
-        conn.commit()
+            # 3. Delete team
+            cursor.execute('DELETE FROM teams WHERE id = ?', (team_id,))
         flash(f'Team "{team_name}" has been deleted successfully', 'success')
         
     except Exception as e:
@@ -1699,35 +1788,65 @@ def mail_inbox():
     """User's mail inbox"""
     user_id = session.get('user_id')
     
-    # Get all mail for the user
-    mail = get_user_mail(user_id)
+    # Get one page of mail for the user
+    mail, older_cursor, newer_cursor = get_mail_page(
+        user_id, 'inbox', before=request.args.get('before'), after=request.args.get('after'))
     
-    return render_template('mail_inbox.html', mail=mail)
+    return render_template('mail_inbox.html', mail=mail,
+                           older_cursor=older_cursor, newer_cursor=newer_cursor)
 
 @app.route('/mail/sent')
 @login_required
 def mail_sent():
     """User's sent mail"""
     user_id = session.get('user_id')
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    
+    # Get one page of sent mail for the user
+    sent_mail, older_cursor, newer_cursor = get_mail_page(
+        user_id, 'sent', before=request.args.get('before'), after=request.args.get('after'))
+    
+    return render_template('mail_sent.html', mail=sent_mail,
+                           older_cursor=older_cursor, newer_cursor=newer_cursor)
+
+@app.route('/mail/archive')
+@login_required
+def mail_archive():
+    """User's archived mail (moved out of the inbox by hand or by mail retention)"""
+    user_id = session.get('user_id')
+    
+    # Get one page of archived mail for the user
+    archived_mail, older_cursor, newer_cursor = get_mail_page(
+        user_id, 'archive', before=request.args.get('before'), after=request.args.get('after'))
+    
+    return render_template('mail_archive.html', mail=archived_mail,
+                           older_cursor=older_cursor, newer_cursor=newer_cursor)
+
+@app.route('/mail/archive/<int:mail_id>')
+@login_required
+def view_archived_mail(mail_id):
+    """View a single archived message (read-only)"""
+    user_id = session.get('user_id')
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
         SELECT m.*, 
                s.username as sender_username, s.profile_pic as sender_pic,
                r.username as recipient_username, r.profile_pic as recipient_pic
-        FROM mail m
+        FROM mail_archive m
         JOIN users s ON m.sender_id = s.id
         JOIN users r ON m.recipient_id = r.id
-        WHERE m.sender_id = ?
-        ORDER BY m.sent_at DESC LIMIT 20
-    ''', (user_id,))
+        WHERE m.id = ? AND m.recipient_id = ?
+    ''', (mail_id, user_id))
     
-    sent_mail = cursor.fetchall()
+    mail = cursor.fetchone()
     conn.close()
     
-    return render_template('mail_sent.html', mail=sent_mail)
+    if not mail:
+        flash('Message not found or you do not have permission to view it', 'error')
+        return redirect(url_for('mail_archive'))
+    
+    return render_template('view_mail.html', mail=mail, archived=True)
 
 @app.route('/mail/compose', methods=['GET', 'POST'])
 @login_required
@@ -1742,7 +1861,7 @@ def mail_compose():
             flash('All fields are required', 'error')
             return redirect(url_for('mail_compose'))
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         cursor = conn.cursor()
         
         # Find the recipient
@@ -1774,8 +1893,7 @@ def mail_compose():
 def view_mail(mail_id):
     """View a single mail message"""
     user_id = session.get('user_id')
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     # Get the mail and check if user is sender or recipient
@@ -1798,8 +1916,10 @@ def view_mail(mail_id):
     
     # Mark as read if user is recipient
     if mail['recipient_id'] == user_id and mail['is_read'] == 0:
-        cursor.execute('UPDATE mail SET is_read = 1 WHERE id = ?', (mail_id,))
-        conn.commit()
+        with db_utils.write_transaction():
+            cursor.execute('UPDATE mail SET is_read = 1 WHERE id = ?', (mail_id,))
+        g.pop('unread_mail_counts', None)
+        mail_events.publish(user_id, 'unread')
     
     conn.close()
     
@@ -1810,34 +1930,98 @@ def view_mail(mail_id):
 def delete_mail(mail_id):
     """Delete a mail message"""
     user_id = session.get('user_id')
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Check if user is sender or recipient
     cursor.execute('''
-        SELECT id FROM mail 
+        SELECT id, recipient_id FROM mail 
         WHERE id = ? AND (sender_id = ? OR recipient_id = ?)
     ''', (mail_id, user_id, user_id))
     
-    if not cursor.fetchone():
+    mail = cursor.fetchone()
+    if not mail:
         conn.close()
         flash('Message not found or you do not have permission to delete it', 'error')
         return redirect(url_for('mail_inbox'))
     
-    # Delete the mail
-    cursor.execute('DELETE FROM mail WHERE id = ?', (mail_id,))
-    conn.commit()
+    with db_utils.write_transaction():
+        # Delete the mail
+        cursor.execute('DELETE FROM mail WHERE id = ?', (mail_id,))
     conn.close()
+    mail_events.publish(mail['recipient_id'], 'unread')
     
     flash('Message deleted successfully', 'success')
     return redirect(url_for('mail_inbox'))
 
+@app.route('/mail/bulk', methods=['POST'])
+@login_required
+def bulk_mail():
+    """Mark read, archive or delete several messages at once
+
+    Takes action (read, archive or delete), folder (inbox or sent) and
+    either mail_ids or select=all, optionally narrowed by mail_type. Accepts
+    a form post (redirects back) or JSON (returns the number changed).
+    """
+    user_id = session.get('user_id')
+    data = request.get_json(silent=True) if request.is_json else request.form
+    data = data or {}
+
+    action = data.get('action')
+    folder = data.get('folder', 'inbox')
+    mail_type = data.get('mail_type') or None
+
+    error = None
+    count = 0
+    changed_users = ()
+    if data.get('select') == 'all':
+        mail_ids = None
+    elif request.is_json:
+        # Must be a real list of integers: a string such as "12" would
+        # otherwise be read digit by digit
+        mail_ids = data.get('mail_ids') or []
+        if not isinstance(mail_ids, list) or not all(
+                isinstance(mail_id, int) and not isinstance(mail_id, bool) for mail_id in mail_ids):
+            error = 'Invalid message IDs'
+    else:
+        try:
+            mail_ids = [int(mail_id) for mail_id in request.form.getlist('mail_ids')]
+        except ValueError:
+            error = 'Invalid message IDs'
+
+    if error is None and mail_ids == []:
+        error = 'No messages selected'
+    elif error is None:
+        try:
+            count, changed_users = db_utils.bulk_mail_action(
+                user_id, action, mail_ids, folder=folder, mail_type=mail_type)
+        except ValueError as e:
+            error = str(e)
+
+    # Everyone whose unread count changed: the user for inbox actions, the
+    # recipients when unread sent mail is deleted
+    g.pop('unread_mail_counts', None)
+    for changed_user in changed_users:
+        mail_events.publish(changed_user, 'unread')
+
+    if request.is_json:
+        if error:
+            return jsonify({'error': error}), 400
+        return jsonify({'action': action, 'count': count})
+
+    if error:
+        flash(error, 'error')
+    else:
+        done = {'read': 'marked as read', 'archive': 'archived', 'delete': 'deleted'}[action]
+        flash(f"{count} message{'s' if count != 1 else ''} {done}", 'success')
+    return redirect(url_for('mail_sent' if folder == 'sent' else 'mail_inbox'))
+
 @app.route('/mail/team-invite/<int:mail_id>/accept', methods=['POST'])
 @login_required
 def accept_team_invite(mail_id):
     """Accept a team invitation"""
     user_id = session.get('user_id')
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Get the invitation
@@ -1862,18 +2046,18 @@ def accept_team_invite(mail_id):
         flash('You are already a member of a team', 'error')
         return redirect(url_for('mail_inbox'))
     
-    # Add user to the team
-    cursor.execute('INSERT INTO team_members (team_id, user_id) VALUES (?, ?)', (team_id, user_id))
-    
-    # Mark invitation as read
-    cursor.execute('UPDATE mail SET is_read = 1 WHERE id = ?', (mail_id,))
+    with db_utils.write_transaction():
+        # Add user to the team
+        cursor.execute('INSERT INTO team_members (team_id, user_id) VALUES (?, ?)', (team_id, user_id))
     
-    # Record the response in team_invite_responses
-    cursor.execute('INSERT INTO team_invite_responses (mail_id, response) VALUES (?, ?)', 
-                  (mail_id, 'accepted'))
+        # Mark invitation as read
+        cursor.execute('UPDATE mail SET is_read = 1 WHERE id = ?', (mail_id,))
     
-    conn.commit()
+        # Record the response in team_invite_responses
+        cursor.execute('INSERT INTO team_invite_responses (mail_id, response) VALUES (?, ?)', 
+                      (mail_id, 'accepted'))
     conn.close()
+    mail_events.publish(user_id, 'unread')
     
     flash('You have joined the team', 'success')
     return redirect(url_for('view_team', team_id=team_id))
@@ -1883,7 +2067,7 @@ def accept_team_invite(mail_id):
 def decline_team_invite(mail_id):
     """Decline a team invitation"""
     user_id = session.get('user_id')
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Get the invitation
@@ -1899,19 +2083,67 @@ def decline_team_invite(mail_id):
         flash('Invitation not found or already processed', 'error')
         return redirect(url_for('mail_inbox'))
     
-    # Mark invitation as read
-    cursor.execute('UPDATE mail SET is_read = 1 WHERE id = ?', (mail_id,))
-    
-    # Record the response in team_invite_responses
-    cursor.execute('INSERT INTO team_invite_responses (mail_id, response) VALUES (?, ?)', 
-                  (mail_id, 'declined'))
+    with db_utils.write_transaction():
+        # Mark invitation as read
+        cursor.execute('UPDATE mail SET is_read = 1 WHERE id = ?', (mail_id,))
     
-    conn.commit()
+        # Record the response in team_invite_responses
+        cursor.execute('INSERT INTO team_invite_responses (mail_id, response) VALUES (?, ?)', 
+                      (mail_id, 'declined'))
     conn.close()
+    mail_events.publish(user_id, 'unread')
     
     flash('You have declined the team invitation', 'success')
     return redirect(url_for('mail_inbox'))
 
+@app.route('/mail/unread-count')
+@login_required
+def unread_mail_count_api():
+    """Unread mail count as JSON (polled by pages that can't keep an event stream open)"""
+    return jsonify({'count': get_unread_mail_count()})
+
+@app.route('/mail/events')
+@login_required
+def mail_event_stream():
+    """Server-Sent Events stream of the user's unread count and new team invites
+
+    Sends an "unread" event whenever the count changes and an "invite" event
+    for each new team invitation. The stream ends after
+    mail_events.STREAM_MAX_AGE seconds and the browser reconnects, so a
+    long-lived connection never pins a worker indefinitely.
+    """
+    user_id = session.get('user_id')
+    
+    def generate():
+        subscriber = mail_events.subscribe(user_id)
+        try:
+            yield f"retry: {mail_events.STREAM_RETRY_MS}\n\n"
+            last_count = None
+            deadline = time.time() + mail_events.STREAM_MAX_AGE
+            while time.time() < deadline:
+                # One point read of the counter; also catches changes made in other workers
+                count = db_utils.get_unread_mail_count(user_id)
+                if count != last_count:
+                    yield mail_events.format_event('unread', {'count': count})
+                    last_count = count
+                
+                try:
+                    event, data = subscriber.get(timeout=mail_events.STREAM_RECHECK_INTERVAL)
+                except queue.Empty:
+                    # Keepalive comment, which also notices clients that went away
+                    yield ": keepalive\n\n"
+                    continue
+                
+                if event != 'unread':
+                    yield mail_events.format_event(event, data)
+        finally:
+            mail_events.unsubscribe(user_id, subscriber)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # Don't let nginx buffer the stream
+    })
+
 # Update base context to include unread mail count
 @app.context_processor
 def inject_unread_mail_count():
@@ -1953,7 +2185,7 @@ def server_error(e):
 @admin_required
 def admin_make_team_leader(user_id, team_id):
     """Make a user a team leader for a specific team"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Check if user exists
@@ -1982,19 +2214,18 @@ def admin_make_team_leader(user_id, team_id):
     cursor.execute("SELECT id FROM team_members WHERE team_id = ? AND user_id = ?", (team_id, user_id))
     is_member = cursor.fetchone()
     
-    if not is_member:
-        # Add user to the team as a leader
-        cursor.execute("INSERT INTO team_members (team_id, user_id, is_leader) VALUES (?, ?, 1)", (team_id, user_id))
-        action = "added to"
-    else:
-        # Update user to be a leader
-        cursor.execute("UPDATE team_members SET is_leader = 1 WHERE team_id = ? AND user_id = ?", (team_id, user_id))
-        action = "updated as leader in"
-    
-    # Remove leader status from other members of this team
-    cursor.execute("UPDATE team_members SET is_leader = 0 WHERE team_id = ? AND user_id != ?", (team_id, user_id))
+    with db_utils.write_transaction():
+        if not is_member:
+            # Add user to the team as a leader
+            cursor.execute("INSERT INTO team_members (team_id, user_id, is_leader) VALUES (?, ?, 1)", (team_id, user_id))
+            action = "added to"
+        else:
+            # Update user to be a leader
+            cursor.execute("UPDATE team_members SET is_leader = 1 WHERE team_id = ? AND user_id = ?", (team_id, user_id))
+            action = "updated as leader in"
     
-    conn.commit()
+        # Remove leader status from other members of this team
+        cursor.execute("UPDATE team_members SET is_leader = 0 WHERE team_id = ? AND user_id != ?", (team_id, user_id))
     conn.close()
     
     flash(f'User {username} has been {action} team {team_name} as leader', 'success')
@@ -2006,8 +2237,7 @@ def search_users_for_team(team_id):
     """Search for users to invite to a team"""
     try:
         user_id = session.get('user_id')
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
+        conn = get_db()
         cursor = conn.cursor()
 
         # Check if team exists
@@ -2146,8 +2376,7 @@ def search_users_for_team(team_id):
 def disband_team(team_id):
     """Disband a team (team leader only)"""
     user_id = session.get('user_id')
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     # Check if team exists
@@ -2184,23 +2413,22 @@ def disband_team(team_id):
     # Get team name for notification
     team_name = team['name']
     
-    # Delete all team members
-    cursor.execute('DELETE FROM team_members WHERE team_id = ?', (team_id,))
-    
-    # Delete the team
-    cursor.execute('DELETE FROM teams WHERE id = ?', (team_id,))
+    with db_utils.write_transaction():
+        # Delete all team members
+        cursor.execute('DELETE FROM team_members WHERE team_id = ?', (team_id,))
     
-    # Notify all members that the team has been disbanded
-    for member in members:
-        send_mail(
-            sender_id=user_id,
-            recipient_id=member['id'],
-            subject=f"Team {team_name} has been disbanded",
-            content=f"The team '{team_name}' has been disbanded by the team leader.",
-            mail_type='system_notification'
-        )
+        # Delete the team
+        cursor.execute('DELETE FROM teams WHERE id = ?', (team_id,))
     
-    conn.commit()
+        # Notify all members that the team has been disbanded
+        for member in members:
+            send_mail(
+                sender_id=user_id,
+                recipient_id=member['id'],
+                subject=f"Team {team_name} has been disbanded",
+                content=f"The team '{team_name}' has been disbanded by the team leader.",
+                mail_type='system_notification'
+            )
     conn.close()
     
     flash(f'Team "{team_name}" has been disbanded and all members have been notified.', 'success')
@@ -2215,8 +2443,7 @@ def team_settings(team_id):
         flash('You must be logged in to access team settings', 'error')
         return redirect(url_for('login'))
     
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
@@ -2282,15 +2509,14 @@ def team_settings(team_id):
                 if team_logo and team_logo.filename:
                     logo_path = save_team_logo(team_logo, team_name)
                 
-                # Update team settings
-                cursor.execute('''
-                    UPDATE teams 
-                    SET name = ?, description = ?, logo = ?, 
-                        email = ?, discord = ?, website = ?, rules = ?, points = ?
-                    WHERE id = ?
-                ''', (team_name, description, logo_path, team_email, team_discord, team_website, team_rules, team_points, team_id))
-                
-                conn.commit()
+                with db_utils.write_transaction():
+                    # Update team settings
+                    cursor.execute('''
+                        UPDATE teams 
+                        SET name = ?, description = ?, logo = ?, 
+                            email = ?, discord = ?, website = ?, rules = ?, points = ?
+                        WHERE id = ?
+                    ''', (team_name, description, logo_path, team_email, team_discord, team_website, team_rules, team_points, team_id))
                 flash('Team settings updated successfully', 'success')
                 return redirect(url_for('view_team', team_id=team_id))
             except Exception as e:
@@ -2333,8 +2559,7 @@ def kick_team_member(team_id, user_id):
     """Kick a member from a team (leader only)"""
     current_user_id = session.get('user_id')
     
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
@@ -2373,23 +2598,22 @@ def kick_team_member(team_id, user_id):
             flash('Cannot kick the team leader', 'error')
             return redirect(url_for('view_team', team_id=team_id))
         
-        # Remove user from team
-        cursor.execute('DELETE FROM team_members WHERE team_id = ? AND user_id = ?', (team_id, user_id))
+        with db_utils.write_transaction():
+            # Remove user from team
+            cursor.execute('DELETE FROM team_members WHERE team_id = ? AND user_id = ?', (team_id, user_id))
         
-        # Get kicked user's username for the log
-        cursor.execute('SELECT username FROM users WHERE id = ?', (user_id,))
-        kicked_user = cursor.fetchone()
-        kicked_username = kicked_user['username'] if kicked_user else f"User {user_id}"
+            # Get kicked user's username for the log
+            cursor.execute('SELECT username FROM users WHERE id = ?', (user_id,))
+            kicked_user = cursor.fetchone()
+            kicked_username = kicked_user['username'] if kicked_user else f"User {user_id}"
         
-        # Get team name
-        cursor.execute('SELECT name FROM teams WHERE id = ?', (team_id,))
-        team = cursor.fetchone()
-        team_name = team['name'] if team else f"Team {team_id}"
-        
-        # Log the action - removed team_activity reference
-        # Instead, just log to system logs if needed
+            # Get team name
+            cursor.execute('SELECT name FROM teams WHERE id = ?', (team_id,))
+            team = cursor.fetchone()
+            team_name = team['name'] if team else f"Team {team_id}"
         
-        conn.commit()
+            # Log the action - removed team_activity reference
+            # Instead, just log to system logs if needed
         flash(f'User {kicked_username} has been removed from the team', 'success')
         
     except Exception as e:
@@ -2408,8 +2632,7 @@ def view_user(user_id):
             return redirect(url_for('profile'))
         
         # Get the user's details
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
+        conn = get_db()
         cursor = conn.cursor()
         
         # Get user details
@@ -2474,8 +2697,7 @@ def promote_member(team_id, user_id):
     """Promote a team member to co-leader (leader only)"""
     current_user_id = session.get('user_id')
     
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
@@ -2517,19 +2739,18 @@ def promote_member(team_id, user_id):
         # Toggle between member and co-leader
         new_role = 'member' if current_role == 'co-leader' else 'co-leader'
         
-        # Update the user's role
-        cursor.execute('''
-            UPDATE team_members
-            SET role = ?
-            WHERE team_id = ? AND user_id = ?
-        ''', (new_role, team_id, user_id))
-        
-        # Get promoted user's username for the notification
-        cursor.execute('SELECT username FROM users WHERE id = ?', (user_id,))
-        user = cursor.fetchone()
-        username = user['username'] if user else f"User {user_id}"
+        with db_utils.write_transaction():
+            # Update the user's role
+            cursor.execute('''
+                UPDATE team_members
+                SET role = ?
+                WHERE team_id = ? AND user_id = ?
+            ''', (new_role, team_id, user_id))
         
-        conn.commit()
+            # Get promoted user's username for the notification
+            cursor.execute('SELECT username FROM users WHERE id = ?', (user_id,))
+            user = cursor.fetchone()
+            username = user['username'] if user else f"User {user_id}"
         action = 'demoted from co-leader to member' if new_role == 'member' else 'promoted to co-leader'
         flash(f'{username} has been {action}', 'success')
         
@@ -2557,71 +2778,66 @@ def admin_toggle_ban(user_id):
     # Get ban reason if provided
     ban_reason = request.form.get('ban_reason', 'Violation of community guidelines')
     
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
-        # Check if the is_banned column exists
-        cursor.execute("PRAGMA table_info(users)")
-        columns = cursor.fetchall()
-        if not any(column['name'] == 'is_banned' for column in columns):
-            # Add the is_banned column if it doesn't exist
-            cursor.execute("ALTER TABLE users ADD COLUMN is_banned INTEGER DEFAULT 0")
-            conn.commit()
-        
-        # Check if the ban_reason column exists
-        if not any(column['name'] == 'ban_reason' for column in columns):
-            # Add the ban_reason column if it doesn't exist
-            cursor.execute("ALTER TABLE users ADD COLUMN ban_reason TEXT")
-            conn.commit()
-        
-        # Get current ban status
-        cursor.execute('SELECT username, is_banned FROM users WHERE id = ?', (user_id,))
-        user = cursor.fetchone()
+        with db_utils.write_transaction():
+            # Check if the is_banned column exists
+            cursor.execute("PRAGMA table_info(users)")
+            columns = cursor.fetchall()
+            if not any(column['name'] == 'is_banned' for column in columns):
+                # Add the is_banned column if it doesn't exist
+                cursor.execute("ALTER TABLE users ADD COLUMN is_banned INTEGER DEFAULT 0")
+        
+            # Check if the ban_reason column exists
+            if not any(column['name'] == 'ban_reason' for column in columns):
+                # Add the ban_reason column if it doesn't exist
+                cursor.execute("ALTER TABLE users ADD COLUMN ban_reason TEXT")
+        
+            # Get current ban status
+            cursor.execute('SELECT username, is_banned FROM users WHERE id = ?', (user_id,))
+            user = cursor.fetchone()
         
-        if not user:
-            flash('User not found', 'error')
-            conn.close()
-            return redirect(url_for('admin_dashboard'))
+            if not user:
+                flash('User not found', 'error')
+                conn.close()
+                return redirect(url_for('admin_dashboard'))
         
-        # Toggle ban status
-        new_status = 0 if user['is_banned'] == 1 else 1
+            # Toggle ban status
+            new_status = 0 if user['is_banned'] == 1 else 1
         
-        # Update user's ban status and reason
-        if new_status == 1:
-            cursor.execute('UPDATE users SET is_banned = ?, ban_reason = ? WHERE id = ?', 
-                          (new_status, ban_reason, user_id))
-        else:
-            cursor.execute('UPDATE users SET is_banned = ?, ban_reason = NULL WHERE id = ?', 
-                          (new_status, user_id))
-        
-        # If banning, log the user out
-        if new_status == 1:
-            # First check if sessions table exists
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='sessions'")
-            sessions_table_exists = cursor.fetchone() is not None
+            # Update user's ban status and reason
+            if new_status == 1:
+                cursor.execute('UPDATE users SET is_banned = ?, ban_reason = ? WHERE id = ?', 
+                              (new_status, ban_reason, user_id))
+            else:
+                cursor.execute('UPDATE users SET is_banned = ?, ban_reason = NULL WHERE id = ?', 
+                              (new_status, user_id))
+        
+            # If banning, log the user out
+            if new_status == 1:
+                # First check if sessions table exists
+                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='sessions'")
+                sessions_table_exists = cursor.fetchone() is not None
             
-            if not sessions_table_exists:
-                # Create the sessions table if it doesn't exist
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS sessions (
-                        session_id TEXT PRIMARY KEY,
-                        user_id INTEGER,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users(id)
-                    )
-                ''')
-                conn.commit()
+                if not sessions_table_exists:
+                    # Create the sessions table if it doesn't exist
+                    cursor.execute('''
+                        CREATE TABLE IF NOT EXISTS sessions (
+                            session_id TEXT PRIMARY KEY,
+                            user_id INTEGER,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                            FOREIGN KEY (user_id) REFERENCES users(id)
+                        )
+                    ''')
             
-            # Now we can safely delete from the sessions table
-            try:
-                cursor.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
-            except sqlite3.Error:
-                # If there's still an error, we'll just continue without deleting sessions
-                pass
-        
-        conn.commit()
+                # Now we can safely delete from the sessions table
+                try:
+                    cursor.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+                except sqlite3.Error:
+                    # If there's still an error, we'll just continue without deleting sessions
+                    pass
         
         action = 'banned' if new_status == 1 else 'unbanned'
         flash(f'User {user["username"]} has been {action}', 'success')
@@ -2692,27 +2908,26 @@ def run_migrations():
         return redirect(url_for('main'))
         
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         cursor = conn.cursor()
         
-        # Check if axe_tier column exists
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [column[1] for column in cursor.fetchall()]
+        with db_utils.write_transaction():
+            # Check if axe_tier column exists
+            cursor.execute("PRAGMA table_info(users)")
+            columns = [column[1] for column in cursor.fetchall()]
         
-        migrations_run = []
+            migrations_run = []
         
-        # Add axe_tier column if it doesn't exist
-        if 'axe_tier' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN axe_tier TEXT")
-            migrations_run.append("Added axe_tier column to users table")
-            
-        # Map nethpot_tier to npot_tier for existing users if npot_tier doesn't exist
-        if 'npot_tier' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN npot_tier TEXT")
-            cursor.execute("UPDATE users SET npot_tier = nethpot_tier WHERE nethpot_tier IS NOT NULL")
-            migrations_run.append("Added npot_tier column and mapped values from nethpot_tier")
+            # Add axe_tier column if it doesn't exist
+            if 'axe_tier' not in columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN axe_tier TEXT")
+                migrations_run.append("Added axe_tier column to users table")
             
-        conn.commit()
+            # Map nethpot_tier to npot_tier for existing users if npot_tier doesn't exist
+            if 'npot_tier' not in columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN npot_tier TEXT")
+                cursor.execute("UPDATE users SET npot_tier = nethpot_tier WHERE nethpot_tier IS NOT NULL")
+                migrations_run.append("Added npot_tier column and mapped values from nethpot_tier")
         conn.close()
         
         if migrations_run:
@@ -2744,9 +2959,6 @@ def update_skill_tiers():
                 return redirect(url_for('profile'))
             
             # Update legacy tier columns for backward compatibility
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            
             # Get tier values from form
             npot_tier = request.form.get('npot_tier', '').strip().upper()
             uhc_tier = request.form.get('uhc_tier', '').strip().upper()
@@ -2773,23 +2985,22 @@ def update_skill_tiers():
                 smp_tier = None
             
             # Update legacy columns
-            cursor.execute('''
-                UPDATE users SET
-                    npot_tier = ?,
-                    uhc_tier = ?,
-                    cpvp_tier = ?,
-                    sword_tier = ?,
-                    axe_tier = ?,
-                    smp_tier = ?
-                WHERE id = ?
-            ''', (npot_tier, uhc_tier, cpvp_tier, sword_tier, axe_tier, smp_tier, user_id))
-            
-            # Also update nethpot_tier for backward compatibility
-            if npot_tier:
-                cursor.execute('UPDATE users SET nethpot_tier = ? WHERE id = ?', (npot_tier, user_id))
-            
-            conn.commit()
-            conn.close()
+            with db_utils.write_transaction() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE users SET
+                        npot_tier = ?,
+                        uhc_tier = ?,
+                        cpvp_tier = ?,
+                        sword_tier = ?,
+                        axe_tier = ?,
+                        smp_tier = ?
+                    WHERE id = ?
+                ''', (npot_tier, uhc_tier, cpvp_tier, sword_tier, axe_tier, smp_tier, user_id))
+                
+                # Also update nethpot_tier for backward compatibility
+                if npot_tier:
+                    cursor.execute('UPDATE users SET nethpot_tier = ? WHERE id = ?', (npot_tier, user_id))
             
             flash('Your skill tiers have been updated successfully!', 'success')
             return redirect(url_for('profile'))
@@ -2820,39 +3031,35 @@ def update_skill_tiers():
             if smp_tier not in valid_tiers:
                 smp_tier = None
             
-            conn = sqlite3.connect(DB_PATH)
+            conn = get_db()
             cursor = conn.cursor()
             
-            # Ensure all necessary columns exist
-            cursor.execute("PRAGMA table_info(users)")
-            columns = [column[1] for column in cursor.fetchall()]
-            
-            missing_columns = []
-            for column_name in ['npot_tier', 'axe_tier']:
-                if column_name not in columns:
-                    missing_columns.append(column_name)
-                    cursor.execute(f"ALTER TABLE users ADD COLUMN {column_name} TEXT")
-            
-            if missing_columns:
-                conn.commit()
+            with db_utils.write_transaction():
+                # Ensure all necessary columns exist
+                cursor.execute("PRAGMA table_info(users)")
+                columns = [column[1] for column in cursor.fetchall()]
             
-            # Update user's tiers
-            cursor.execute('''
-                UPDATE users SET
-                    npot_tier = ?,
-                    uhc_tier = ?,
-                    cpvp_tier = ?,
-                    sword_tier = ?,
-                    axe_tier = ?,
-                    smp_tier = ?
-                WHERE id = ?
-            ''', (npot_tier, uhc_tier, cpvp_tier, sword_tier, axe_tier, smp_tier, user_id))
+                missing_columns = []
+                for column_name in ['npot_tier', 'axe_tier']:
+                    if column_name not in columns:
+                        missing_columns.append(column_name)
+                        cursor.execute(f"ALTER TABLE users ADD COLUMN {column_name} TEXT")
             
-            # Also update nethpot_tier for backward compatibility
-            if npot_tier:
-                cursor.execute('UPDATE users SET nethpot_tier = ? WHERE id = ?', (npot_tier, user_id))
+                # Update user's tiers
+                cursor.execute('''
+                    UPDATE users SET
+                        npot_tier = ?,
+                        uhc_tier = ?,
+                        cpvp_tier = ?,
+                        sword_tier = ?,
+                        axe_tier = ?,
+                        smp_tier = ?
+                    WHERE id = ?
+                ''', (npot_tier, uhc_tier, cpvp_tier, sword_tier, axe_tier, smp_tier, user_id))
             
-            conn.commit()
+                # Also update nethpot_tier for backward compatibility
+                if npot_tier:
+                    cursor.execute('UPDATE users SET nethpot_tier = ? WHERE id = ?', (npot_tier, user_id))
             conn.close()
             
             flash('Your skill tiers have been updated successfully!', 'success')
@@ -2871,8 +3078,7 @@ def debug_schema():
         return redirect(url_for('main'))
     
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
+        conn = get_db()
         cursor = conn.cursor()
         
         # Get schema info
@@ -2945,60 +3151,21 @@ def backup_database():
         return redirect(url_for('main'))
     
     try:
-        # Create backups directory if it doesn't exist
-        backup_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backups')
-        os.makedirs(backup_dir, exist_ok=True)
+        if not os.path.exists(DB_PATH):
+            flash('Database file not found.', 'error')
+            return redirect(url_for('admin_dashboard'))
         
         # Generate timestamp for the backup file
-        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-        db_backup_path = os.path.join(backup_dir, f'cosmic_teams_backup_{timestamp}.db')
-        sql_backup_path = os.path.join(backup_dir, f'cosmic_teams_backup_{timestamp}.sql')
-        
-        # Copy the database file
-        shutil.copy2(DB_PATH, db_backup_path)
-        
-        # Create SQL dump
-        connection = sqlite3.connect(DB_PATH)
-        with open(sql_backup_path, 'w') as f:
-            # Get schema
-            cursor = connection.cursor()
-            cursor.execute("SELECT sql FROM sqlite_master WHERE type='table'")
-            schemas = cursor.fetchall()
-            
-            for schema in schemas:
-                if schema[0] is not None:  # Exclude sqlite_sequence and other system tables
-                    f.write(f"{schema[0]};\n\n")
-            
-            # Get data
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            tables = cursor.fetchall()
-            
-            for table in tables:
-                table_name = table[0]
-                if not table_name.startswith('sqlite_'):
-                    cursor.execute(f"SELECT * FROM {table_name}")
-                    rows = cursor.fetchall()
-                    
-                    for row in rows:
-                        values = []
-                        for value in row:
-                            if value is None:
-                                values.append("NULL")
-                            elif isinstance(value, (int, float)):
-                                values.append(str(value))
-                            else:
-                                # Fix the string escaping syntax
-                                escaped_value = str(value).replace("'", "''")
-                                values.append(f"'{escaped_value}'")
-                        
-                        f.write(f"INSERT INTO {table_name} VALUES ({', '.join(values)});\n")
-                    f.write("\n")
-        
-        connection.close()
-        
-        # Flash success message and redirect
-        flash(f'Database backup created successfully. Files saved as cosmic_teams_backup_{timestamp}.db and cosmic_teams_backup_{timestamp}.sql', 'success')
-        return redirect(url_for('admin_dashboard'))
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        compress = request.form.get('compress') == '1'
+        filename = f'cosmic_teams_backup_{timestamp}.sql' + ('.gz' if compress else '')
+        
+        # Stream the SQL dump (schema, data, indexes) straight to the client
+        return Response(
+            db_backup.iter_dump_chunks(DB_PATH, compress=compress),
+            mimetype='application/gzip' if compress else 'application/sql',
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
+        )
     
     except Exception as e:
         flash(f'Failed to create database backup: {str(e)}', 'error')
@@ -3035,104 +3202,63 @@ def restore_database():
         
         # Get file extension
         file_ext = os.path.splitext(file.filename)[1].lower()
+        if file.filename.lower().endswith('.sql.gz'):
+            file_ext = '.sql.gz'
         
         if file_ext == '.db':
-            # Save the file temporarily
-            temp_path = os.path.join(temp_dir, 'temp_restore.db')
-            file.save(temp_path)
+            # Save the upload next to the live database; it is validated before anything is replaced
+            restore_path = db_backup.restore_path()
+            db_backup.remove_database_files(restore_path)
+            file.save(restore_path)
             
             # Create a backup of the current database before restoring
-            backup_timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+            backup_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             backup_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backups')
             os.makedirs(backup_dir, exist_ok=True)
             backup_path = os.path.join(backup_dir, f'pre_restore_backup_{backup_timestamp}.db')
             
             # Copy current database to backup
-            shutil.copy2(DB_PATH, backup_path)
-            
-            # Replace the current database with the uploaded one
-            # First make sure Flask isn't using the database
-            db = getattr(g, '_database', None)
-            if db is not None:
-                db.close()
-                g._database = None
-            
-            # Copy the uploaded file to replace the current database
-            shutil.copy2(temp_path, DB_PATH)
+            db_backup.snapshot_database(backup_path, DB_PATH)
             
-            # Clean up the temp file
-            os.remove(temp_path)
+            # Swap the uploaded database in; workers pause briefly and reconnect
+            db_utils.end_scope()
+            db_backup.install_database(restore_path)
             
             flash('Database has been successfully restored from the uploaded file.', 'success')
             
-        elif file_ext == '.sql':
+        elif file_ext in ('.sql', '.sql.gz'):
             # Save the file temporarily
-            temp_path = os.path.join(temp_dir, 'temp_restore.sql')
+            temp_path = os.path.join(temp_dir, 'temp_restore' + file_ext)
             file.save(temp_path)
             
             # Create a backup of the current database before restoring
-            backup_timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+            backup_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             backup_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backups')
             os.makedirs(backup_dir, exist_ok=True)
             backup_path = os.path.join(backup_dir, f'pre_restore_backup_{backup_timestamp}.db')
             
             # Copy current database to backup
-            shutil.copy2(DB_PATH, backup_path)
+            db_backup.snapshot_database(backup_path, DB_PATH)
             
-            # First make sure Flask isn't using the database
-            db = getattr(g, '_database', None)
-            if db is not None:
-                db.close()
-                g._database = None
-            
-            # Execute the SQL file
-            connection = sqlite3.connect(DB_PATH)
-            cursor = connection.cursor()
-            
-            with open(temp_path, 'r') as f:
-                sql_script = f.read()
-                # Split by semicolons but handle quoted semicolons properly
-                statements = []
-                current_statement = ''
-                in_quotes = False
-                quote_char = None
-                
-                for char in sql_script:
-                    if char in ["'", '"'] and (not in_quotes or quote_char == char):
-                        in_quotes = not in_quotes
-                        if in_quotes:
-                            quote_char = char
-                        else:
-                            quote_char = None
-                    
-                    if char == ';' and not in_quotes:
-                        if current_statement.strip():
-                            statements.append(current_statement.strip())
-                        current_statement = ''
-                    else:
-                        current_statement += char
-                
-                if current_statement.strip():
-                    statements.append(current_statement.strip())
-                
-                for statement in statements:
-                    try:
-                        cursor.execute(statement)
-                    except sqlite3.Error as e:
-                        print(f"Error executing SQL statement: {e}")
-                        print(f"Statement: {statement}")
-                        # Continue with other statements
+            # Replay the SQL file into a fresh database next to the live one
+            restore_path = db_backup.restore_path()
+            db_backup.remove_database_files(restore_path)
+            try:
+                executed, failed = db_backup.restore_sql_dump(temp_path, restore_path)
+            finally:
+                os.remove(temp_path)
             
-            connection.commit()
-            connection.close()
+            # Swap it in; workers pause briefly and reconnect
+            db_utils.end_scope()
+            db_backup.install_database(restore_path)
             
-            # Clean up the temp file
-            os.remove(temp_path)
+            if failed:
+                flash(f'{failed} of {executed + failed} SQL statements failed and were skipped (see backup.log).', 'warning')
             
             flash('Database has been successfully restored from the SQL file.', 'success')
             
         else:
-            flash('Invalid file type. Please upload a .db or .sql file.', 'error')
+            flash('Invalid file type. Please upload a .db, .sql or .sql.gz file.', 'error')
             return redirect(url_for('restore_database_page'))
         
         return redirect(url_for('admin_dashboard'))
@@ -3145,15 +3271,18 @@ def restore_database():
 def initialize_app_data():
     """Initialize the app data at startup"""
     try:
-        # Start the backup scheduler in a separate thread
+        # Start the backup scheduler (only the lease holder among the workers runs jobs)
         if 'db_backup' in globals():
-            threading.Thread(target=db_backup.start_scheduler, daemon=True).start()
+            db_backup.start_scheduler()
             app.logger.info("Database backup scheduler started")
-            
-        # Migrate existing user tier data
+        
+        # Start sending queued emails
+        email_outbox.start_worker()
+        
+        # Migrate existing user tier data (once per database, not per worker boot)
         if 'TierManager' in globals():
-            TierManager.migrate_existing_user_tiers()
-            app.logger.info("User tiers migrated to new system")
+            if TierManager.migrate_existing_user_tiers_once():
+                app.logger.info("User tiers migrated to new system")
     except Exception as e:
         app.logger.error(f"Failed to start initialization: {str(e)}")
 
@@ -3184,10 +3313,10 @@ def admin_backup():
             if not backup_id:
                 flash("No backup selected for restoration", "error")
             else:
-                # Get backup list
-                backups = db_backup.list_backups()
-                if 0 <= int(backup_id) < len(backups):
-                    backup_path = backups[int(backup_id)]['path']
+                # Look the backup up in the catalog
+                backup = db_backup.get_backup(int(backup_id)) if backup_id.isdigit() else None
+                if backup:
+                    backup_path = backup['path']
                     # This would be dangerous to do directly in a production environment
                     # In a real app, you might want to queue this for execution during maintenance
                     success, message = db_backup.restore_backup(backup_path)
@@ -3207,7 +3336,14 @@ def admin_backup():
         backups = []
         flash(f"Failed to list backups: {str(e)}", "error")
     
-    return render_template('admin_backup.html', backups=backups)
+    # Get which worker currently runs the scheduled backups
+    try:
+        scheduler = db_backup.get_scheduler_status()
+    except Exception as e:
+        app.logger.error(f"Failed to read scheduler status: {str(e)}")
+        scheduler = None
+    
+    return render_template('admin_backup.html', backups=backups, scheduler=scheduler)
 
 # Run the application
 if __name__ == '__main__':
@@ -3226,7 +3362,7 @@ def leaderboards():
         
         return render_template('leaderboards.html', 
                                leaderboards=leaderboards,
-                               unread_mail_count=get_unread_mail_count())
+                               unread_mail_count=get_unread_mail_count(session.get('user_id')))
     except Exception as e:
         flash(f"Error loading leaderboards: {str(e)}", "error")
         return redirect(url_for('main'))
@@ -3268,19 +3404,16 @@ def skill_recommendations():
         user_skills = TierManager.get_user_skills(user_id)
         
         # Get recommendations
-        recommendations = TierManager.get_tier_recommendations(user_id)
+        recommendations = TierManager.get_tier_recommendations(user_id, user_skills)
         
         # Get user's ranks in each skill
-        user_ranks = {}
-        for skill in user_skills:
-            if skill.get('tier_name'):
-                user_ranks[skill['skill_code']] = TierManager.get_user_tier_rank(user_id, skill['skill_code'])
+        user_ranks = TierManager.get_user_ranks(user_id)
         
         return render_template('skill_recommendations.html', 
                                user_skills=user_skills,
                                recommendations=recommendations,
                                user_ranks=user_ranks,
-                               unread_mail_count=get_unread_mail_count())
+                               unread_mail_count=get_unread_mail_count(user_id))
     except Exception as e:
         flash(f"Error loading skill recommendations: {str(e)}", "error")
         return redirect(url_for('profile'))
@@ -3376,7 +3509,7 @@ def follow_user(user_id):
             flash('You cannot follow yourself', 'error')
             return redirect(url_for('view_user', user_id=user_id))
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         cursor = conn.cursor()
         
         # Check if already following
@@ -3388,13 +3521,12 @@ def follow_user(user_id):
         if cursor.fetchone():
             flash('You are already following this user', 'info')
         else:
-            # Add follow relationship
-            cursor.execute('''
-                INSERT INTO user_follows (follower_id, following_id, created_at)
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            ''', (follower_id, user_id))
-            
-            conn.commit()
+            with db_utils.write_transaction():
+                # Add follow relationship
+                cursor.execute('''
+                    INSERT INTO user_follows (follower_id, following_id, created_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                ''', (follower_id, user_id))
             flash('You are now following this user', 'success')
         
         conn.close()
@@ -3412,21 +3544,20 @@ def unfollow_user(user_id):
     try:
         follower_id = session.get('user_id')
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         cursor = conn.cursor()
         
-        # Remove follow relationship
-        cursor.execute('''
-            DELETE FROM user_follows 
-            WHERE follower_id = ? AND following_id = ?
-        ''', (follower_id, user_id))
-        
-        if cursor.rowcount > 0:
-            flash('You have unfollowed this user', 'success')
-        else:
-            flash('You were not following this user', 'info')
+        with db_utils.write_transaction():
+            # Remove follow relationship
+            cursor.execute('''
+                DELETE FROM user_follows 
+                WHERE follower_id = ? AND following_id = ?
+            ''', (follower_id, user_id))
         
-        conn.commit()
+            if cursor.rowcount > 0:
+                flash('You have unfollowed this user', 'success')
+            else:
+                flash('You were not following this user', 'info')
         conn.close()
         return redirect(url_for('view_user', user_id=user_id))
     
@@ -61,41 +61,41 @@ def list_backups(args):
     print_info(f"Found {len(backups)} backups:\n")
     
     # Print table header
-    print(f"{'ID':<3} | {'Type':<8} | {'Created At':<19} | {'Size':<10} | {'Filename'}")
-    print("-" * 80)
+    print(f"{'ID':<3} | {'Type':<8} | {'Created At':<19} | {'Size':<10} | {'Verified':<8} | {'Filename'}")
+    print("-" * 91)
     
     # Print table rows
-    for idx, backup in enumerate(backups, 1):
+    for backup in backups:
         size_kb = backup.get('size', 0) // 1024
-        print(f"{idx:<3} | {backup['type']:<8} | {backup.get('created_at', 'Unknown'):<19} | {size_kb:<8} KB | {backup['filename']}")
+        verified = backup.get('verify_status') or 'pending'
+        print(f"{backup['id']:<3} | {backup['type']:<8} | {backup.get('created_at', 'Unknown'):<19} | {size_kb:<8} KB | {verified:<8} | {backup['filename']}")
     
-    print("\n" + "-" * 80)
+    print("\n" + "-" * 91)
     print_info("To restore a backup, use: python backup.py restore --id <ID>")
     
     return 0
 
 def restore_backup(args):
     """Restore a backup"""
+    if args.at:
+        return restore_point_in_time(args)
+    
     if not args.id and not args.path:
-        print_error("Either --id or --path must be specified")
+        print_error("Either --id, --path or --at must be specified")
         return 1
     
     if args.id:
-        backups = db_backup.list_backups()
-        if not backups:
-            print_error("No backups found")
-            return 1
-        
         try:
-            backup_id = int(args.id) - 1  # Convert to 0-based index
-            if backup_id < 0 or backup_id >= len(backups):
-                print_error(f"Invalid backup ID. Use a value between 1 and {len(backups)}")
-                return 1
-            
-            backup_path = backups[backup_id]['path']
+            backup = db_backup.get_backup(int(args.id))
         except ValueError:
             print_error("Backup ID must be a number")
             return 1
+        
+        if not backup:
+            print_error("Invalid backup ID. Use an ID shown by the list command")
+            return 1
+        
+        backup_path = backup['path']
     else:
         backup_path = args.path
         if not os.path.exists(backup_path):
@@ -123,6 +123,120 @@ def restore_backup(args):
     
     return 0
 
+def restore_point_in_time(args):
+    """Restore the database to a point in time from the WAL archive"""
+    try:
+        target = datetime.strptime(args.at, "%Y-%m-%d %H:%M")
+    except ValueError:
+        print_error("--at must look like 'YYYY-MM-DD HH:MM'")
+        return 1
+    
+    print_info(f"Preparing to restore the database as it was at {args.at}")
+    print_info("This will REPLACE the current database.")
+    print_info("A safety backup of the current database will be created.")
+    
+    if not args.yes:
+        confirmation = input("\nAre you sure you want to proceed? [y/N]: ").lower()
+        if confirmation != 'y':
+            print_info("Restoration canceled")
+            return 0
+    
+    print_info("Replaying WAL archive...")
+    success, message = db_backup.restore_point_in_time(target)
+    
+    if success:
+        print_success(message)
+    else:
+        print_error(f"Restore failed: {message}")
+        return 1
+    
+    return 0
+
+def wal_status(args):
+    """Show the WAL archive timelines and the times they can restore to"""
+    if not db_backup.WAL_ARCHIVE_ENABLED:
+        print_info("WAL archiving is off (set BACKUP_WAL_ARCHIVE=1 to enable it)")
+    
+    timelines = db_backup.list_wal_timelines()
+    if not timelines:
+        print_info("No WAL timelines found.")
+        return 0
+    
+    print(f"{'Base Taken':<19} | {'Restorable Until':<19} | {'Segments':<8} | {'Timeline'}")
+    print("-" * 80)
+    for timeline in timelines:
+        print(f"{timeline['created_at']:<19} | {timeline['latest_at']:<19} | {len(timeline['segments']):<8} | "
+              f"{os.path.basename(timeline['path'])}")
+    
+    print("\n" + "-" * 80)
+    print_info("To restore to a point in time, use: python backup.py restore --at 'YYYY-MM-DD HH:MM'")
+    return 0
+
+def rebuild_catalog(args):
+    """Rebuild the backup catalog from the files on disk"""
+    print_info("Scanning backup folders...")
+    
+    try:
+        count = db_backup.rebuild_catalog()
+    except Exception as e:
+        print_error(f"Failed to rebuild catalog: {str(e)}")
+        return 1
+    
+    print_success(f"Catalog rebuilt with {count} backups")
+    return 0
+
+def verify_backups(args):
+    """Verify one backup, or every backup not yet verified"""
+    if args.id:
+        try:
+            backup = db_backup.get_backup(int(args.id))
+        except ValueError:
+            print_error("Backup ID must be a number")
+            return 1
+        
+        if not backup:
+            print_error("Invalid backup ID. Use an ID shown by the list command")
+            return 1
+        
+        print_info(f"Verifying {backup['filename']}...")
+        ok, message = db_backup.verify_backup(backup['path'])
+        db_backup.record_verification(backup['id'], ok, message)
+        if not ok:
+            print_error(f"Verification failed: {message}")
+            return 1
+        print_success(f"Backup verified ({message})")
+        return 0
+    
+    print_info("Verifying backups that have not been checked yet...")
+    verified, failed = db_backup.verify_pending_backups(bytes_per_sec=0 if args.no_limit else None)
+    if failed:
+        print_error(f"{failed} backups failed verification ({verified} verified)")
+        return 1
+    print_success(f"{verified} backups verified")
+    return 0
+
+def benchmark(args):
+    """Compare compression codecs on a snapshot of the live database"""
+    codecs = args.codec or list(db_backup.CODECS)
+    print_info(f"Benchmarking {', '.join(codecs)} ({db_backup.BACKUP_CODEC_THREADS} threads for deflate-parallel)...")
+    
+    try:
+        results = db_backup.benchmark_codecs(codecs)
+    except Exception as e:
+        print_error(f"Benchmark failed: {str(e)}")
+        return 1
+    
+    print("\n{:<18} {:>10} {:>10} {:>12} {:>8}".format("CODEC", "SECONDS", "MB/S", "SIZE", "RATIO"))
+    print("-" * 62)
+    for result in results:
+        rate = result["raw_size"] / result["seconds"] / (1024 * 1024) if result["seconds"] else 0
+        ratio = result["raw_size"] / result["compressed_size"] if result["compressed_size"] else 0
+        print("{:<18} {:>10.2f} {:>10.1f} {:>9} KB {:>7.2f}x".format(
+            result["codec"], result["seconds"], rate, result["compressed_size"] // 1024, ratio))
+    
+    print_info(f"Current codec: {db_backup.BACKUP_CODEC} (set BACKUP_CODEC to change it)")
+    return 0
+
 def start_scheduler(args):
     """Start the backup scheduler"""
     print_info("Starting backup scheduler...")
@@ -165,12 +279,30 @@ def main():
     restore_parser = subparsers.add_parser("restore", help="Restore a backup")
     restore_parser.add_argument("--id", help="Backup ID from the list command")
     restore_parser.add_argument("--path", help="Direct path to backup file")
+    restore_parser.add_argument("--at", help="Point in time to restore from the WAL archive ('YYYY-MM-DD HH:MM')")
     restore_parser.add_argument("--yes", "-y", action="store_true", 
                                help="Skip confirmation prompt")
     
+    # WAL archive status command
+    wal_parser = subparsers.add_parser("wal-status", help="Show the WAL archive and the times it can restore to")
+    
+    # Rebuild catalog command
+    catalog_parser = subparsers.add_parser("rebuild-catalog", help="Rebuild the backup catalog from the backup folders")
+    
     # Start scheduler command
     scheduler_parser = subparsers.add_parser("scheduler", help="Start the backup scheduler")
     
+    # Verify backups command
+    verify_parser = subparsers.add_parser("verify", help="Verify backups restore to an intact database")
+    verify_parser.add_argument("--id", help="Backup ID to (re-)verify (default: all unverified backups)")
+    verify_parser.add_argument("--no-limit", action="store_true",
+                               help="Don't rate-limit disk reads")
+    
+    # Benchmark codecs command
+    benchmark_parser = subparsers.add_parser("benchmark", help="Compare compression codecs on the live database")
+    benchmark_parser.add_argument("--codec", action="append", choices=list(db_backup.CODECS),
+                                  help="Codec to benchmark (repeatable, default: all)")
+    
     args = parser.parse_args()
     
     # Print header
@@ -183,8 +315,16 @@ def main():
         return list_backups(args)
     elif args.command == "restore":
         return restore_backup(args)
+    elif args.command == "wal-status":
+        return wal_status(args)
+    elif args.command == "rebuild-catalog":
+        return rebuild_catalog(args)
     elif args.command == "scheduler":
         return start_scheduler(args)
+    elif args.command == "verify":
+        return verify_backups(args)
+    elif args.command == "benchmark":
+        return benchmark(args)
     else:
         parser.print_help()
         return 0
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+"""
+Performance Benchmarks
+
+This script runs synthetic benchmarks against throwaway copies of the
+database layer so changes can be compared before and after.
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+import db_utils
+import email_outbox
+from tier_manager import TierManager
+
+MAIL_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS mail (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id INTEGER,
+        recipient_id INTEGER NOT NULL,
+        subject TEXT NOT NULL,
+        content TEXT,
+        is_read INTEGER DEFAULT 0,
+        mail_type TEXT DEFAULT 'message',
+        related_id INTEGER,
+        sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+def print_header(title):
+    """Print script header"""
+    print("\n" + "=" * 60)
+    print(f" {title} ".center(60, "="))
+    print("=" * 60 + "\n")
+
+def print_result(label, writes, errors, elapsed):
+    """Print one benchmark result row"""
+    rate = writes / elapsed if elapsed else 0
+    print(f"{label:<28} | {writes:>7} writes | {errors:>5} errors | {elapsed:>6.2f} s | {rate:>8.1f} writes/s")
+
+# Database write throughput
+def _legacy_write_worker(db_path, threads, writes):
+    """Write the way the app used to: a new connection per write, rollback journal"""
+    def run(result):
+        for i in range(writes):
+            try:
+                conn = sqlite3.connect(db_path)
+                conn.execute('SELECT COUNT(*) FROM mail WHERE recipient_id = ?', (i % 50,)).fetchone()
+                conn.execute(
+                    'INSERT INTO mail (sender_id, recipient_id, subject, content) VALUES (?, ?, ?, ?)',
+                    (1, i % 50, 'Benchmark', 'x' * 200)
+                )
+                conn.commit()
+                conn.close()
+                result[0] += 1
+            except sqlite3.OperationalError:
+                result[1] += 1
+
+    return _run_threads(run, threads)
+
+def _pooled_write_worker(db_path, threads, writes, mode):
+    """Write through db_utils: pooled connections, journal mode, serialized writer"""
+    db_utils.DB_PATH = db_path
+    db_utils.DB_MODE = mode
+
+    def run(result):
+        for i in range(writes):
+            try:
+                with db_utils.connection_scope() as conn:
+                    conn.execute('SELECT COUNT(*) FROM mail WHERE recipient_id = ?', (i % 50,)).fetchone()
+                    with db_utils.write_transaction() as conn:
+                        conn.execute(
+                            'INSERT INTO mail (sender_id, recipient_id, subject, content) VALUES (?, ?, ?, ?)',
+                            (1, i % 50, 'Benchmark', 'x' * 200)
+                        )
+                result[0] += 1
+            except sqlite3.OperationalError:
+                result[1] += 1
+
+    return _run_threads(run, threads)
+
+def _run_threads(target, threads):
+    """Run target in several threads (stand-ins for greenlets) and sum the results"""
+    results = [[0, 0] for _ in range(threads)]
+    workers = [threading.Thread(target=target, args=(results[i],)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+def _run_processes(func, args, processes):
+    """Run func in several processes (stand-ins for gunicorn workers)"""
+    start = time.perf_counter()
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.starmap(func, [args] * processes)
+    elapsed = time.perf_counter() - start
+    return sum(r[0] for r in results), sum(r[1] for r in results), elapsed
+
+def _create_mail_db(path, journal_mode):
+    """Create an empty benchmark database"""
+    conn = sqlite3.connect(path)
+    conn.execute(f'PRAGMA journal_mode = {journal_mode}')
+    conn.execute(MAIL_TABLE_SQL)
+    conn.commit()
+    conn.close()
+
+def bench_db_writes(args):
+    """Compare concurrent write throughput before and after the WAL/writer changes"""
+    print_header("DATABASE WRITE CONCURRENCY")
+    print(f"{args.processes} processes x {args.threads} threads x {args.writes} writes\n")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_db = os.path.join(tmp, 'legacy.db')
+        _create_mail_db(legacy_db, 'DELETE')
+        writes, errors, elapsed = _run_processes(
+            _legacy_write_worker, (legacy_db, args.threads, args.writes), args.processes)
+        print_result("before (connect per write)", writes, errors, elapsed)
+
+        for mode in ('rollback', 'wal'):
+            pooled_db = os.path.join(tmp, f'{mode}.db')
+            _create_mail_db(pooled_db, 'DELETE')
+            writes, errors, elapsed = _run_processes(
+                _pooled_write_worker, (pooled_db, args.threads, args.writes, mode), args.processes)
+            print_result(f"after (DB_MODE={mode})", writes, errors, elapsed)
+
+    return 0
+
+# Skill rank lookups
+LEGACY_RANK_QUERIES = [
+    '''
+        SELECT t.tier_name, t.category, t.level
+        FROM user_skills us
+        JOIN skill_types st ON us.skill_type_id = st.id
+        JOIN tiers t ON us.tier_id = t.id
+        WHERE us.user_id = ? AND st.skill_code = ?
+    ''',
+    '''
+        SELECT COUNT(*) as rank_position
+        FROM (
+            SELECT us.user_id,
+                   CASE WHEN t.category = 'HT' THEN t.level + 5 ELSE t.level END as tier_value
+            FROM user_skills us
+            JOIN skill_types st ON us.skill_type_id = st.id
+            JOIN tiers t ON us.tier_id = t.id
+            WHERE st.skill_code = ?
+        ) ranked_users
+        WHERE tier_value >= (
+            SELECT CASE WHEN t.category = 'HT' THEN t.level + 5 ELSE t.level END as tier_value
+            FROM user_skills us
+            JOIN skill_types st ON us.skill_type_id = st.id
+            JOIN tiers t ON us.tier_id = t.id
+            WHERE us.user_id = ? AND st.skill_code = ?
+        )
+    ''',
+    '''
+        SELECT COUNT(*) as total
+        FROM user_skills us
+        JOIN skill_types st ON us.skill_type_id = st.id
+        WHERE st.skill_code = ? AND us.tier_id IS NOT NULL
+    ''',
+]
+
+def _legacy_user_ranks(conn, user_id, skill_codes):
+    """Rank lookups the way /skill-recommendations used to do them: three queries per skill"""
+    for skill_code in skill_codes:
+        conn.execute(LEGACY_RANK_QUERIES[0], (user_id, skill_code)).fetchone()
+        conn.execute(LEGACY_RANK_QUERIES[1], (skill_code, user_id, skill_code)).fetchone()
+        conn.execute(LEGACY_RANK_QUERIES[2], (skill_code,)).fetchone()
+
+def _create_skills_db(path, users):
+    """Create a database with every user ranked in every skill"""
+    conn = sqlite3.connect(path)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')) as f:
+        conn.executescript(f.read())
+    conn.executemany(
+        'INSERT INTO users (id, username, email, password) VALUES (?, ?, ?, ?)',
+        ((i, f'user{i}', f'user{i}@example.com', 'x') for i in range(1, users + 1))
+    )
+    skill_ids = [row[0] for row in conn.execute('SELECT id FROM skill_types')]
+    tier_ids = [row[0] for row in conn.execute('SELECT id FROM tiers')]
+    rng = random.Random(42)
+    conn.executemany(
+        'INSERT INTO user_skills (user_id, skill_type_id, tier_id) VALUES (?, ?, ?)',
+        ((i, skill_id, rng.choice(tier_ids)) for i in range(1, users + 1) for skill_id in skill_ids)
+    )
+    conn.commit()
+    conn.close()
+
+    db_utils.DB_PATH = path
+    TierManager.initialize_tables()
+
+def bench_tier_ranks(args):
+    """Compare per-skill rank lookups against TierManager.get_user_ranks"""
+    print_header("SKILL RANK LOOKUPS")
+    print(f"{args.users} users, {args.lookups} lookups\n")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'ranks.db')
+        start = time.perf_counter()
+        _create_skills_db(db_path, args.users)
+        print(f"dataset built in {time.perf_counter() - start:.1f} s\n")
+
+        rng = random.Random(7)
+        user_ids = [rng.randint(1, args.users) for _ in range(args.lookups)]
+
+        conn = sqlite3.connect(db_path)
+        skill_codes = [row[0] for row in conn.execute('SELECT skill_code FROM skill_types')]
+        statements = []
+        conn.set_trace_callback(statements.append)
+        start = time.perf_counter()
+        for user_id in user_ids:
+            _legacy_user_ranks(conn, user_id, skill_codes)
+        elapsed = time.perf_counter() - start
+        conn.close()
+        print(f"{'before (3 queries per skill)':<28} | {len(statements) // args.lookups:>3} queries/view | "
+              f"{elapsed / args.lookups * 1000:>8.2f} ms/view")
+
+        statements = []
+        with db_utils.connection_scope() as conn:
+            conn.set_trace_callback(statements.append)
+            start = time.perf_counter()
+            for user_id in user_ids:
+                TierManager.get_user_ranks(user_id)
+            elapsed = time.perf_counter() - start
+            conn.set_trace_callback(None)
+        print(f"{'after (get_user_ranks)':<28} | {len(statements) // args.lookups:>3} queries/view | "
+              f"{elapsed / args.lookups * 1000:>8.2f} ms/view")
+
+    return 0
+
+# Team invitations
+def _legacy_send_invitation(sender_id, recipient_id, team_id):
+    """Invite the way send_team_invitation used to: f-strings and a MIMEMultipart per invite"""
+    conn = db_utils.get_db_connection()
+    sender = conn.execute('SELECT username FROM users WHERE id = ?', (sender_id,)).fetchone()
+    recipient = conn.execute('SELECT username, email FROM users WHERE id = ?', (recipient_id,)).fetchone()
+    team = conn.execute('SELECT name, description FROM teams WHERE id = ?', (team_id,)).fetchone()
+
+    subject = f"Team Invitation: {team['name']}"
+    content = f"""
+    Hello {recipient['username']},
+
+    You have been invited to join the team "{team['name']}" by {sender['username']}.
+
+    Team Description:
+    {team['description']}
+
+    To accept or decline this invitation, please check your in-app mail.
+
+    Best regards,
+    The TeamSync Team
+    """
+
+    with db_utils.write_transaction() as conn:
+        conn.execute('''
+            INSERT INTO mail (sender_id, recipient_id, subject, content, mail_type, related_id)
+            VALUES (?, ?, ?, ?, 'team_invite', ?)
+        ''', (sender_id, recipient_id, subject, content, team_id))
+
+    msg = MIMEMultipart()
+    msg['Subject'] = subject
+    msg['From'] = "TeamSync <your_email@gmail.com>"
+    msg['To'] = recipient['email']
+    html = f"""
+    <html>
+    <head>
+        <style>
+            body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
+            .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
+            .header {{ background-color: #0a1128; color: white; padding: 10px 20px; text-align: center; }}
+            .content {{ padding: 20px; background-color: #f9f9f9; }}
+            .footer {{ font-size: 12px; text-align: center; margin-top: 20px; color: #777; }}
+            .button {{ display: inline-block; padding: 10px 20px; background-color: #4a6ac8; color: white;
+                      text-decoration: none; border-radius: 4px; }}
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <div class="header">
+                <h1>TeamSync</h1>
+            </div>
+            <div class="content">
+                <h2>Team Invitation</h2>
+                <p>Hello {recipient['username']},</p>
+                <p>{content}</p>
+                <p>Please log in to your account to accept or decline this invitation.</p>
+                <p><a href="http://yourwebsite.com/login" class="button">Go to TeamSync</a></p>
+            </div>
+            <div class="footer">
+                <p>This is an automated message from TeamSync. Please do not reply to this email.</p>
+            </div>
+        </div>
+    </body>
+    </html>
+    """
+    msg.attach(MIMEText(html, 'html'))
+    msg.as_string()
+
+def _create_invites_db(path, users):
+    """Create a database with a team and users to invite"""
+    conn = sqlite3.connect(path)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')) as f:
+        conn.executescript(f.read())
+    conn.executemany(
+        'INSERT INTO users (id, username, email, password) VALUES (?, ?, ?, ?)',
+        ((i, f'user{i}', f'user{i}@example.com', 'x') for i in range(1, users + 1))
+    )
+    conn.execute("INSERT INTO teams (id, name, description) VALUES (1, 'Benchmark Team', 'A team for benchmarks')")
+    conn.commit()
+    conn.close()
+
+    db_utils.clear_pool()
+    db_utils.DB_PATH = path
+
+def print_invite_result(label, invites, elapsed):
+    """Print one invitation benchmark row"""
+    print(f"{label:<28} | {invites:>6} invites | {elapsed:>6.2f} s | {invites / elapsed:>8.1f} invites/s")
+
+def bench_invites(args):
+    """Compare invitations per second: legacy per-invite path, cached templates, bulk API"""
+    print_header("TEAM INVITATIONS")
+    print(f"{args.invites} invitations, bulk batches of {args.batch}\n")
+
+    recipient_ids = list(range(2, args.invites + 2))
+    with tempfile.TemporaryDirectory() as tmp:
+        _create_invites_db(os.path.join(tmp, 'legacy.db'), args.invites + 1)
+        with db_utils.connection_scope():
+            start = time.perf_counter()
+            for recipient_id in recipient_ids:
+                _legacy_send_invitation(1, recipient_id, 1)
+            print_invite_result("before (f-string + MIME)", args.invites, time.perf_counter() - start)
+
+        _create_invites_db(os.path.join(tmp, 'single.db'), args.invites + 1)
+        with db_utils.connection_scope():
+            start = time.perf_counter()
+            for recipient_id in recipient_ids:
+                email_outbox.send_team_invitations(1, [recipient_id], 1)
+            print_invite_result("after (one per call)", args.invites, time.perf_counter() - start)
+
+        _create_invites_db(os.path.join(tmp, 'bulk.db'), args.invites + 1)
+        with db_utils.connection_scope():
+            start = time.perf_counter()
+            for i in range(0, len(recipient_ids), args.batch):
+                email_outbox.send_team_invitations(1, recipient_ids[i:i + args.batch], 1)
+            print_invite_result(f"after (bulk, {args.batch} per call)", args.invites, time.perf_counter() - start)
+
+        # Building the MIME message now happens in the outbox worker
+        conn = db_utils.get_db_connection()
+        emails = [dict(row) for row in conn.execute('SELECT * FROM email_outbox')]
+        db_utils.close_connection(conn)
+        start = time.perf_counter()
+        for email in emails:
+            email_outbox.build_message(email).as_string()
+        print_invite_result("worker MIME build", len(emails), time.perf_counter() - start)
+        db_utils.clear_pool()
+
+    return 0
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description="Cosmic Teams Performance Benchmarks")
+    subparsers = parser.add_subparsers(dest="command", help="Benchmark to run")
+
+    writes_parser = subparsers.add_parser("db-writes", help="Concurrent write throughput")
+    writes_parser.add_argument("--processes", type=int, default=4, help="Worker processes (default: 4)")
+    writes_parser.add_argument("--threads", type=int, default=4, help="Threads per process (default: 4)")
+    writes_parser.add_argument("--writes", type=int, default=200, help="Writes per thread (default: 200)")
+
+    ranks_parser = subparsers.add_parser("tier-ranks", help="Skill rank lookups for /skill-recommendations")
+    ranks_parser.add_argument("--users", type=int, default=100000, help="Synthetic users (default: 100000)")
+    ranks_parser.add_argument("--lookups", type=int, default=20, help="Rank lookups to time (default: 20)")
+
+    invites_parser = subparsers.add_parser("invites", help="Team invitations per second")
+    invites_parser.add_argument("--invites", type=int, default=2000, help="Invitations to send (default: 2000)")
+    invites_parser.add_argument("--batch", type=int, default=50, help="Recipients per bulk call (default: 50)")
+
+    args = parser.parse_args()
+
+    if args.command == "db-writes":
+        return bench_db_writes(args)
+    elif args.command == "tier-ranks":
+        return bench_tier_ranks(args)
+    elif args.command == "invites":
+        return bench_invites(args)
+    else:
+        parser.print_help()
+        return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,6 +9,19 @@ from datetime import datetime
 import schedule
 import threading
 import hashlib
+import socket
+import atexit
+import zlib
+import gzip
+import lzma
+import re
+import subprocess
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import db_utils
+import mail_retention
 
 # Get the application root directory
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -47,6 +60,81 @@ MAX_DAILY_BACKUPS = 7     # Keep last 7 daily backups
 MAX_WEEKLY_BACKUPS = 4    # Keep last 4 weekly backups
 MAX_MONTHLY_BACKUPS = 12  # Keep last 12 monthly backups
 
+# Online backup settings - the live database is copied with the SQLite backup
+# API a few pages at a time so writers are only blocked between steps
+BACKUP_PAGES_PER_STEP = 256    # Pages copied per step (1 MB with 4 KB pages)
+BACKUP_STEP_SLEEP = 0.01       # Seconds to pause between steps
+BACKUP_MAX_RESTARTS = 3        # Restarts (source changed mid-copy) before copying in one step
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Backup job priority - backups read at most BACKUP_RATE_LIMIT bytes/sec (0 for
+# no limit) and run on their own thread with lowered CPU and I/O priority
+BACKUP_RATE_LIMIT = int(os.environ.get('BACKUP_RATE_LIMIT', 50 * 1024 * 1024))
+BACKUP_NICE = int(os.environ.get('BACKUP_NICE', 10))                    # Added to the thread's nice value
+BACKUP_IONICE = os.environ.get('BACKUP_IONICE', 'best-effort')          # 'best-effort', 'idle' or '' for off
+IONICE_ARGS = {'best-effort': ['-c', '2', '-n', '7'], 'idle': ['-c', '3']}
+
+# SQL dump settings
+DUMP_FETCH_SIZE = 500          # Rows fetched per round trip while dumping a table
+DUMP_CHUNK_SIZE = 64 * 1024    # Bytes of SQL text buffered before each yield
+RESTORE_BATCH_SIZE = 500       # Rows per executemany when replaying INSERT runs
+
+# Literal INSERT statements as written by iter_sql_dump (and older dumps)
+INSERT_STATEMENT_RE = re.compile(r'^INSERT INTO\s+("(?:[^"]|"")+"|\w+)\s+VALUES\s*\((.*)\)\s*;$', re.S | re.I)
+SQL_VALUE_RE = re.compile(r"""\s*(?:(NULL)|'((?:[^']|'')*)'|[xX]'([0-9A-Fa-f]*)'|([-+]?[0-9][0-9.eE+-]*))\s*(,|$)""")
+TRANSACTION_STATEMENT_RE = re.compile(r'^(BEGIN|COMMIT|END)\b', re.I)
+# Statement splitting: quote and comment openers (and what closes them), and semicolons
+SQL_TOKEN_RE = re.compile(r"""[;'"`\[]|--|/\*""")
+SQL_TOKEN_CLOSERS = {"'": "'", '"': '"', '`': '`', '[': ']', '--': '\n', '/*': '*/'}
+
+# Restores - the new database is built next to the live one, validated, and
+# copied in while every worker holds new requests
+RESTORE_SUFFIX = '.restore'
+RESTORE_DRAIN_GRACE = 0.5   # Seconds for requests already running to finish
+REQUIRED_TABLES = ('users', 'teams')
+
+# Compression codecs - 'deflate' (gzip), 'lzma' (xz) or 'deflate-parallel', which
+# deflates 1 MB blocks on a thread pool as independent gzip members
+BACKUP_CODEC = os.environ.get('BACKUP_CODEC', 'deflate-parallel')
+BACKUP_CODEC_THREADS = int(os.environ.get('BACKUP_CODEC_THREADS', min(4, os.cpu_count() or 1)))
+BACKUP_COMPRESS_LEVEL = 6
+PARALLEL_BLOCK_SIZE = 1024 * 1024
+CODECS = ('deflate', 'lzma', 'deflate-parallel')
+CODEC_EXTENSIONS = {'deflate': '.gz', 'lzma': '.xz', 'deflate-parallel': '.gz'}
+
+# Incremental backups - the database is split into fixed-size chunks stored once
+# by content hash, and each backup is a manifest listing its chunks
+BACKUP_FORMAT = os.environ.get('BACKUP_FORMAT', 'incremental')  # 'incremental' or 'zip'
+CHUNK_STORE_DIR = os.path.join(BACKUP_DIR, 'chunks')
+CHUNK_SIZE = 64 * 1024         # 16 pages of 4 KB - small enough that a day's edits touch few chunks
+CHUNK_GC_GRACE = 3600          # Never collect chunks touched within the last hour
+MANIFEST_SUFFIX = '.manifest.json'
+
+# Backup catalog - one row per backup so listing doesn't open every archive
+CATALOG_DB_PATH = os.path.join(BACKUP_DIR, 'catalog.db')
+
+# Backup verification - runs on the scheduler leader, reading at most
+# BACKUP_VERIFY_RATE bytes/sec so it doesn't compete with live traffic
+BACKUP_VERIFY_RATE = int(os.environ.get('BACKUP_VERIFY_RATE', 10 * 1024 * 1024))
+BACKUP_VERIFY_CHECK = os.environ.get('BACKUP_VERIFY_CHECK', 'integrity_check')  # or 'quick_check'
+VERIFY_INTERVAL_MINUTES = 15
+
+# WAL archiving - optional point-in-time recovery. Each timeline is a base
+# snapshot plus the WAL frames shipped every BACKUP_WAL_INTERVAL seconds
+WAL_ARCHIVE_ENABLED = os.environ.get('BACKUP_WAL_ARCHIVE') == '1'
+WAL_ARCHIVE_DIR = os.path.join(BACKUP_DIR, 'wal')
+WAL_ARCHIVE_INTERVAL = int(os.environ.get('BACKUP_WAL_INTERVAL', 60))
+WAL_BASE_INTERVAL = 24 * 3600   # Start a new timeline (fresh base) daily
+WAL_RETENTION_DAYS = int(os.environ.get('BACKUP_WAL_RETENTION_DAYS', 7))
+WAL_HEADER_SIZE = 32
+WAL_FRAME_HEADER_SIZE = 24
+
+# Scheduler leadership - only the process holding the lease runs scheduled jobs
+SCHEDULER_DB_PATH = os.path.join(BACKUP_DIR, 'scheduler.db')
+SCHEDULER_LEASE_NAME = 'backup_scheduler'
+SCHEDULER_HEARTBEAT = 30    # Seconds between heartbeats / takeover attempts
+SCHEDULER_LEASE_TTL = 120   # A leader silent for this long can be replaced
+
 # Ensure backup directories exist
 if not os.path.exists(BACKUP_DIR):
     os.makedirs(BACKUP_DIR)
@@ -63,14 +151,264 @@ def calculate_file_hash(file_path):
             sha256_hash.update(byte_block)
     return sha256_hash.hexdigest()
 
+class _BackupRestarted(Exception):
+    """Raised from the backup progress callback to abandon a batched copy"""
+
+def snapshot_database(dest_path, source_path=None, limiter=None):
+    """Copy a consistent snapshot of the live database to dest_path using the SQLite backup API"""
+    source_path = source_path or DB_PATH
+    source = sqlite3.connect(source_path, timeout=30)
+    dest = sqlite3.connect(dest_path)
+    
+    try:
+        page_size = source.execute('PRAGMA page_size').fetchone()[0]
+        state = {"remaining": None, "restarts": 0}
+        
+        def progress(status, remaining, total):
+            # If another connection writes to the source, SQLite starts the
+            # copy over; under constant writes that could go on forever
+            if state["remaining"] is not None and remaining > state["remaining"]:
+                state["restarts"] += 1
+                if state["restarts"] > BACKUP_MAX_RESTARTS:
+                    raise _BackupRestarted()
+            copied = (total if state["remaining"] is None else state["remaining"]) - remaining
+            state["remaining"] = remaining
+            if limiter:
+                limiter.consume(max(copied, 0) * page_size)
+            if remaining and BACKUP_STEP_SLEEP:
+                time.sleep(BACKUP_STEP_SLEEP)
+        
+        try:
+            source.backup(dest, pages=BACKUP_PAGES_PER_STEP, progress=progress)
+        except _BackupRestarted:
+            logger.info("Database kept changing during batched backup, copying in one step")
+            source.backup(dest, pages=-1)
+    finally:
+        dest.close()
+        source.close()
+
+def _lower_thread_priority():
+    """Lower the calling OS thread's CPU and I/O priority (Linux; best effort)"""
+    tid = threading.get_native_id()
+    if BACKUP_NICE:
+        try:
+            # On Linux a thread id here affects just that thread
+            os.setpriority(os.PRIO_PROCESS, tid, min(19, os.getpriority(os.PRIO_PROCESS, tid) + BACKUP_NICE))
+        except (AttributeError, OSError) as e:
+            logger.debug(f"Could not lower backup thread CPU priority: {str(e)}")
+    
+    ionice = shutil.which('ionice') if BACKUP_IONICE in IONICE_ARGS else None
+    if ionice:
+        subprocess.run([ionice, *IONICE_ARGS[BACKUP_IONICE], '-p', str(tid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+def _run_low_priority(func, *args):
+    """Run func on a fresh OS thread with lowered priority and return its result
+
+    The thread ends with the job, so the lowered priority never leaks into
+    request handling (under gevent, the hub's thread is left alone too).
+    """
+    if not BACKUP_NICE and BACKUP_IONICE not in IONICE_ARGS:
+        return func(*args)
+    
+    def run():
+        _lower_thread_priority()
+        return func(*args)
+    
+    executor = _codec_executor(1)
+    try:
+        return executor.submit(run).result()
+    finally:
+        executor.shutdown(wait=True)
+
+@contextmanager
+def _timed(timings, phase):
+    """Add the time spent in the block to timings[phase]"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0) + time.perf_counter() - started
+
+def _log_timings(label, timings, limiter):
+    """Log how long each phase of a backup job took"""
+    phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items())
+    logger.info(f"Backup timings ({label}): {phases} (including {limiter.throttled:.2f}s throttled)")
+
+def _codec_executor(threads):
+    """Thread pool for compression; real OS threads even when gevent has patched threading"""
+    try:
+        import gevent.monkey
+        if gevent.monkey.is_module_patched('threading'):
+            import gevent.threadpool
+            return gevent.threadpool.ThreadPoolExecutor(max_workers=threads)
+    except ImportError:
+        pass
+    return ThreadPoolExecutor(max_workers=threads)
+
+def _gzip_member(data, level):
+    """Compress one block as a complete gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+def compress_stream(src, dst, codec=None, limiter=None, timings=None):
+    """Compress src into dst with a backup codec, hashing the raw data in the same pass
+
+    Reads are paced by limiter if given, and seconds spent hashing and
+    compressing are added to the timings dict if given. Returns (sha256 hex
+    digest, raw bytes, compressed bytes).
+    """
+    codec = codec or BACKUP_CODEC
+    timings = {} if timings is None else timings
+    sha256_hash = hashlib.sha256()
+    sizes = {"raw": 0, "compressed": 0}
+    started = time.perf_counter()
+    hash_before = timings.get("hash", 0)
+    
+    def blocks(size):
+        for block in iter(lambda: src.read(size), b""):
+            if limiter:
+                limiter.consume(len(block))
+            hash_started = time.perf_counter()
+            sha256_hash.update(block)
+            timings["hash"] = timings.get("hash", 0) + time.perf_counter() - hash_started
+            sizes["raw"] += len(block)
+            yield block
+    
+    def write(data):
+        dst.write(data)
+        sizes["compressed"] += len(data)
+    
+    if codec == 'deflate-parallel':
+        # zlib releases the GIL, so blocks compress concurrently; results are
+        # written in order and only a few blocks are kept in flight
+        executor = _codec_executor(BACKUP_CODEC_THREADS)
+        pending = deque()
+        try:
+            for block in blocks(PARALLEL_BLOCK_SIZE):
+                pending.append(executor.submit(_gzip_member, block, BACKUP_COMPRESS_LEVEL))
+                if len(pending) >= BACKUP_CODEC_THREADS * 2:
+                    write(pending.popleft().result())
+            while pending:
+                write(pending.popleft().result())
+        finally:
+            executor.shutdown(wait=True)
+    else:
+        if codec == 'deflate':
+            compressor = zlib.compressobj(BACKUP_COMPRESS_LEVEL, zlib.DEFLATED, 31)
+        elif codec == 'lzma':
+            compressor = lzma.LZMACompressor(preset=BACKUP_COMPRESS_LEVEL)
+        else:
+            raise ValueError(f"Unknown backup codec: {codec}")
+        for block in blocks(STREAM_CHUNK_SIZE):
+            write(compressor.compress(block))
+        write(compressor.flush())
+    
+    # Whatever wasn't hashing was reading, compressing and writing
+    elapsed = time.perf_counter() - started - (timings.get("hash", 0) - hash_before)
+    timings["compress"] = timings.get("compress", 0) + elapsed
+    return sha256_hash.hexdigest(), sizes["raw"], sizes["compressed"]
+
+def decompress_stream(src, dst, codec):
+    """Decompress a codec stream from src into dst"""
+    if codec in ('deflate', 'deflate-parallel'):
+        reader = gzip.GzipFile(fileobj=src, mode='rb')  # Reads every gzip member
+    elif codec == 'lzma':
+        reader = lzma.LZMAFile(src, mode='rb')
+    else:
+        raise ValueError(f"Unknown backup codec: {codec}")
+    with reader:
+        shutil.copyfileobj(reader, dst, STREAM_CHUNK_SIZE)
+
+def compress_chunk(data, codec=None):
+    """Compress one chunk for the chunk store"""
+    if (codec or BACKUP_CODEC) == 'lzma':
+        return lzma.compress(data, preset=BACKUP_COMPRESS_LEVEL)
+    return zlib.compress(data, BACKUP_COMPRESS_LEVEL)
+
+def decompress_chunk(data):
+    """Decompress a stored chunk, whichever codec wrote it"""
+    if data.startswith(b"\xfd7zXZ\x00"):
+        return lzma.decompress(data)
+    return zlib.decompress(data)
+
+def benchmark_codecs(codecs=CODECS):
+    """Compress a snapshot of the live database with each codec and time it"""
+    temp_db_path = os.path.join(BACKUP_DIR, f"temp_benchmark_{int(time.time())}.db")
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    snapshot_database(temp_db_path)
+    
+    results = []
+    try:
+        for codec in codecs:
+            with open(temp_db_path, 'rb') as src, open(os.devnull, 'wb') as dst:
+                start = time.perf_counter()
+                _, raw_size, compressed_size = compress_stream(src, dst, codec)
+                elapsed = time.perf_counter() - start
+            results.append({
+                "codec": codec,
+                "seconds": elapsed,
+                "raw_size": raw_size,
+                "compressed_size": compressed_size
+            })
+    finally:
+        os.remove(temp_db_path)
+    return results
+
+def _zip_file_with_codec(zipf, file_path, arcname, codec, limiter=None, timings=None):
+    """Compress a file with the backup codec into a stored archive member, hashing it in the same pass"""
+    info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_STORED  # Already compressed by the codec
+    with open(file_path, "rb") as src, zipf.open(info, "w", force_zip64=True) as dst:
+        return compress_stream(src, dst, codec, limiter, timings)
+
+def _collect_schema(db_path):
+    """Describe each table's columns and row count for the backup metadata"""
+    schema_data = {}
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    # Get all tables
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    tables = cursor.fetchall()
+    
+    for table in tables:
+        table_name = table[0]
+        if table_name.startswith('sqlite_'):
+            continue  # Skip sqlite internal tables
+            
+        # Get table schema
+        cursor.execute(f"PRAGMA table_info({table_name})")
+        columns = cursor.fetchall()
+        
+        # Get row count
+        cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
+        row_count = cursor.fetchone()[0]
+        
+        schema_data[table_name] = {
+            "columns": [{"name": col[1], "type": col[2]} for col in columns],
+            "row_count": row_count
+        }
+    
+    conn.close()
+    return schema_data
+
 def create_backup(backup_type='manual', with_schema=True):
     """Create a database backup with metadata and validation"""
+    # Runs at low priority so live requests keep the CPU and disk
+    return _run_low_priority(_create_backup, backup_type, with_schema)
+
+def _create_backup(backup_type, with_schema):
+    """Create a database backup on the current thread"""
     try:
         # Ensure source database exists
         if not os.path.exists(DB_PATH):
             logger.error(f"Database file {DB_PATH} does not exist")
             return False, "Database file not found"
         
+        if BACKUP_FORMAT == 'incremental':
+            return create_incremental_backup(backup_type, with_schema)
+        
         # Determine target directory and filename
         now = datetime.now()
         timestamp = now.strftime("%Y%m%d_%H%M%S")
@@ -82,63 +420,37 @@ def create_backup(backup_type='manual', with_schema=True):
         backup_filename = f"{backup_type}_backup_{timestamp}.zip"
         backup_path = os.path.join(backup_subdir, backup_filename)
         
-        # Create a temporary copy of the database to back up
+        # Take a consistent snapshot of the live database to back up
+        limiter = _RateLimiter(BACKUP_RATE_LIMIT)
+        timings = {}
         temp_db_path = os.path.join(BACKUP_DIR, f"temp_{timestamp}.db")
-        shutil.copy2(DB_PATH, temp_db_path)
+        with _timed(timings, "copy"):
+            snapshot_database(temp_db_path, limiter=limiter)
         
         # Create metadata
         metadata = {
             "backup_type": backup_type,
             "timestamp": timestamp,
             "created_at": now.strftime("%Y-%m-%d %H:%M:%S"),
-            "database_size": os.path.getsize(DB_PATH),
-            "backup_hash": calculate_file_hash(temp_db_path)
+            "database_size": os.path.getsize(temp_db_path)
         }
         
         # Add schema information if requested
         if with_schema:
-            schema_data = {}
-            conn = sqlite3.connect(temp_db_path)
-            cursor = conn.cursor()
-            
-            # Get all tables
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            tables = cursor.fetchall()
-            
-            for table in tables:
-                table_name = table[0]
-                if table_name.startswith('sqlite_'):
-                    continue  # Skip sqlite internal tables
-                    
-                # Get table schema
-                cursor.execute(f"PRAGMA table_info({table_name})")
-                columns = cursor.fetchall()
-                
-                # Get row count
-                cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
-                row_count = cursor.fetchone()[0]
-                
-                schema_data[table_name] = {
-                    "columns": [{"name": col[1], "type": col[2]} for col in columns],
-                    "row_count": row_count
-                }
-            
-            conn.close()
-            metadata["schema"] = schema_data
+            with _timed(timings, "schema"):
+                metadata["schema"] = _collect_schema(temp_db_path)
         
-        # Create a zip file containing the database and metadata
+        # Create a zip file containing the database and metadata; the database
+        # is hashed while it is compressed so the snapshot is read only once
+        codec = BACKUP_CODEC
         with zipfile.ZipFile(backup_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            # Add the database file
-            zipf.write(temp_db_path, os.path.basename(DB_PATH))
-            
-            # Add metadata file
-            metadata_path = os.path.join(BACKUP_DIR, f"metadata_{timestamp}.json")
-            with open(metadata_path, 'w') as f:
-                json.dump(metadata, f, indent=4)
-            zipf.write(metadata_path, "backup_metadata.json")
-            
-            # Clean up temp files
-            os.remove(metadata_path)
+            arcname = os.path.basename(DB_PATH) + CODEC_EXTENSIONS[codec]
+            backup_hash, raw_size, compressed_size = _zip_file_with_codec(
+                zipf, temp_db_path, arcname, codec, limiter, timings)
+            metadata["backup_hash"] = backup_hash
+            metadata["codec"] = codec
+            metadata["compression_ratio"] = round(raw_size / compressed_size, 2) if compressed_size else None
+            zipf.writestr("backup_metadata.json", json.dumps(metadata, indent=4))
         
         # Cleanup
         os.remove(temp_db_path)
@@ -147,6 +459,8 @@ def create_backup(backup_type='manual', with_schema=True):
         if os.path.exists(backup_path):
             backup_size = os.path.getsize(backup_path)
             logger.info(f"Backup created successfully: {backup_path} ({backup_size} bytes)")
+            _log_timings(f"{backup_type} zip", timings, limiter)
+            catalog_add(backup_path, backup_type, 'zip', metadata, backup_size)
             
             # Rotate old backups
             rotate_backups(backup_type)
@@ -160,13 +474,430 @@ def create_backup(backup_type='manual', with_schema=True):
         logger.error(f"Backup failed: {str(e)}")
         return False, str(e)
 
+def _chunk_path(chunk_hash):
+    """Location of a chunk in the content-addressed store (fanned out by hash prefix)"""
+    return os.path.join(CHUNK_STORE_DIR, chunk_hash[:2], chunk_hash)
+
+def _chunk_stored(chunk_hash):
+    """Check whether the store has a chunk, marking it in use so a concurrent garbage collection keeps it"""
+    path = _chunk_path(chunk_hash)
+    if os.path.exists(path):
+        os.utime(path)
+        return True
+    return False
+
+def _write_chunk(chunk_hash, compressed):
+    """Atomically write a compressed chunk into the store; returns the bytes written"""
+    path = _chunk_path(chunk_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(compressed)
+    os.replace(temp_path, path)
+    return len(compressed)
+
+def _read_chunk(chunk_hash):
+    """Read and verify a chunk from the store"""
+    with open(_chunk_path(chunk_hash), 'rb') as f:
+        data = decompress_chunk(f.read())
+    if hashlib.sha256(data).hexdigest() != chunk_hash:
+        raise ValueError(f"Chunk {chunk_hash} is corrupted")
+    return data
+
+def create_incremental_backup(backup_type='manual', with_schema=True):
+    """Create a backup that stores only the chunks not already in the chunk store"""
+    now = datetime.now()
+    timestamp = now.strftime("%Y%m%d_%H%M%S")
+    
+    backup_subdir = os.path.join(BACKUP_DIR, backup_type)
+    os.makedirs(backup_subdir, exist_ok=True)
+    manifest_path = os.path.join(backup_subdir, f"{backup_type}_backup_{timestamp}{MANIFEST_SUFFIX}")
+    
+    # Take a consistent snapshot of the live database to back up
+    limiter = _RateLimiter(BACKUP_RATE_LIMIT)
+    timings = {}
+    temp_db_path = os.path.join(BACKUP_DIR, f"temp_{timestamp}.db")
+    with _timed(timings, "copy"):
+        snapshot_database(temp_db_path, limiter=limiter)
+    
+    codec = BACKUP_CODEC
+    threads = BACKUP_CODEC_THREADS if codec == 'deflate-parallel' else 1
+    executor = _codec_executor(threads)
+    try:
+        # Hash the snapshot chunk by chunk, compressing and writing only the
+        # chunks the store lacks (on the thread pool for deflate-parallel)
+        file_hash = hashlib.sha256()
+        chunks = []
+        stored_bytes = 0
+        new_bytes = 0
+        new_chunks = 0
+        pending = deque()
+        queued = set()
+        
+        def write_next():
+            chunk_hash, future = pending.popleft()
+            queued.discard(chunk_hash)
+            with _timed(timings, "compress"):
+                return _write_chunk(chunk_hash, future.result())
+        
+        with open(temp_db_path, 'rb') as f:
+            for data in iter(lambda: f.read(CHUNK_SIZE), b""):
+                with _timed(timings, "hash"):
+                    limiter.consume(len(data))
+                    file_hash.update(data)
+                    chunk_hash = hashlib.sha256(data).hexdigest()
+                chunks.append(chunk_hash)
+                if chunk_hash in queued or _chunk_stored(chunk_hash):
+                    continue
+                new_chunks += 1
+                new_bytes += len(data)
+                queued.add(chunk_hash)
+                pending.append((chunk_hash, executor.submit(compress_chunk, data, codec)))
+                if len(pending) >= threads * 4:
+                    stored_bytes += write_next()
+            while pending:
+                stored_bytes += write_next()
+        
+        manifest = {
+            "format": "incremental",
+            "backup_type": backup_type,
+            "timestamp": timestamp,
+            "created_at": now.strftime("%Y-%m-%d %H:%M:%S"),
+            "database_size": os.path.getsize(temp_db_path),
+            "backup_hash": file_hash.hexdigest(),
+            "chunk_size": CHUNK_SIZE,
+            "codec": codec,
+            "compression_ratio": round(new_bytes / stored_bytes, 2) if stored_bytes else None,
+            "new_chunks": new_chunks,
+            "stored_bytes": stored_bytes,
+            "chunks": chunks
+        }
+        if with_schema:
+            with _timed(timings, "schema"):
+                manifest["schema"] = _collect_schema(temp_db_path)
+    finally:
+        executor.shutdown(wait=True)
+        os.remove(temp_db_path)
+    
+    # Write the manifest last so a half-finished backup is never listed
+    temp_manifest = manifest_path + ".tmp"
+    with open(temp_manifest, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_manifest, manifest_path)
+    
+    logger.info(f"Incremental backup created: {manifest_path} "
+                f"({new_chunks}/{len(chunks)} new chunks, {stored_bytes} bytes stored)")
+    _log_timings(f"{backup_type} incremental", timings, limiter)
+    catalog_add(manifest_path, backup_type, 'incremental', manifest, stored_bytes)
+    
+    rotate_backups(backup_type)
+    return True, manifest_path
+
+def read_manifest(manifest_path):
+    """Load an incremental backup manifest"""
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def rebuild_from_manifest(manifest_path, dest_path, limiter=None):
+    """Reassemble the database file described by a manifest and verify its hash"""
+    manifest = read_manifest(manifest_path)
+    
+    try:
+        with open(dest_path, 'wb') as f:
+            dst = _HashingWriter(f, limiter)
+            for chunk_hash in manifest["chunks"]:
+                dst.write(_read_chunk(chunk_hash))
+        
+        if dst.hash.hexdigest() != manifest["backup_hash"]:
+            raise ValueError("Rebuilt database does not match the backup hash")
+    except Exception:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+    return manifest
+
+def collect_chunk_garbage():
+    """Delete chunks no remaining manifest refers to; returns the number removed"""
+    referenced = set()
+    for backup_type in os.listdir(BACKUP_DIR):
+        backup_subdir = os.path.join(BACKUP_DIR, backup_type)
+        if not os.path.isdir(backup_subdir) or backup_subdir == CHUNK_STORE_DIR:
+            continue
+        for filename in os.listdir(backup_subdir):
+            if filename.endswith(MANIFEST_SUFFIX):
+                referenced.update(read_manifest(os.path.join(backup_subdir, filename))["chunks"])
+    
+    removed = 0
+    cutoff = time.time() - CHUNK_GC_GRACE
+    if not os.path.isdir(CHUNK_STORE_DIR):
+        return removed
+    for prefix in os.listdir(CHUNK_STORE_DIR):
+        prefix_dir = os.path.join(CHUNK_STORE_DIR, prefix)
+        for chunk_hash in os.listdir(prefix_dir):
+            path = os.path.join(prefix_dir, chunk_hash)
+            # Recent chunks may belong to a backup whose manifest isn't written yet
+            if chunk_hash not in referenced and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+    
+    if removed:
+        logger.info(f"Removed {removed} unreferenced chunks")
+    return removed
+
+def iter_sql_dump(conn):
+    """Yield the database as SQL statements, like Connection.iterdump but fetching rows in batches"""
+    cursor = conn.cursor()
+    
+    yield 'BEGIN TRANSACTION;'
+    
+    cursor.execute('''
+        SELECT name, sql FROM sqlite_master
+        WHERE sql NOT NULL AND type = 'table'
+        ORDER BY name
+    ''')
+    tables = cursor.fetchall()
+    has_sequence = False
+    
+    for table_name, sql in tables:
+        if table_name == 'sqlite_sequence':
+            # Recreated automatically by AUTOINCREMENT tables; refilled at the end
+            has_sequence = True
+            yield 'DELETE FROM "sqlite_sequence";'
+            continue
+        elif table_name == 'sqlite_stat1':
+            yield 'ANALYZE "sqlite_master";'
+            continue
+        elif table_name.startswith('sqlite_'):
+            continue
+        
+        yield f"{sql};"
+        
+        # Let SQLite quote the values so every type (blobs, reals, text) round-trips
+        quoted_name = table_name.replace('"', '""')
+        cursor.execute(f'PRAGMA table_info("{quoted_name}")')
+        columns = [col[1].replace('"', '""') for col in cursor.fetchall()]
+        values = ",".join(f"'||quote(\"{col}\")||'" for col in columns)
+        cursor.execute(f'''SELECT 'INSERT INTO "{quoted_name}" VALUES({values})' FROM "{quoted_name}"''')
+        
+        while True:
+            rows = cursor.fetchmany(DUMP_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield f"{row[0]};"
+    
+    # Indexes, triggers and views go after the data so inserts stay fast
+    cursor.execute('''
+        SELECT sql FROM sqlite_master
+        WHERE sql NOT NULL AND type IN ('index', 'trigger', 'view')
+        ORDER BY CASE type WHEN 'view' THEN 1 ELSE 0 END, name
+    ''')
+    for (sql,) in cursor.fetchall():
+        yield f"{sql};"
+    
+    if has_sequence:
+        cursor.execute('SELECT name, seq FROM sqlite_sequence')
+        for name, seq in cursor.fetchall():
+            quoted = name.replace("'", "''")
+            yield f"INSERT INTO \"sqlite_sequence\" VALUES('{quoted}',{seq});"
+    
+    yield 'COMMIT;'
+
+def iter_dump_chunks(db_path=None, compress=False):
+    """Stream a SQL dump of the database as byte chunks, optionally gzip-compressed on the fly"""
+    conn = sqlite3.connect(db_path or DB_PATH, timeout=30)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits 31 = gzip
+    
+    try:
+        # One read transaction so the dump is a consistent snapshot
+        conn.execute('BEGIN')
+        
+        buffer = []
+        buffered = 0
+        for statement in iter_sql_dump(conn):
+            buffer.append(statement)
+            buffered += len(statement) + 1
+            if buffered >= DUMP_CHUNK_SIZE:
+                data = ("\n".join(buffer) + "\n").encode('utf-8')
+                buffer, buffered = [], 0
+                data = compressor.compress(data) if compressor else data
+                if data:
+                    yield data
+        
+        data = ("\n".join(buffer) + "\n").encode('utf-8') if buffer else b""
+        if compressor:
+            data = compressor.compress(data) + compressor.flush()
+        if data:
+            yield data
+    finally:
+        conn.close()
+
+def iter_sql_statements(lines):
+    """Split a stream of SQL text lines into complete statements in a single linear pass
+
+    Quotes and comments are tracked while scanning, so a semicolon inside a
+    string literal is skipped without re-checking the statement. Only a
+    semicolon outside them can end a statement; sqlite3.complete_statement
+    confirms it (it can still be inside a trigger body).
+    """
+    pending = []
+    closer = None  # What ends the quote or comment being scanned, if any
+    for line in lines:
+        start = pos = 0
+        while True:
+            if closer:
+                end = line.find(closer, pos)
+                if end == -1:
+                    break
+                pos = end + len(closer)
+                closer = None
+                continue
+            
+            match = SQL_TOKEN_RE.search(line, pos)
+            if not match:
+                break
+            pos = match.end()
+            if match.group() != ';':
+                closer = SQL_TOKEN_CLOSERS[match.group()]
+                continue
+            
+            pending.append(line[start:pos])
+            start = pos
+            statement = "".join(pending)
+            if sqlite3.complete_statement(statement):
+                pending = []
+                statement = statement.strip()
+                if statement != ';':
+                    yield statement
+        pending.append(line[start:])
+    
+    statement = "".join(pending).strip()
+    if statement:
+        yield statement
+
+def _parse_insert(statement):
+    """Split a literal INSERT into (table, values) so runs of them can go through executemany"""
+    match = INSERT_STATEMENT_RE.match(statement)
+    if not match:
+        return None
+    
+    body = match.group(2)
+    values = []
+    pos = 0
+    for value in SQL_VALUE_RE.finditer(body):
+        # Values must follow each other with nothing unparsed in between
+        if value.start() != pos:
+            return None
+        null, text, blob, number, _ = value.groups()
+        if null:
+            values.append(None)
+        elif text is not None:
+            values.append(text.replace("''", "'"))
+        elif blob is not None:
+            values.append(bytes.fromhex(blob))
+        else:
+            try:
+                integer = int(number)
+                # SQLite reads integer literals beyond 64 bits as REAL
+                values.append(integer if -2**63 <= integer < 2**63 else float(integer))
+            except ValueError:
+                try:
+                    values.append(float(number))
+                except ValueError:
+                    return None
+        pos = value.end()
+    
+    if pos != len(body):
+        return None
+    return match.group(1), tuple(values)
+
+def restore_sql_dump(sql_path, db_path=None):
+    """Replay a .sql (or .sql.gz) dump into the database in one transaction
+
+    Consecutive INSERTs into the same table are batched through executemany.
+    As before, statements that fail are logged and skipped. Returns
+    (statements_executed, statements_failed).
+    """
+    conn = sqlite3.connect(db_path or DB_PATH, timeout=30, isolation_level=None)
+    cursor = conn.cursor()
+    executed = 0
+    failed = 0
+    batch_table = None
+    batch = []
+    
+    def run(statement):
+        nonlocal executed, failed
+        try:
+            cursor.execute(statement)
+            executed += 1
+        except sqlite3.Error as e:
+            failed += 1
+            logger.error(f"Error executing SQL statement: {e}: {statement[:200]}")
+    
+    def flush():
+        nonlocal executed, failed, batch
+        if not batch:
+            return
+        placeholders = ", ".join("?" * len(batch[0]))
+        sql = f"INSERT INTO {batch_table} VALUES ({placeholders})"
+        cursor.execute("SAVEPOINT restore_batch")
+        try:
+            cursor.executemany(sql, batch)
+            cursor.execute("RELEASE restore_batch")
+            executed += len(batch)
+        except sqlite3.Error:
+            # Replay the batch row by row so only the bad rows are skipped
+            cursor.execute("ROLLBACK TO restore_batch")
+            cursor.execute("RELEASE restore_batch")
+            for row in batch:
+                try:
+                    cursor.execute(sql, row)
+                    executed += 1
+                except sqlite3.Error as e:
+                    failed += 1
+                    logger.error(f"Error restoring row into {batch_table}: {e}")
+        batch = []
+    
+    opener = gzip.open if sql_path.endswith('.gz') else open
+    try:
+        cursor.execute("BEGIN")
+        with opener(sql_path, 'rt', encoding='utf-8') as f:
+            for statement in iter_sql_statements(f):
+                # The dump's own BEGIN/COMMIT would end our transaction early
+                if TRANSACTION_STATEMENT_RE.match(statement):
+                    continue
+                
+                insert = _parse_insert(statement)
+                if insert:
+                    table, values = insert
+                    if batch and (table != batch_table or len(values) != len(batch[0])):
+                        flush()
+                    batch_table = table
+                    batch.append(values)
+                    if len(batch) >= RESTORE_BATCH_SIZE:
+                        flush()
+                else:
+                    flush()
+                    run(statement)
+        
+        flush()
+        cursor.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    return executed, failed
+
 def rotate_backups(backup_type):
     """Remove old backups to save space"""
     if backup_type == 'manual':
         return  # Don't rotate manual backups
         
     backup_subdir = os.path.join(BACKUP_DIR, backup_type)
-    backups = [f for f in os.listdir(backup_subdir) if f.endswith('.zip')]
+    backups = [f for f in os.listdir(backup_subdir) if f.endswith('.zip') or f.endswith(MANIFEST_SUFFIX)]
     backups.sort(reverse=True)  # Newest first
     
     max_backups = {
@@ -176,13 +907,166 @@ def rotate_backups(backup_type):
     }.get(backup_type, 5)
     
     # Remove excess backups
+    removed_manifest = False
     if len(backups) > max_backups:
         for old_backup in backups[max_backups:]:
             try:
                 os.remove(os.path.join(backup_subdir, old_backup))
+                catalog_remove(os.path.join(backup_subdir, old_backup))
+                removed_manifest = removed_manifest or old_backup.endswith(MANIFEST_SUFFIX)
                 logger.info(f"Removed old backup: {old_backup}")
             except Exception as e:
                 logger.error(f"Failed to remove old backup {old_backup}: {str(e)}")
+    
+    # Chunks only shared with the removed manifests can go too
+    if removed_manifest:
+        try:
+            collect_chunk_garbage()
+        except Exception as e:
+            logger.error(f"Chunk garbage collection failed: {str(e)}")
+
+class _RateLimiter:
+    """Sleep as needed to keep a stream of bytes under a bytes-per-second cap
+
+    Every call yields at least briefly, so long copy loops stay cooperative
+    with other threads and greenlets even without a cap.
+    """
+    def __init__(self, bytes_per_sec):
+        self.bytes_per_sec = bytes_per_sec
+        self.started = time.monotonic()
+        self.total = 0
+        self.throttled = 0.0
+    
+    def consume(self, nbytes):
+        ahead = 0
+        if self.bytes_per_sec:
+            self.total += nbytes
+            ahead = self.total / self.bytes_per_sec - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+            self.throttled += ahead
+        else:
+            time.sleep(0)
+
+class _HashingWriter:
+    """File wrapper that hashes (and optionally rate-limits) everything written through it"""
+    def __init__(self, fileobj, limiter=None):
+        self.fileobj = fileobj
+        self.limiter = limiter
+        self.hash = hashlib.sha256()
+    
+    def write(self, data):
+        self.hash.update(data)
+        if self.limiter:
+            self.limiter.consume(len(data))
+        return self.fileobj.write(data)
+
+def extract_backup(backup_path, dest_path, limiter=None):
+    """Write the database held by a backup to dest_path, checking it against the backup hash
+
+    Returns the backup metadata; raises ValueError if the backup is damaged.
+    """
+    if backup_path.endswith(MANIFEST_SUFFIX):
+        return rebuild_from_manifest(backup_path, dest_path, limiter)
+    
+    try:
+        with zipfile.ZipFile(backup_path, 'r') as zipf:
+            names = zipf.namelist()
+            metadata = {}
+            if "backup_metadata.json" in names:
+                metadata = json.loads(zipf.read("backup_metadata.json"))
+            
+            # Newer backups hold the database compressed with a backup codec
+            codec = metadata.get("codec")
+            member = os.path.basename(DB_PATH) + (CODEC_EXTENSIONS[codec] if codec else "")
+            if member not in names:
+                raise ValueError("Database file not found in backup")
+            
+            # Reading a member to the end also checks its zip CRC
+            with zipf.open(member) as src, open(dest_path, 'wb') as f:
+                dst = _HashingWriter(f, limiter)
+                if codec:
+                    decompress_stream(src, dst, codec)
+                else:
+                    shutil.copyfileobj(src, dst, STREAM_CHUNK_SIZE)
+        
+        if metadata.get("backup_hash") and dst.hash.hexdigest() != metadata["backup_hash"]:
+            raise ValueError("Extracted database does not match the backup hash")
+    except Exception:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+    return metadata
+
+def restore_path():
+    """Where a restore builds the new database: a sibling of the live file"""
+    return DB_PATH + RESTORE_SUFFIX
+
+def remove_database_files(db_path):
+    """Delete a database file together with any journal, WAL or shared-memory file beside it"""
+    for suffix in ("", "-journal", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+def validate_database(db_path):
+    """Check that a database file is intact and is this app's database; returns a list of problems"""
+    problems = []
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        result = [row[0] for row in conn.execute('PRAGMA quick_check')]
+        if result != ['ok']:
+            problems.extend(result[:5])
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        problems.extend(f"missing table {table}" for table in REQUIRED_TABLES if table not in tables)
+    except sqlite3.DatabaseError as e:
+        problems.append(str(e))
+    finally:
+        conn.close()
+    return problems
+
+def install_database(new_db_path):
+    """Validate a prepared database file and swap it in for the live database
+
+    The contents are copied into the live file with the backup API in one
+    write transaction rather than renamed over it: connections still open on
+    a renamed-away SQLite file delete its -wal and -shm by name when they
+    close, which would take the new database's WAL with them. Every worker
+    holds new requests for the duration and reopens its connections after.
+    """
+    try:
+        problems = validate_database(new_db_path)
+        if problems:
+            raise ValueError(f"Restored database failed validation: {'; '.join(problems)}")
+        
+        generation = db_utils.begin_drain()
+        try:
+            time.sleep(RESTORE_DRAIN_GRACE)
+            if os.path.exists(DB_PATH):
+                dest = sqlite3.connect(DB_PATH, timeout=30)
+                source = sqlite3.connect(new_db_path)
+                try:
+                    # A WAL-mode destination must keep its page size
+                    page_size = dest.execute('PRAGMA page_size').fetchone()[0]
+                    if source.execute('PRAGMA page_size').fetchone()[0] != page_size:
+                        source.execute('PRAGMA journal_mode = DELETE')
+                        source.execute(f'PRAGMA page_size = {int(page_size)}')
+                        source.execute('VACUUM')
+                    source.backup(dest)
+                finally:
+                    source.close()
+                    dest.close()
+            else:
+                os.replace(new_db_path, DB_PATH)
+        finally:
+            db_utils.end_drain(generation)
+    finally:
+        remove_database_files(new_db_path)
+    
+    logger.info(f"Database replaced (generation {generation})")
+    
+    # Backups taken before the mail indexes or unread counters existed need them set up
+    if db_utils.initialize_mail_schema():
+        logger.info("Mail indexes and unread counters set up for the restored database")
 
 def restore_backup(backup_path):
     """Restore database from a backup file"""
@@ -194,44 +1078,23 @@ def restore_backup(backup_path):
         # Create a backup of the current database before restoration
         create_backup(backup_type='pre_restore')
         
-        # Extract the backup
-        temp_dir = os.path.join(BACKUP_DIR, f"temp_restore_{int(time.time())}")
-        os.makedirs(temp_dir, exist_ok=True)
+        # Extract the database and check it against the backup hash
+        restored_db = restore_path()
+        remove_database_files(restored_db)
+        metadata = extract_backup(backup_path, restored_db)
+        logger.info(f"Restoring backup created at: {metadata.get('created_at')}")
         
-        with zipfile.ZipFile(backup_path, 'r') as zipf:
-            zipf.extractall(temp_dir)
-        
-        # Verify metadata
-        metadata_path = os.path.join(temp_dir, "backup_metadata.json")
-        if os.path.exists(metadata_path):
-            with open(metadata_path, 'r') as f:
-                metadata = json.load(f)
-                logger.info(f"Restoring backup created at: {metadata.get('created_at')}")
-        
-        # Replace the current database with the backup
-        extracted_db = os.path.join(temp_dir, os.path.basename(DB_PATH))
-        if os.path.exists(extracted_db):
-            # Stop the application if possible (this depends on your deployment)
-            
-            # Replace the database
-            if os.path.exists(DB_PATH):
-                os.remove(DB_PATH)
-            shutil.copy2(extracted_db, DB_PATH)
-            
-            # Cleanup
-            shutil.rmtree(temp_dir)
-            
-            logger.info(f"Database restored successfully from {backup_path}")
-            return True, "Database restored successfully"
-        else:
-            return False, "Database file not found in backup"
+        install_database(restored_db)
+        
+        logger.info(f"Database restored successfully from {backup_path}")
+        return True, "Database restored successfully"
     
     except Exception as e:
         logger.error(f"Restore failed: {str(e)}")
         return False, str(e)
 
-def list_backups():
-    """List all available backups with metadata"""
+def scan_backups():
+    """Walk the backup folders and read every backup's metadata (slow; used to rebuild the catalog)"""
     backups = []
     
     for backup_type in ['daily', 'weekly', 'monthly', 'manual', 'pre_restore']:
@@ -240,7 +1103,23 @@ def list_backups():
             continue
             
         for filename in os.listdir(backup_subdir):
-            if filename.endswith('.zip'):
+            if filename.endswith(MANIFEST_SUFFIX):
+                backup_path = os.path.join(backup_subdir, filename)
+                try:
+                    manifest = read_manifest(backup_path)
+                    backups.append({
+                        "filename": filename,
+                        "path": backup_path,
+                        "type": backup_type,
+                        "format": "incremental",
+                        "created_at": manifest.get("created_at"),
+                        "size": manifest.get("stored_bytes", 0),  # New data this backup added
+                        "database_size": manifest.get("database_size"),
+                        "backup_hash": manifest.get("backup_hash")
+                    })
+                except Exception as e:
+                    logger.error(f"Failed to read manifest {filename}: {str(e)}")
+            elif filename.endswith('.zip'):
                 backup_path = os.path.join(backup_subdir, filename)
                 
                 # Extract metadata
@@ -255,9 +1134,11 @@ def list_backups():
                                     "filename": filename,
                                     "path": backup_path,
                                     "type": backup_type,
+                                    "format": "zip",
                                     "created_at": metadata.get("created_at"),
                                     "size": os.path.getsize(backup_path),
-                                    "database_size": metadata.get("database_size")
+                                    "database_size": metadata.get("database_size"),
+                                    "backup_hash": metadata.get("backup_hash")
                                 })
                         else:
                             # Metadata not found, use file stats
@@ -266,9 +1147,10 @@ def list_backups():
                                 "filename": filename,
                                 "path": backup_path,
                                 "type": backup_type,
+                                "format": "zip",
                                 "created_at": datetime.fromtimestamp(created_time).strftime("%Y-%m-%d %H:%M:%S"),
                                 "size": os.path.getsize(backup_path),
-                                "database_size": "Unknown"
+                                "database_size": None
                             })
                 except Exception as e:
                     logger.error(f"Failed to extract metadata from {filename}: {str(e)}")
@@ -278,15 +1160,658 @@ def list_backups():
                         "filename": filename,
                         "path": backup_path,
                         "type": backup_type,
+                        "format": "zip",
                         "created_at": datetime.fromtimestamp(created_time).strftime("%Y-%m-%d %H:%M:%S"),
                         "size": os.path.getsize(backup_path),
-                        "database_size": "Unknown"
+                        "database_size": None
                     })
     
     # Sort by creation time (newest first)
     backups.sort(key=lambda x: x.get("created_at", ""), reverse=True)
     return backups
 
+def _catalog_db():
+    """Open the backup catalog, creating it on first use"""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    is_new = not os.path.exists(CATALOG_DB_PATH)
+    conn = sqlite3.connect(CATALOG_DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS backups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT NOT NULL UNIQUE,      -- relative to BACKUP_DIR
+            filename TEXT NOT NULL,
+            backup_type TEXT NOT NULL,
+            format TEXT NOT NULL,           -- 'zip' or 'incremental'
+            created_at TEXT NOT NULL,
+            size INTEGER,
+            database_size INTEGER,
+            backup_hash TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_backups_created ON backups(created_at DESC)')
+    
+    # Verification columns, added to catalogs created before verification existed
+    columns = {row['name'] for row in conn.execute('PRAGMA table_info(backups)')}
+    for column, column_type in (('verify_status', 'TEXT'), ('verified_at', 'TEXT'), ('verify_message', 'TEXT')):
+        if column not in columns:
+            conn.execute(f'ALTER TABLE backups ADD COLUMN {column} {column_type}')
+    conn.commit()
+    
+    # Backups made before the catalog existed are picked up once
+    if is_new:
+        _fill_catalog(conn, scan_backups())
+    return conn
+
+def _catalog_row(backup):
+    """Catalog column values for a backup entry"""
+    return (
+        os.path.relpath(backup["path"], BACKUP_DIR),
+        backup["filename"],
+        backup["type"],
+        backup["format"],
+        backup["created_at"],
+        backup.get("size"),
+        backup.get("database_size"),
+        backup.get("backup_hash")
+    )
+
+def _fill_catalog(conn, backups):
+    """Insert (or refresh) catalog rows for the given backups"""
+    conn.executemany('''
+        INSERT INTO backups (path, filename, backup_type, format, created_at, size, database_size, backup_hash)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (path) DO UPDATE SET
+            filename = excluded.filename,
+            backup_type = excluded.backup_type,
+            format = excluded.format,
+            created_at = excluded.created_at,
+            size = excluded.size,
+            database_size = excluded.database_size,
+            backup_hash = excluded.backup_hash
+    ''', [_catalog_row(backup) for backup in backups])
+    conn.commit()
+
+def catalog_add(backup_path, backup_type, backup_format, metadata, size):
+    """Record a newly created backup in the catalog"""
+    conn = _catalog_db()
+    try:
+        _fill_catalog(conn, [{
+            "path": backup_path,
+            "filename": os.path.basename(backup_path),
+            "type": backup_type,
+            "format": backup_format,
+            "created_at": metadata.get("created_at"),
+            "size": size,
+            "database_size": metadata.get("database_size"),
+            "backup_hash": metadata.get("backup_hash")
+        }])
+    finally:
+        conn.close()
+
+def catalog_remove(backup_path):
+    """Drop a deleted backup from the catalog"""
+    conn = _catalog_db()
+    try:
+        conn.execute('DELETE FROM backups WHERE path = ?', (os.path.relpath(backup_path, BACKUP_DIR),))
+        conn.commit()
+    finally:
+        conn.close()
+
+def rebuild_catalog():
+    """Re-scan the backup folders and replace the catalog contents; returns the number of backups"""
+    backups = scan_backups()
+    conn = _catalog_db()
+    try:
+        conn.execute('DELETE FROM backups')
+        _fill_catalog(conn, backups)
+    finally:
+        conn.close()
+    logger.info(f"Backup catalog rebuilt with {len(backups)} backups")
+    return len(backups)
+
+def _catalog_entry(row):
+    """Turn a catalog row into the dict shape list_backups has always returned"""
+    return {
+        "id": row["id"],
+        "filename": row["filename"],
+        "path": os.path.join(BACKUP_DIR, row["path"]),
+        "type": row["backup_type"],
+        "format": row["format"],
+        "created_at": row["created_at"],
+        "size": row["size"] or 0,
+        "database_size": row["database_size"],
+        "backup_hash": row["backup_hash"],
+        "verify_status": row["verify_status"],
+        "verified_at": row["verified_at"],
+        "verify_message": row["verify_message"]
+    }
+
+def list_backups():
+    """List all available backups with metadata (newest first)"""
+    conn = _catalog_db()
+    try:
+        rows = conn.execute('SELECT * FROM backups ORDER BY created_at DESC').fetchall()
+    finally:
+        conn.close()
+    return [_catalog_entry(row) for row in rows]
+
+def get_backup(backup_id):
+    """Look up one backup by its catalog id"""
+    conn = _catalog_db()
+    try:
+        row = conn.execute('SELECT * FROM backups WHERE id = ?', (backup_id,)).fetchone()
+    finally:
+        conn.close()
+    return _catalog_entry(row) if row else None
+
+def verify_backup(backup_path, limiter=None):
+    """Check that a backup restores to an intact database; returns (ok, message)"""
+    temp_db_path = os.path.join(BACKUP_DIR, f"temp_verify_{os.getpid()}_{int(time.time())}.db")
+    try:
+        # Re-hashes the data (and zip CRCs or chunk hashes) on the way out
+        extract_backup(backup_path, temp_db_path, limiter)
+        
+        # The file was just written, so the check mostly reads from the page cache
+        conn = sqlite3.connect(f"file:{temp_db_path}?mode=ro", uri=True)
+        try:
+            problems = [row[0] for row in conn.execute(f'PRAGMA {BACKUP_VERIFY_CHECK}')]
+        finally:
+            conn.close()
+        
+        if problems != ['ok']:
+            return False, "; ".join(problems[:5])
+        return True, BACKUP_VERIFY_CHECK
+    except Exception as e:
+        return False, str(e)
+    finally:
+        if os.path.exists(temp_db_path):
+            os.remove(temp_db_path)
+
+def record_verification(backup_id, ok, message):
+    """Store a verification result in the catalog"""
+    conn = _catalog_db()
+    try:
+        conn.execute(
+            'UPDATE backups SET verify_status = ?, verified_at = ?, verify_message = ? WHERE id = ?',
+            ('verified' if ok else 'failed', datetime.now().strftime("%Y-%m-%d %H:%M:%S"), message, backup_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def verify_pending_backups(limit=None, bytes_per_sec=None):
+    """Verify catalogued backups that haven't been checked yet (newest first); returns (verified, failed)"""
+    conn = _catalog_db()
+    try:
+        query = 'SELECT * FROM backups WHERE verify_status IS NULL ORDER BY created_at DESC'
+        if limit:
+            query += f' LIMIT {int(limit)}'
+        rows = conn.execute(query).fetchall()
+    finally:
+        conn.close()
+    
+    limiter = _RateLimiter(BACKUP_VERIFY_RATE if bytes_per_sec is None else bytes_per_sec)
+    verified = failed = 0
+    for row in rows:
+        backup = _catalog_entry(row)
+        if not os.path.exists(backup["path"]):
+            continue  # Rotated away since the query
+        ok, message = verify_backup(backup["path"], limiter)
+        record_verification(backup["id"], ok, message)
+        if ok:
+            verified += 1
+        else:
+            failed += 1
+            logger.error(f"Backup verification failed for {backup['filename']}: {message}")
+    
+    if rows:
+        logger.info(f"Backup verification: {verified} verified, {failed} failed")
+    return verified, failed
+
+_job_threads = {}
+
+def start_job(name, job):
+    """Run a scheduled job in its own thread unless its previous run is still going
+
+    A rate-limited backup or verification of a large database can take far
+    longer than SCHEDULER_LEASE_TTL. Run inline, it would stop the lease
+    heartbeat and let another worker take over and run the same jobs
+    concurrently.
+    """
+    thread = _job_threads.get(name)
+    if thread and thread.is_alive():
+        logger.info(f"{name} still running, skipping this run")
+        return
+    
+    def run():
+        try:
+            job()
+        except Exception as e:
+            logger.error(f"{name} error: {str(e)}")
+    
+    thread = _job_threads[name] = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+def start_verification():
+    """Verify pending backups in a background thread unless a run is still going"""
+    start_job("Backup verification", lambda: _run_low_priority(verify_pending_backups))
+
+_wal_lock = threading.Lock()
+_wal_state = {}
+
+def _db_file_state():
+    """Identify the current contents of the database file; only checkpoints change it in WAL mode"""
+    stat = os.stat(DB_PATH)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def _open_wal_archiver():
+    """Open the archiver's connections; they stay open so this process never checkpoints on close"""
+    writer = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+    checkpointer = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+    for conn in (writer, checkpointer):
+        conn.execute('PRAGMA wal_autocheckpoint = 0')
+    if writer.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+        writer.close()
+        checkpointer.close()
+        raise ValueError("WAL archiving needs the database in WAL mode")
+    _wal_state.clear()
+    _wal_state.update(writer=writer, checkpointer=checkpointer, db_path=DB_PATH, timeline=None)
+
+def _close_wal_archiver():
+    """Close the archiver's connections and forget the current timeline"""
+    for name in ('writer', 'checkpointer'):
+        if _wal_state.get(name):
+            _wal_state[name].close()
+    _wal_state.clear()
+
+def _timeline_info(timeline_dir):
+    """Load a WAL timeline's description"""
+    with open(os.path.join(timeline_dir, 'timeline.json'), 'r') as f:
+        return json.load(f)
+
+def _start_wal_timeline():
+    """Take a base snapshot and start archiving WAL frames on top of it"""
+    writer = _wal_state['writer']
+    checkpointer = _wal_state['checkpointer']
+    
+    # Checkpoint with writers held off, so every frame after this point is
+    # either in the base snapshot or still in the WAL for the next segment
+    writer.execute('BEGIN IMMEDIATE')
+    try:
+        checkpointer.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+        _wal_state['db_state'] = _db_file_state()
+    finally:
+        writer.execute('ROLLBACK')
+    
+    now = datetime.now()
+    codec = BACKUP_CODEC
+    timeline_dir = os.path.join(WAL_ARCHIVE_DIR, now.strftime("%Y%m%d_%H%M%S_%f")[:-3])
+    os.makedirs(timeline_dir, exist_ok=True)
+    temp_db_path = os.path.join(timeline_dir, "base.db.tmp")
+    base_name = "base.db" + CODEC_EXTENSIONS[codec]
+    try:
+        snapshot_database(temp_db_path)
+        with open(temp_db_path, 'rb') as src, open(os.path.join(timeline_dir, base_name), 'wb') as dst:
+            base_hash, _, _ = compress_stream(src, dst, codec)
+    finally:
+        if os.path.exists(temp_db_path):
+            os.remove(temp_db_path)
+    
+    # Written last; a timeline without it is incomplete and ignored
+    with open(os.path.join(timeline_dir, 'timeline.json'), 'w') as f:
+        json.dump({
+            "created_at": now.strftime("%Y-%m-%d %H:%M:%S"),
+            "created_ts": now.timestamp(),
+            "codec": codec,
+            "base": base_name,
+            "base_hash": base_hash
+        }, f, indent=4)
+    
+    _wal_state.update(timeline=timeline_dir, timeline_ts=now.timestamp(), codec=codec, last_segment=None)
+    logger.info(f"WAL archive timeline started: {timeline_dir}")
+    prune_wal_archive()
+
+def archive_wal():
+    """Ship the WAL frames written since the last run; returns the segment path or None"""
+    with _wal_lock:
+        if _wal_state and _wal_state['db_path'] != DB_PATH:
+            _close_wal_archiver()
+        if not _wal_state:
+            _open_wal_archiver()
+        if not _wal_state['timeline'] or time.time() - _wal_state['timeline_ts'] > WAL_BASE_INTERVAL:
+            _start_wal_timeline()
+        
+        writer = _wal_state['writer']
+        segment_path = None
+        writer.execute('BEGIN IMMEDIATE')  # No frames can be added while we copy
+        try:
+            if _db_file_state() != _wal_state['db_state']:
+                # Something else checkpointed (or the database was replaced),
+                # so frames may have reached the file without being archived
+                broken = True
+            else:
+                broken = False
+                _, frames, _ = _wal_state['checkpointer'].execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+                _wal_state['db_state'] = _db_file_state()
+                segment_path = _copy_wal_segment(frames)
+        finally:
+            writer.execute('ROLLBACK')
+        
+        if broken:
+            logger.warning("Database file changed outside the WAL archiver, starting a new timeline")
+            _close_wal_archiver()
+            _open_wal_archiver()
+            _start_wal_timeline()
+        return segment_path
+
+def _copy_wal_segment(frames):
+    """Copy the valid frames of the WAL into the current timeline, unless they were already copied"""
+    wal_path = DB_PATH + "-wal"
+    if frames <= 0 or not os.path.exists(wal_path):
+        return None
+    
+    with open(wal_path, 'rb') as wal:
+        header = wal.read(WAL_HEADER_SIZE)
+        page_size = int.from_bytes(header[8:12], 'big')
+        salt = header[16:24]
+        
+        # The WAL isn't truncated after a checkpoint, so the same frames stay
+        # until the next write restarts it with a new salt
+        if (salt, frames) == _wal_state['last_segment']:
+            return None
+        
+        # Only the frames SQLite counts as valid; anything after is left over
+        # from before the WAL was last restarted
+        wal_size = WAL_HEADER_SIZE + frames * (WAL_FRAME_HEADER_SIZE + page_size)
+        wal.seek(0)
+        segment_path = os.path.join(
+            _wal_state['timeline'], f"{int(time.time() * 1000)}.wal{CODEC_EXTENSIONS[_wal_state['codec']]}")
+        with open(segment_path + ".tmp", 'wb') as dst:
+            compress_stream(_LimitedReader(wal, wal_size), dst, _wal_state['codec'])
+        os.replace(segment_path + ".tmp", segment_path)
+    
+    _wal_state['last_segment'] = (salt, frames)
+    return segment_path
+
+class _LimitedReader:
+    """File wrapper that stops reading after a given number of bytes"""
+    def __init__(self, fileobj, limit):
+        self.fileobj = fileobj
+        self.remaining = limit
+    
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+def run_wal_archiving():
+    """Scheduled job wrapper for archive_wal"""
+    try:
+        archive_wal()
+    except Exception as e:
+        logger.error(f"WAL archiving failed: {str(e)}")
+        with _wal_lock:
+            _close_wal_archiver()
+
+def list_wal_timelines():
+    """List archived WAL timelines (newest first) with the range of times they can restore to"""
+    timelines = []
+    if not os.path.isdir(WAL_ARCHIVE_DIR):
+        return timelines
+    
+    for name in os.listdir(WAL_ARCHIVE_DIR):
+        timeline_dir = os.path.join(WAL_ARCHIVE_DIR, name)
+        if not os.path.exists(os.path.join(timeline_dir, 'timeline.json')):
+            continue
+        info = _timeline_info(timeline_dir)
+        segments = sorted(
+            (int(filename.split('.', 1)[0]) / 1000.0, os.path.join(timeline_dir, filename))
+            for filename in os.listdir(timeline_dir)
+            if '.wal' in filename and not filename.endswith('.tmp')
+        )
+        latest_ts = segments[-1][0] if segments else info["created_ts"]
+        timelines.append({
+            "path": timeline_dir,
+            "created_at": info["created_at"],
+            "created_ts": info["created_ts"],
+            "latest_at": datetime.fromtimestamp(latest_ts).strftime("%Y-%m-%d %H:%M:%S"),
+            "latest_ts": latest_ts,
+            "codec": info["codec"],
+            "base": os.path.join(timeline_dir, info["base"]),
+            "base_hash": info["base_hash"],
+            "segments": segments
+        })
+    
+    timelines.sort(key=lambda t: t["created_ts"], reverse=True)
+    return timelines
+
+def prune_wal_archive():
+    """Delete timelines older than WAL_RETENTION_DAYS, always keeping the newest"""
+    cutoff = time.time() - WAL_RETENTION_DAYS * 86400
+    for timeline in list_wal_timelines()[1:]:
+        if timeline["created_ts"] < cutoff:
+            shutil.rmtree(timeline["path"])
+            logger.info(f"Removed old WAL timeline: {timeline['path']}")
+
+def build_point_in_time(target, dest_path):
+    """Rebuild the database as it was at target (a datetime) into dest_path
+
+    Returns the time of the last segment replayed.
+    """
+    target_ts = target.timestamp()
+    candidates = [t for t in list_wal_timelines() if t["created_ts"] <= target_ts]
+    if not candidates:
+        raise ValueError(f"No WAL archive covers {target.strftime('%Y-%m-%d %H:%M:%S')}")
+    timeline = candidates[0]
+    
+    try:
+        with open(timeline["base"], 'rb') as src, open(dest_path, 'wb') as f:
+            dst = _HashingWriter(f)
+            decompress_stream(src, dst, timeline["codec"])
+        if dst.hash.hexdigest() != timeline["base_hash"]:
+            raise ValueError("WAL timeline base does not match its hash")
+        
+        # Make sure the rebuilt file is in WAL mode so SQLite reads the segments
+        conn = sqlite3.connect(dest_path)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.close()
+        
+        # Replay each segment by placing it as the WAL and checkpointing it
+        restored_ts = timeline["created_ts"]
+        for segment_ts, segment_path in timeline["segments"]:
+            if segment_ts > target_ts:
+                break
+            if os.path.exists(dest_path + "-shm"):
+                os.remove(dest_path + "-shm")
+            with open(segment_path, 'rb') as src, open(dest_path + "-wal", 'wb') as dst:
+                decompress_stream(src, dst, timeline["codec"])
+            conn = sqlite3.connect(dest_path, isolation_level=None)
+            try:
+                busy, _, _ = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+                if busy:
+                    raise ValueError(f"Could not replay WAL segment {segment_path}")
+            finally:
+                conn.close()
+            restored_ts = segment_ts
+        
+        conn = sqlite3.connect(dest_path)
+        try:
+            problems = [row[0] for row in conn.execute('PRAGMA quick_check')]
+        finally:
+            conn.close()
+        if problems != ['ok']:
+            raise ValueError(f"Rebuilt database failed quick_check: {'; '.join(problems[:5])}")
+    except Exception:
+        remove_database_files(dest_path)
+        raise
+    return datetime.fromtimestamp(restored_ts)
+
+def restore_point_in_time(target):
+    """Restore the database to how it was at target (a datetime) from the WAL archive"""
+    try:
+        restored_db = restore_path()
+        remove_database_files(restored_db)
+        restored_at = build_point_in_time(target, restored_db)
+        
+        # Create a backup of the current database before restoration
+        create_backup(backup_type='pre_restore')
+        install_database(restored_db)
+        
+        message = f"Database restored to {restored_at.strftime('%Y-%m-%d %H:%M:%S')}"
+        logger.info(message)
+        return True, message
+    
+    except Exception as e:
+        logger.error(f"Point-in-time restore failed: {str(e)}")
+        return False, str(e)
+
+def _scheduler_id():
+    """Identify this process as a scheduler lease holder"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _scheduler_db():
+    """Open the scheduler lease database (kept apart from the main database so restores don't touch it)"""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    conn = sqlite3.connect(SCHEDULER_DB_PATH, timeout=10, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_lease (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            acquired_at REAL NOT NULL,
+            heartbeat_at REAL NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_runs (
+            run_key TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            status TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            finished_at REAL,
+            message TEXT
+        )
+    ''')
+    return conn
+
+def acquire_scheduler_lease():
+    """Take or renew the scheduler lease; returns True if this process is the leader"""
+    holder = _scheduler_id()
+    now = time.time()
+    conn = _scheduler_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor = conn.execute(
+            'SELECT holder, heartbeat_at FROM scheduler_lease WHERE name = ?',
+            (SCHEDULER_LEASE_NAME,)
+        )
+        lease = cursor.fetchone()
+        
+        if lease is None:
+            conn.execute(
+                'INSERT INTO scheduler_lease (name, holder, acquired_at, heartbeat_at) VALUES (?, ?, ?, ?)',
+                (SCHEDULER_LEASE_NAME, holder, now, now)
+            )
+            logger.info(f"Backup scheduler lease acquired by {holder}")
+            is_leader = True
+        elif lease['holder'] == holder:
+            conn.execute(
+                'UPDATE scheduler_lease SET heartbeat_at = ? WHERE name = ?',
+                (now, SCHEDULER_LEASE_NAME)
+            )
+            is_leader = True
+        elif now - lease['heartbeat_at'] > SCHEDULER_LEASE_TTL:
+            conn.execute(
+                'UPDATE scheduler_lease SET holder = ?, acquired_at = ?, heartbeat_at = ? WHERE name = ?',
+                (holder, now, now, SCHEDULER_LEASE_NAME)
+            )
+            logger.info(f"Backup scheduler lease taken over by {holder} from {lease['holder']}")
+            is_leader = True
+        else:
+            is_leader = False
+        
+        conn.execute('COMMIT')
+        return is_leader
+    finally:
+        conn.close()
+
+def release_scheduler_lease():
+    """Give up the lease (if held) so another process can take over straight away"""
+    try:
+        conn = _scheduler_db()
+        try:
+            conn.execute(
+                'DELETE FROM scheduler_lease WHERE name = ? AND holder = ?',
+                (SCHEDULER_LEASE_NAME, _scheduler_id())
+            )
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.error(f"Failed to release scheduler lease: {str(e)}")
+
+def claim_scheduled_run(run_key):
+    """Record that a scheduled job has started; returns False if any process already started it"""
+    conn = _scheduler_db()
+    try:
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO scheduler_runs (run_key, holder, status, started_at) VALUES (?, ?, ?, ?)',
+            (run_key, _scheduler_id(), 'running', time.time())
+        )
+        return cursor.rowcount == 1
+    finally:
+        conn.close()
+
+def finish_scheduled_run(run_key, success, message=None):
+    """Record the outcome of a claimed scheduled job"""
+    conn = _scheduler_db()
+    try:
+        conn.execute(
+            'UPDATE scheduler_runs SET status = ?, finished_at = ?, message = ? WHERE run_key = ?',
+            ('succeeded' if success else 'failed', time.time(), message, run_key)
+        )
+    finally:
+        conn.close()
+
+def get_scheduler_status(recent_runs=5):
+    """Get the current scheduler leader and the most recent scheduled runs"""
+    def fmt(ts):
+        return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S") if ts else None
+    
+    conn = _scheduler_db()
+    try:
+        lease = conn.execute(
+            'SELECT holder, acquired_at, heartbeat_at FROM scheduler_lease WHERE name = ?',
+            (SCHEDULER_LEASE_NAME,)
+        ).fetchone()
+        runs = conn.execute(
+            'SELECT run_key, holder, status, started_at, finished_at, message FROM scheduler_runs ORDER BY started_at DESC LIMIT ?',
+            (recent_runs,)
+        ).fetchall()
+    finally:
+        conn.close()
+    
+    return {
+        "leader": lease['holder'] if lease else None,
+        "acquired_at": fmt(lease['acquired_at']) if lease else None,
+        "heartbeat_at": fmt(lease['heartbeat_at']) if lease else None,
+        "alive": bool(lease) and time.time() - lease['heartbeat_at'] <= SCHEDULER_LEASE_TTL,
+        "is_this_process": bool(lease) and lease['holder'] == _scheduler_id(),
+        "recent_runs": [
+            {
+                "run_key": run['run_key'],
+                "holder": run['holder'],
+                "status": run['status'],
+                "started_at": fmt(run['started_at']),
+                "finished_at": fmt(run['finished_at']),
+                "message": run['message']
+            }
+            for run in runs
+        ]
+    }
+
 def run_scheduled_backups():
     """Function to run scheduled backups"""
     logger.info("Running scheduled backup job")
@@ -299,28 +1824,60 @@ def run_scheduled_backups():
     # Determine backup type
     if day_of_month == 1:
         # First day of month - run monthly backup
-        success, path = create_backup("monthly")
-        logger.info(f"Monthly backup {'succeeded' if success else 'failed'}: {path}")
+        backup_type = "monthly"
     elif day_of_week == 0:
         # Monday - run weekly backup
-        success, path = create_backup("weekly")
-        logger.info(f"Weekly backup {'succeeded' if success else 'failed'}: {path}")
+        backup_type = "weekly"
     else:
         # Any other day - run daily backup
-        success, path = create_backup("daily")
-        logger.info(f"Daily backup {'succeeded' if success else 'failed'}: {path}")
+        backup_type = "daily"
+    
+    # A new leader taking over the same day must not repeat a run that
+    # already started, even if it failed
+    run_key = f"scheduled_backup:{now.strftime('%Y-%m-%d')}"
+    if not claim_scheduled_run(run_key):
+        logger.info(f"Scheduled backup {run_key} already ran, skipping")
+        return
+    
+    success, path = create_backup(backup_type)
+    finish_scheduled_run(run_key, success, path)
+    logger.info(f"{backup_type.capitalize()} backup {'succeeded' if success else 'failed'}: {path}")
 
 # Setup scheduled jobs
+_scheduler_started = False
+
 def start_scheduler():
-    """Start the scheduler thread to run automatic backups"""
-    schedule.every().day.at("03:00").do(run_scheduled_backups)  # Run daily at 3 AM
+    """Start the scheduler thread to run automatic backups
+
+    Every worker process may call this; they all keep heartbeating the lease
+    but only the current leader runs the jobs, and a follower takes over when
+    the leader stops heartbeating for SCHEDULER_LEASE_TTL seconds.
+    """
+    global _scheduler_started
+    if _scheduler_started:
+        return
+    _scheduler_started = True
+    
+    # Jobs run in their own threads so the heartbeat below keeps renewing the lease
+    schedule.every().day.at("03:00").do(start_job, "Scheduled backup", run_scheduled_backups)  # Run daily at 3 AM
+    schedule.every(VERIFY_INTERVAL_MINUTES).minutes.do(start_verification)
+    if WAL_ARCHIVE_ENABLED:
+        schedule.every(WAL_ARCHIVE_INTERVAL).seconds.do(start_job, "WAL archiving", run_wal_archiving)
+    # Mail retention runs under the same lease, so only one worker archives and vacuums
+    if mail_retention.MAIL_RETENTION_DAYS > 0:
+        schedule.every().day.at(mail_retention.MAIL_RETENTION_TIME).do(mail_retention.start_retention)
     
-    logger.info("Starting backup scheduler thread")
+    logger.info(f"Starting backup scheduler thread ({_scheduler_id()})")
+    atexit.register(release_scheduler_lease)
     
     def run_scheduler():
         while True:
-            schedule.run_pending()
-            time.sleep(60)
+            try:
+                if acquire_scheduler_lease():
+                    schedule.run_pending()
+            except Exception as e:
+                logger.error(f"Backup scheduler error: {str(e)}")
+            time.sleep(SCHEDULER_HEARTBEAT)
     
     # Start scheduler in a separate thread
     scheduler_thread = threading.Thread(target=run_scheduler)
@@ -332,7 +1889,7 @@ if __name__ == "__main__":
     import argparse
     
     parser = argparse.ArgumentParser(description="Database Backup System")
-    parser.add_argument("action", choices=["backup", "restore", "list", "start_scheduler"],
+    parser.add_argument("action", choices=["backup", "restore", "list", "rebuild_catalog", "verify", "start_scheduler"],
                         help="Action to perform")
     parser.add_argument("--type", choices=["daily", "weekly", "monthly", "manual"],
                         default="manual", help="Backup type (for backup action)")
@@ -364,6 +1921,14 @@ if __name__ == "__main__":
             print(f"   DB Size: {backup.get('database_size', 'Unknown') // 1024 if isinstance(backup.get('database_size'), int) else 'Unknown'} KB")
             print()
             
+    elif args.action == "rebuild_catalog":
+        count = rebuild_catalog()
+        print(f"Catalog rebuilt with {count} backups")
+            
+    elif args.action == "verify":
+        verified, failed = verify_pending_backups()
+        print(f"{verified} backups verified, {failed} failed")
+            
     elif args.action == "start_scheduler":
         print("Starting backup scheduler in the background")
         start_scheduler()
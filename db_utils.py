@@ -1,6 +1,13 @@
 import sqlite3
+import json
 from datetime import datetime
+from contextlib import contextmanager
+from functools import wraps
 import os
+import queue
+import random
+import threading
+import time
 
 # Get the application root directory
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -19,17 +26,495 @@ os.makedirs(DB_DIR, exist_ok=True)
 
 DB_PATH = os.path.join(DB_DIR, 'cosmic_teams.db')
 
-def get_db_connection():
-    """Create a database connection and return the connection and cursor"""
-    conn = sqlite3.connect(DB_PATH)
+# Connection pool configuration
+# Idle connections kept open per process; extra connections are closed on release
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+
+# Database mode: 'wal' for concurrent readers alongside a writer (default),
+# 'rollback' for the classic rollback journal
+DB_MODE = os.environ.get('DB_MODE', 'wal')
+
+# How long SQLite itself waits on a lock before raising SQLITE_BUSY. Kept short
+# because the wait blocks the whole gevent worker; longer waits are done by
+# the retry loop below, which sleeps cooperatively. This relies on every
+# runtime writer going through write_transaction (only startup and offline
+# scripts commit directly).
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 1000))
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 64 * 1024 * 1024))
+
+# With WAL archiving on (see db_backup), only the archiver may checkpoint,
+# otherwise frames could reach the database file without being archived
+DB_WAL_AUTOCHECKPOINT = 0 if os.environ.get('BACKUP_WAL_ARCHIVE') == '1' else 1000
+
+# Retry policy for SQLITE_BUSY / "database is locked"
+DB_BUSY_RETRIES = int(os.environ.get('DB_BUSY_RETRIES', 6))
+DB_BUSY_BACKOFF = 0.02      # first retry waits ~20 ms
+DB_BUSY_BACKOFF_MAX = 1.0   # never wait more than a second between attempts
+
+# Pragmas applied once when a connection is opened, not on every checkout
+CONNECTION_PRAGMAS = (
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -8000',  # ~8 MB page cache per connection
+)
+
+DB_MODE_PRAGMAS = {
+    'wal': (
+        'PRAGMA journal_mode = WAL',
+        'PRAGMA synchronous = NORMAL',
+        'PRAGMA mmap_size = {mmap_size}',
+        'PRAGMA wal_autocheckpoint = {wal_autocheckpoint}',
+    ),
+    'rollback': (
+        'PRAGMA journal_mode = DELETE',
+        'PRAGMA synchronous = FULL',
+    ),
+}
+
+# How long a request waits for a restore in another worker to finish
+DB_DRAIN_TIMEOUT = float(os.environ.get('DB_DRAIN_TIMEOUT', 30))
+
+_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+# Database generation, shared by all workers through a file next to the
+# database and bumped whenever the database is restored
+_generation = {'stat': None, 'value': 0}
+
+# Request scope storage. Under gunicorn's gevent worker threading is monkey
+# patched, so this is greenlet-local and every greenlet gets its own scope.
+_local = threading.local()
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection that goes back to the pool instead of closing"""
+
+    def close(self):
+        """Release the connection
+
+        Inside a connection scope this is a no-op so helpers can keep calling
+        close() on the shared connection; the scope releases it at the end.
+        Outside a scope the connection is returned to the pool right away.
+        """
+        scope = getattr(_local, 'scope', None)
+        if scope is not None and scope.get('conn') is self:
+            return
+        if not getattr(self, 'pooled', False):
+            _release(self)
+
+    def close_for_real(self):
+        """Close the underlying SQLite handle"""
+        sqlite3.Connection.close(self)
+
+def _open_connection():
+    """Open a new SQLite connection and apply per-connection pragmas"""
+    # check_same_thread is off because a pooled connection may be reused by
+    # another thread; the pool guarantees only one holder at a time
+    conn = sqlite3.connect(DB_PATH, factory=PooledConnection, check_same_thread=False,
+                           timeout=DB_BUSY_TIMEOUT_MS / 1000.0)
     conn.row_factory = sqlite3.Row  # This enables column access by name
+    conn.pooled = False
+    conn.generation = _generation['value']
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    for pragma in DB_MODE_PRAGMAS.get(DB_MODE, ()):
+        try:
+            conn.execute(pragma.format(mmap_size=DB_MMAP_SIZE, wal_autocheckpoint=DB_WAL_AUTOCHECKPOINT))
+        except sqlite3.OperationalError:
+            # Switching journal mode needs exclusive access; another worker
+            # has already done it or will do it on its next connection
+            pass
+
+    scope = getattr(_local, 'scope', None)
+    if scope is not None:
+        scope['opened'] += 1
     return conn
 
+def _acquire():
+    """Take an idle connection from the pool or open a new one"""
+    try:
+        conn = _pool.get_nowait()
+        conn.pooled = False
+    except queue.Empty:
+        conn = _open_connection()
+
+    scope = getattr(_local, 'scope', None)
+    if scope is not None:
+        scope['checkouts'] += 1
+    return conn
+
+def _release(conn):
+    """Return a connection to the pool, closing it if the pool is full"""
+    try:
+        # Never hand out a connection with a half-finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+        # Connections from before a restore are not reused
+        if conn.generation != _generation['value']:
+            conn.close_for_real()
+            return
+        conn.pooled = True
+        _pool.put_nowait(conn)
+    except (queue.Full, sqlite3.Error):
+        conn.close_for_real()
+
+def get_db_connection():
+    """Get a database connection with row factory
+
+    Inside a connection scope (one per request) every call returns the same
+    connection. Outside a scope a pooled connection is returned and close()
+    gives it back to the pool.
+    """
+    scope = getattr(_local, 'scope', None)
+    if scope is None:
+        return _acquire()
+
+    if scope['conn'] is None:
+        scope['conn'] = _acquire()
+    return scope['conn']
+
 def close_connection(conn):
     """Close the database connection"""
     if conn:
         conn.close()
 
+def begin_scope():
+    """Start a connection scope for the current request or greenlet"""
+    _local.scope = {'conn': None, 'opened': 0, 'checkouts': 0}
+
+def end_scope():
+    """End the current connection scope and return its connection to the pool
+
+    Returns the scope statistics (connections opened and pool checkouts).
+    """
+    scope = getattr(_local, 'scope', None)
+    if scope is None:
+        return None
+
+    _local.scope = None
+    if scope['conn'] is not None:
+        _release(scope['conn'])
+    return {'opened': scope['opened'], 'checkouts': scope['checkouts']}
+
+def scope_stats():
+    """Get connection statistics for the current scope"""
+    scope = getattr(_local, 'scope', None)
+    if scope is None:
+        return {'opened': 0, 'checkouts': 0}
+    return {'opened': scope['opened'], 'checkouts': scope['checkouts']}
+
+@contextmanager
+def connection_scope():
+    """Share one connection for the duration of a block (background jobs, scripts)"""
+    previous = getattr(_local, 'scope', None)
+    begin_scope()
+    try:
+        yield get_db_connection()
+    finally:
+        end_scope()
+        _local.scope = previous
+
+def is_busy_error(error):
+    """Check whether an exception is SQLITE_BUSY / SQLITE_LOCKED"""
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+def busy_backoff(attempt):
+    """Sleep before retry number `attempt` using jittered exponential backoff"""
+    delay = min(DB_BUSY_BACKOFF_MAX, DB_BUSY_BACKOFF * (2 ** attempt))
+    # Full jitter so workers that collided do not retry in lockstep;
+    # time.sleep is cooperative under gevent
+    time.sleep(random.uniform(delay / 2, delay))
+
+def retry_on_busy(func):
+    """Retry a database function when SQLite reports the database is locked
+
+    Only wrap functions that run a complete transaction (commit or rollback),
+    so a retried call starts from a clean state.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(DB_BUSY_RETRIES):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not is_busy_error(e) or attempt == DB_BUSY_RETRIES - 1:
+                    raise
+                busy_backoff(attempt)
+    return wrapper
+
+# Per-process writer lock. Writes from all greenlets/threads in a worker are
+# queued here instead of piling up on SQLite's file lock.
+_write_lock = threading.RLock()
+
+@contextmanager
+def write_transaction():
+    """Run a block of writes as one serialized transaction
+
+    Takes the process writer lock, starts the transaction with BEGIN IMMEDIATE
+    (retrying with backoff while another process holds the write lock) and
+    commits on success or rolls back on error. If the connection is already in
+    a transaction, or an outer write_transaction is open on this thread, the
+    block simply joins it and the outer code commits.
+
+        with db_utils.write_transaction() as conn:
+            conn.execute('UPDATE users SET bio = ? WHERE id = ?', (bio, user_id))
+    """
+    outer = getattr(_local, 'writer', None)
+    if outer is not None:
+        yield outer
+        return
+
+    conn = get_db_connection()
+    with _write_lock:
+        if conn.in_transaction:
+            yield conn
+            return
+
+        for attempt in range(DB_BUSY_RETRIES):
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                break
+            except sqlite3.OperationalError as e:
+                if not is_busy_error(e) or attempt == DB_BUSY_RETRIES - 1:
+                    close_connection(conn)
+                    raise
+                busy_backoff(attempt)
+
+        _local.writer = conn
+        try:
+            yield conn
+            retry_on_busy(conn.commit)()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            _local.writer = None
+            close_connection(conn)
+
+def clear_pool():
+    """Close every idle pooled connection (e.g. after the database file is replaced)"""
+    while True:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            break
+        conn.close_for_real()
+
+# Restore coordination
+def _generation_path():
+    """Path of the file holding the shared database generation"""
+    return DB_PATH + '.generation'
+
+def _read_generation():
+    """Read the shared generation: (generation, draining)"""
+    try:
+        with open(_generation_path()) as f:
+            parts = f.read().split()
+    except FileNotFoundError:
+        return 0, False
+    return int(parts[0]), parts[1:] == ['draining']
+
+def _write_generation(value, draining):
+    """Atomically replace the shared generation file"""
+    temp_path = f"{_generation_path()}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(f"{value} draining\n" if draining else f"{value}\n")
+    os.replace(temp_path, _generation_path())
+
+def check_generation():
+    """Per-request check: wait out a restore in progress and drop connections to the old database
+
+    Costs one stat() per request unless the generation file has changed.
+    """
+    def file_stat():
+        try:
+            stat = os.stat(_generation_path())
+            return (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            return None
+
+    stat = file_stat()
+    if stat == _generation['stat']:
+        return
+
+    value, draining = _read_generation()
+    deadline = time.monotonic() + DB_DRAIN_TIMEOUT
+    while draining and time.monotonic() < deadline:
+        time.sleep(0.05)  # Cooperative under gevent
+        stat = file_stat()
+        value, draining = _read_generation()
+    if draining:
+        return  # Restore is taking too long; carry on and check again next request
+
+    if value != _generation['value']:
+        _generation['value'] = value
+        clear_pool()
+    _generation['stat'] = stat
+
+def begin_drain():
+    """Tell every worker to hold new requests while the database is replaced; returns the new generation"""
+    value, _ = _read_generation()
+    _write_generation(value + 1, True)
+    return value + 1
+
+def end_drain(generation):
+    """Let workers continue; each one reopens its connections on its next request"""
+    _write_generation(generation, False)
+    check_generation()
+
+# One-off data migrations
+def migration_applied(name):
+    """Check whether a named data migration has already been recorded"""
+    conn = get_db_connection()
+    try:
+        row = conn.execute('SELECT 1 FROM schema_migrations WHERE name = ?', (name,)).fetchone()
+        return row is not None
+    except sqlite3.OperationalError:
+        # Table not created yet, so nothing has been applied
+        return False
+    finally:
+        close_connection(conn)
+
+def run_migration_once(name, migrate):
+    """Apply a named data migration exactly once across all worker processes
+
+    migrate(cursor) runs inside a BEGIN IMMEDIATE transaction together with
+    the row recording it in schema_migrations, so workers booting at the same
+    time queue on the database write lock and all but the first find it
+    already recorded. Returns True if this call applied the migration.
+    """
+    # Cheap check first so startup costs one point read once it is done
+    if migration_applied(name):
+        return False
+
+    with write_transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                name TEXT PRIMARY KEY,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('SELECT 1 FROM schema_migrations WHERE name = ?', (name,))
+        if cursor.fetchone():
+            return False
+
+        migrate(cursor)
+        cursor.execute('INSERT INTO schema_migrations (name) VALUES (?)', (name,))
+    return True
+
+# Mailbox indexes. The inbox and sent views page by (sent_at, id) newest
+# first, so one index range scan returns a page without sorting. They replace
+# the single-column sender/recipient indexes, which they cover.
+MAIL_INDEXES_SQL = (
+    'CREATE INDEX IF NOT EXISTS idx_mail_recipient_sent ON mail(recipient_id, sent_at DESC, id DESC)',
+    'CREATE INDEX IF NOT EXISTS idx_mail_sender_sent ON mail(sender_id, sent_at DESC, id DESC)',
+    'DROP INDEX IF EXISTS idx_mail_recipient_id',
+    'DROP INDEX IF EXISTS idx_mail_sender_id',
+)
+
+def _create_mail_indexes(cursor):
+    """Create the mailbox paging indexes"""
+    # Databases created by app.init_db before it matched schema.sql call the
+    # timestamp created_at; everything that reads mail expects sent_at
+    cursor.execute('PRAGMA table_info(mail)')
+    columns = [column[1] for column in cursor.fetchall()]
+    if 'sent_at' not in columns and 'created_at' in columns:
+        cursor.execute('ALTER TABLE mail RENAME COLUMN created_at TO sent_at')
+    
+    for statement in MAIL_INDEXES_SQL:
+        cursor.execute(statement)
+
+# Archived mail. Same columns as mail; rows keep their original id.
+MAIL_ARCHIVE_SQL = (
+    '''
+    CREATE TABLE IF NOT EXISTS mail_archive (
+        id INTEGER PRIMARY KEY,
+        sender_id INTEGER,
+        recipient_id INTEGER NOT NULL,
+        subject TEXT,
+        content TEXT,
+        is_read INTEGER DEFAULT 0,
+        mail_type TEXT DEFAULT 'message',
+        related_id INTEGER,
+        sent_at TIMESTAMP,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_mail_archive_recipient_sent ON mail_archive(recipient_id, sent_at DESC)',
+)
+
+MAIL_COLUMNS = 'id, sender_id, recipient_id, subject, content, is_read, mail_type, related_id, sent_at'
+
+def _create_mail_archive(cursor):
+    """Create the mail archive table"""
+    for statement in MAIL_ARCHIVE_SQL:
+        cursor.execute(statement)
+
+def initialize_mail_schema():
+    """Bring the mail indexes, unread counters and archive up to date (once per database)
+
+    Returns True if anything was applied.
+    """
+    indexes = run_migration_once('mail_paging_indexes', _create_mail_indexes)
+    counters = run_migration_once('mail_unread_counts', _create_mail_unread_counts)
+    archive = run_migration_once('mail_archive', _create_mail_archive)
+    return indexes or counters or archive
+
+# Unread mail counters. Triggers keep mail_unread_counts in step with the mail
+# table inside whatever transaction inserts, updates or deletes mail, so every
+# code path (including bulk and archive jobs) is covered without extra code.
+MAIL_UNREAD_COUNTS_SQL = (
+    '''
+    CREATE TABLE IF NOT EXISTS mail_unread_counts (
+        user_id INTEGER PRIMARY KEY,
+        unread INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS mail_unread_insert AFTER INSERT ON mail
+    WHEN NEW.is_read = 0
+    BEGIN
+        INSERT INTO mail_unread_counts (user_id, unread) VALUES (NEW.recipient_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET unread = unread + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS mail_unread_delete AFTER DELETE ON mail
+    WHEN OLD.is_read = 0
+    BEGIN
+        UPDATE mail_unread_counts SET unread = unread - 1 WHERE user_id = OLD.recipient_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS mail_unread_update_old AFTER UPDATE OF is_read, recipient_id ON mail
+    WHEN OLD.is_read = 0
+    BEGIN
+        UPDATE mail_unread_counts SET unread = unread - 1 WHERE user_id = OLD.recipient_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS mail_unread_update_new AFTER UPDATE OF is_read, recipient_id ON mail
+    WHEN NEW.is_read = 0
+    BEGIN
+        INSERT INTO mail_unread_counts (user_id, unread) VALUES (NEW.recipient_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET unread = unread + 1;
+    END
+    ''',
+)
+
+def _create_mail_unread_counts(cursor):
+    """Create the counter table and triggers and fill the counters from the mail table"""
+    for statement in MAIL_UNREAD_COUNTS_SQL:
+        cursor.execute(statement)
+    
+    # Same transaction as the triggers, so no mail change can slip in between
+    cursor.execute('DELETE FROM mail_unread_counts')
+    cursor.execute('''
+        INSERT INTO mail_unread_counts (user_id, unread)
+        SELECT recipient_id, COUNT(*) FROM mail WHERE is_read = 0 GROUP BY recipient_id
+    ''')
+
 # User-related functions
 def get_user(user_id):
     """Get user data by ID"""
@@ -76,54 +561,46 @@ def get_all_users(order_by='username', limit=None):
 
 def update_user_login(user_id):
     """Update user's last login time"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        'UPDATE users SET last_login = ? WHERE id = ?',
-        (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id)
-    )
-    
-    conn.commit()
-    close_connection(conn)
+    with write_transaction() as conn:
+        conn.execute(
+            'UPDATE users SET last_login = ? WHERE id = ?',
+            (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id)
+        )
 
 def add_star_points(user_id, points):
     """Add star points to a user and update their galaxy rank"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Get current star points
-    cursor.execute('SELECT star_points FROM users WHERE id = ?', (user_id,))
-    result = cursor.fetchone()
-    
-    if not result:
-        close_connection(conn)
-        return False
-    
-    current_points = result['star_points']
-    new_points = current_points + points
-    
-    # Determine new galaxy rank based on points
-    new_rank = "Novice Explorer"
-    if new_points >= 1000:
-        new_rank = "Galaxy Master"
-    elif new_points >= 500:
-        new_rank = "Star Commander"
-    elif new_points >= 250:
-        new_rank = "Nebula Navigator"
-    elif new_points >= 100:
-        new_rank = "Cosmic Voyager"
-    elif new_points >= 50:
-        new_rank = "Space Explorer"
-    
-    # Update user
-    cursor.execute(
-        'UPDATE users SET star_points = ?, galaxy_rank = ? WHERE id = ?',
-        (new_points, new_rank, user_id)
-    )
+    with write_transaction() as conn:
+        cursor = conn.cursor()
+        
+        # Get current star points
+        cursor.execute('SELECT star_points FROM users WHERE id = ?', (user_id,))
+        result = cursor.fetchone()
+        
+        if not result:
+            return False
+        
+        current_points = result['star_points']
+        new_points = current_points + points
+        
+        # Determine new galaxy rank based on points
+        new_rank = "Novice Explorer"
+        if new_points >= 1000:
+            new_rank = "Galaxy Master"
+        elif new_points >= 500:
+            new_rank = "Star Commander"
+        elif new_points >= 250:
+            new_rank = "Nebula Navigator"
+        elif new_points >= 100:
+            new_rank = "Cosmic Voyager"
+        elif new_points >= 50:
+            new_rank = "Space Explorer"
+        
+        # Update user
+        cursor.execute(
+            'UPDATE users SET star_points = ?, galaxy_rank = ? WHERE id = ?',
+            (new_points, new_rank, user_id)
+        )
     
-    conn.commit()
-    close_connection(conn)
     return True
 
 # Team-related functions
@@ -235,37 +712,83 @@ def get_user_mail(user_id, mail_type=None, is_read=None, limit=20):
     return mail
 
 def get_unread_mail_count(user_id):
-    """Get count of unread mail for a user"""
+    """Get count of unread mail for a user (one point read of the counter)"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute(
-        'SELECT COUNT(*) as count FROM mail WHERE recipient_id = ? AND is_read = 0',
-        (user_id,)
-    )
+    cursor.execute('SELECT unread FROM mail_unread_counts WHERE user_id = ?', (user_id,))
     result = cursor.fetchone()
     
     close_connection(conn)
-    return result['count'] if result else 0
+    return max(result['unread'], 0) if result else 0
 
 def send_mail(sender_id, recipient_id, subject, content, mail_type='message', related_id=None):
     """Send a mail message from one user to another"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with write_transaction() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute(
+            '''
+            INSERT INTO mail (sender_id, recipient_id, subject, content, mail_type, related_id, sent_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''',
+            (sender_id, recipient_id, subject, content, mail_type, related_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
+        
+        mail_id = cursor.lastrowid
     
-    cursor.execute(
-        '''
-        INSERT INTO mail (sender_id, recipient_id, subject, content, mail_type, related_id, sent_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''',
-        (sender_id, recipient_id, subject, content, mail_type, related_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-    )
+    return mail_id
+
+MAIL_BULK_ACTIONS = ('read', 'delete', 'archive')
+
+def bulk_mail_action(user_id, action, mail_ids=None, folder='inbox', mail_type=None):
+    """Mark read, delete or archive many of a user's messages in one transaction
+
+    Acts on mail_ids, or on every message in the folder (optionally of one
+    mail_type) when mail_ids is None. Ownership is part of the WHERE clause,
+    so IDs belonging to other users are ignored rather than checked one by
+    one. Returns (messages changed, IDs of the users whose unread count
+    changed); deleting unread sent mail changes the recipients' counts.
+    """
+    if action not in MAIL_BULK_ACTIONS:
+        raise ValueError(f"Unknown mail action: {action}")
+    if folder not in ('inbox', 'sent'):
+        raise ValueError(f"Unknown mail folder: {folder}")
+    if folder == 'sent' and action != 'delete':
+        raise ValueError("Sent mail can only be deleted")
+    
+    # Owner of the folder: recipients own the inbox, senders the sent folder
+    where = 'recipient_id = ?' if folder == 'inbox' else 'sender_id = ?'
+    params = [user_id]
     
-    mail_id = cursor.lastrowid
-    conn.commit()
-    close_connection(conn)
+    if mail_ids is not None:
+        # One JSON parameter instead of one placeholder per ID, so any
+        # number of IDs fits in a single statement
+        where += ' AND id IN (SELECT value FROM json_each(?))'
+        params.append(json.dumps([int(mail_id) for mail_id in mail_ids]))
     
-    return mail_id
+    if mail_type:
+        where += ' AND mail_type = ?'
+        params.append(mail_type)
+    
+    with write_transaction() as conn:
+        # Only unread messages move a counter, whichever action it is
+        changed_users = [row[0] for row in conn.execute(
+            f'SELECT DISTINCT recipient_id FROM mail WHERE {where} AND is_read = 0', params)]
+        
+        if action == 'read':
+            cursor = conn.execute(f'UPDATE mail SET is_read = 1 WHERE {where} AND is_read = 0', params)
+        elif action == 'delete':
+            cursor = conn.execute(f'DELETE FROM mail WHERE {where}', params)
+        else:
+            conn.execute(f'''
+                INSERT INTO mail_archive ({MAIL_COLUMNS})
+                SELECT {MAIL_COLUMNS} FROM mail WHERE {where}
+            ''', params)
+            cursor = conn.execute(f'DELETE FROM mail WHERE {where}', params)
+        count = cursor.rowcount
+    
+    return count, changed_users
 
 # Competition-related functions
 def get_active_competitions():
@@ -350,109 +873,91 @@ def award_achievement(user_id=None, team_id=None, achievement_name=None):
     if not achievement_name or (user_id is None and team_id is None):
         return False
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Get the achievement ID
-    cursor.execute('SELECT id, achievement_type, points FROM achievements WHERE name = ?', (achievement_name,))
-    achievement = cursor.fetchone()
-    
-    if not achievement:
-        close_connection(conn)
-        return False
-    
-    achievement_id = achievement['id']
-    achievement_type = achievement['achievement_type']
-    points = achievement['points']
-    
-    if achievement_type == 'user' and user_id:
-        # Check if user already has this achievement
-        cursor.execute(
-            'SELECT id FROM user_achievements WHERE user_id = ? AND achievement_id = ?',
-            (user_id, achievement_id)
-        )
-        existing = cursor.fetchone()
+    with write_transaction() as conn:
+        cursor = conn.cursor()
         
-        if not existing:
-            # Award the achievement
-            cursor.execute(
-                'INSERT INTO user_achievements (user_id, achievement_id, date_earned) VALUES (?, ?, ?)',
-                (user_id, achievement_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-            )
-            
-            # Add star points to the user
-            add_star_points(user_id, points)
-            
-            # Log the activity
-            log_user_activity(user_id, 'achievement_earned', f"Earned achievement: {achievement_name}", achievement_id)
-            
-            conn.commit()
-            close_connection(conn)
-            return True
-    
-    elif achievement_type == 'team' and team_id:
-        # Check if team already has this achievement
-        cursor.execute(
-            'SELECT id FROM team_achievements WHERE team_id = ? AND achievement_id = ?',
-            (team_id, achievement_id)
-        )
-        existing = cursor.fetchone()
+        # Get the achievement ID
+        cursor.execute('SELECT id, achievement_type, points FROM achievements WHERE name = ?', (achievement_name,))
+        achievement = cursor.fetchone()
         
-        if not existing:
-            # Award the achievement
+        if not achievement:
+            return False
+        
+        achievement_id = achievement['id']
+        achievement_type = achievement['achievement_type']
+        points = achievement['points']
+        
+        if achievement_type == 'user' and user_id:
+            # Check if user already has this achievement
             cursor.execute(
-                'INSERT INTO team_achievements (team_id, achievement_id, date_earned) VALUES (?, ?, ?)',
-                (team_id, achievement_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                'SELECT id FROM user_achievements WHERE user_id = ? AND achievement_id = ?',
+                (user_id, achievement_id)
             )
+            existing = cursor.fetchone()
             
-            # Add points to the team
+            if not existing:
+                # Award the achievement
+                cursor.execute(
+                    'INSERT INTO user_achievements (user_id, achievement_id, date_earned) VALUES (?, ?, ?)',
+                    (user_id, achievement_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                )
+                
+                # Add star points to the user
+                add_star_points(user_id, points)
+                
+                # Log the activity
+                log_user_activity(user_id, 'achievement_earned', f"Earned achievement: {achievement_name}", achievement_id)
+                return True
+        
+        elif achievement_type == 'team' and team_id:
+            # Check if team already has this achievement
             cursor.execute(
-                'UPDATE teams SET points = points + ? WHERE id = ?',
-                (points, team_id)
+                'SELECT id FROM team_achievements WHERE team_id = ? AND achievement_id = ?',
+                (team_id, achievement_id)
             )
+            existing = cursor.fetchone()
             
-            # Log the activity
-            log_team_activity(team_id, None, 'achievement_earned', f"Team earned achievement: {achievement_name}", achievement_id)
-            
-            conn.commit()
-            close_connection(conn)
-            return True
+            if not existing:
+                # Award the achievement
+                cursor.execute(
+                    'INSERT INTO team_achievements (team_id, achievement_id, date_earned) VALUES (?, ?, ?)',
+                    (team_id, achievement_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                )
+                
+                # Add points to the team
+                cursor.execute(
+                    'UPDATE teams SET points = points + ? WHERE id = ?',
+                    (points, team_id)
+                )
+                
+                # Log the activity
+                log_team_activity(team_id, None, 'achievement_earned', f"Team earned achievement: {achievement_name}", achievement_id)
+                return True
     
-    close_connection(conn)
     return False
 
 # Activity logging functions
 def log_user_activity(user_id, activity_type, description=None, related_id=None):
     """Log a user activity"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        '''
-        INSERT INTO user_activity (user_id, activity_type, description, related_id, timestamp)
-        VALUES (?, ?, ?, ?, ?)
-        ''',
-        (user_id, activity_type, description, related_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-    )
-    
-    conn.commit()
-    close_connection(conn)
+    with write_transaction() as conn:
+        conn.execute(
+            '''
+            INSERT INTO user_activity (user_id, activity_type, description, related_id, timestamp)
+            VALUES (?, ?, ?, ?, ?)
+            ''',
+            (user_id, activity_type, description, related_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
 
 def log_team_activity(team_id, user_id, activity_type, description=None, related_id=None):
     """Log a team activity"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        '''
-        INSERT INTO team_activity (team_id, user_id, activity_type, description, related_id, timestamp)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ''',
-        (team_id, user_id, activity_type, description, related_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-    )
-    
-    conn.commit()
-    close_connection(conn)
+    with write_transaction() as conn:
+        conn.execute(
+            '''
+            INSERT INTO team_activity (team_id, user_id, activity_type, description, related_id, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''',
+            (team_id, user_id, activity_type, description, related_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
 
 # Settings functions
 def get_setting(setting_key, default=None):
@@ -481,22 +986,17 @@ def get_setting(setting_key, default=None):
 
 def update_setting(setting_key, setting_value):
     """Update a setting value"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     # Convert value to string for storage
     if isinstance(setting_value, bool):
         setting_value = 'true' if setting_value else 'false'
     else:
         setting_value = str(setting_value)
     
-    cursor.execute(
-        'UPDATE settings SET setting_value = ? WHERE setting_key = ?',
-        (setting_value, setting_key)
-    )
-    
-    conn.commit()
-    close_connection(conn)
+    with write_transaction() as conn:
+        conn.execute(
+            'UPDATE settings SET setting_value = ? WHERE setting_key = ?',
+            (setting_value, setting_key)
+        )
 
 # Galaxy events functions
 def get_active_galaxy_events():
@@ -0,0 +1,355 @@
+"""
+Outbound email outbox
+
+Emails are written to the email_outbox table in the same transaction as the
+in-app mail they belong to, and a background worker sends them. The worker
+claims a batch of due rows, sends them over one SMTP connection, and
+reschedules failures with exponential backoff.
+
+Email bodies are rendered from the Jinja templates in templates/email, which
+are compiled once per process and reused.
+"""
+import os
+import time
+import random
+import smtplib
+import logging
+import threading
+from email.mime.text import MIMEText
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+import db_utils
+import mail_events
+
+logger = logging.getLogger('email_outbox')
+
+# SMTP settings
+SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+SMTP_USERNAME = os.environ.get('SMTP_USERNAME', '')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', '')
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1') == '1'
+SMTP_TIMEOUT = 30
+EMAIL_FROM = os.environ.get('EMAIL_FROM') or f"TeamSync <{SMTP_USERNAME or 'noreply@localhost'}>"
+EMAIL_LOGIN_URL = os.environ.get('EMAIL_LOGIN_URL', 'http://yourwebsite.com/login')
+
+# Email templates, compiled on first use and kept for the life of the process
+EMAIL_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'email')
+
+# Worker settings
+OUTBOX_BATCH_SIZE = 50          # Emails sent per SMTP connection
+OUTBOX_POLL_INTERVAL = 5        # Seconds between checks when the outbox is idle
+OUTBOX_MAX_ATTEMPTS = 8         # Attempts before an email is marked failed
+OUTBOX_RETRY_BASE = 30          # First retry after ~30 s, doubling each time
+OUTBOX_RETRY_MAX = 3600         # Never wait more than an hour between attempts
+OUTBOX_CLAIM_TIMEOUT = 300      # A claimed batch not finished by then is retried
+
+OUTBOX_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS email_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        mail_id INTEGER,
+        recipient_email TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        body_html TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',  -- pending, sending, sent, failed
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        claimed_until REAL,
+        last_error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        sent_at TIMESTAMP,
+        FOREIGN KEY (mail_id) REFERENCES mail (id) ON DELETE SET NULL
+    )
+'''
+OUTBOX_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox(status, next_attempt_at)'
+
+_wakeup = threading.Event()
+_worker_started = False
+
+# No auto_reload: the compiled templates are used as-is, without checking
+# the files for changes on every render
+_template_env = Environment(
+    loader=FileSystemLoader(EMAIL_TEMPLATE_DIR),
+    autoescape=select_autoescape(['html']),
+    auto_reload=False,
+    cache_size=-1,
+)
+_templates = {}
+_templates_lock = threading.Lock()
+
+def initialize_tables():
+    """Create the outbox table if it doesn't exist"""
+    with db_utils.write_transaction() as conn:
+        conn.execute(OUTBOX_TABLE_SQL)
+        conn.execute(OUTBOX_INDEX_SQL)
+
+def enqueue_email(cursor, recipient_email, subject, body_html, mail_id=None):
+    """Queue an email inside the caller's transaction; returns the outbox id"""
+    cursor.execute('''
+        INSERT INTO email_outbox (mail_id, recipient_email, subject, body_html, next_attempt_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (mail_id, recipient_email, subject, body_html, time.time()))
+    return cursor.lastrowid
+
+def get_template(name):
+    """Get a compiled email template (loaded once per process)"""
+    template = _templates.get(name)
+    if template is None:
+        with _templates_lock:
+            template = _templates.get(name)
+            if template is None:
+                template = _templates[name] = _template_env.get_template(name)
+    return template
+
+def render_email(name, **context):
+    """Render an email template"""
+    return get_template(name).render(**context)
+
+def send_team_invitations(sender_id, recipient_ids, team_id):
+    """Send team invitations to several users at once
+
+    Writes the in-app mail and queues the email for every recipient in one
+    transaction. Returns {recipient_id: mail_id} for the invitations sent;
+    unknown users are skipped.
+    """
+    recipient_ids = list(dict.fromkeys(int(recipient_id) for recipient_id in recipient_ids))
+
+    conn = db_utils.get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT username FROM users WHERE id = ?', (sender_id,))
+    sender = cursor.fetchone()
+
+    cursor.execute('SELECT name, description FROM teams WHERE id = ?', (team_id,))
+    team = cursor.fetchone()
+
+    # Look recipients up in chunks to stay under SQLite's variable limit
+    recipients = []
+    for start in range(0, len(recipient_ids), 500):
+        chunk = recipient_ids[start:start + 500]
+        cursor.execute(
+            f'SELECT id, username, email FROM users WHERE id IN ({",".join("?" * len(chunk))})',
+            chunk
+        )
+        recipients.extend(cursor.fetchall())
+
+    db_utils.close_connection(conn)
+
+    if not sender or not team or not recipients:
+        return {}
+
+    # Render everything before taking the write lock
+    subject = f"Team Invitation: {team['name']}"
+    text_template = get_template('team_invite.txt')
+    html_template = get_template('team_invite.html')
+    invitations = []
+    for recipient in recipients:
+        context = {
+            'recipient_name': recipient['username'],
+            'sender_name': sender['username'],
+            'team_name': team['name'],
+            'team_description': team['description'],
+            'login_url': EMAIL_LOGIN_URL,
+        }
+        content = text_template.render(context)
+        html = html_template.render(context, content=content) if recipient['email'] else None
+        invitations.append((recipient, content, html))
+
+    # Store the in-app mail and queue the email in one transaction, so an email
+    # is only ever sent for an invitation that was saved
+    mail_ids = {}
+    with db_utils.write_transaction() as conn:
+        cursor = conn.cursor()
+        for recipient, content, html in invitations:
+            cursor.execute('''
+                INSERT INTO mail (sender_id, recipient_id, subject, content, mail_type, related_id)
+                VALUES (?, ?, ?, ?, 'team_invite', ?)
+            ''', (sender_id, recipient['id'], subject, content, team_id))
+            mail_ids[recipient['id']] = cursor.lastrowid
+
+            if html:
+                enqueue_email(cursor, recipient['email'], subject, html, mail_id=mail_ids[recipient['id']])
+
+    wake_worker()
+
+    # Live notification for recipients with a page open in this process
+    for recipient, _, _ in invitations:
+        mail_events.publish(recipient['id'], 'invite', {
+            'mail_id': mail_ids[recipient['id']],
+            'team_id': team_id,
+            'team_name': team['name'],
+            'sender': sender['username'],
+        })
+    return mail_ids
+
+def wake_worker():
+    """Ask this process's worker to check the outbox now instead of at its next poll"""
+    _wakeup.set()
+
+def retry_delay(attempts):
+    """Seconds to wait before the next attempt, with jitter so failures don't retry in lockstep"""
+    delay = min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * (2 ** (attempts - 1)))
+    return delay * random.uniform(0.8, 1.2)
+
+def claim_batch(limit=OUTBOX_BATCH_SIZE):
+    """Claim due emails for this worker; other workers skip them until the claim expires"""
+    now = time.time()
+    due_sql = '''
+        FROM email_outbox
+        WHERE (status = 'pending' AND next_attempt_at <= ?)
+           OR (status = 'sending' AND claimed_until < ?)
+    '''
+
+    # Every worker polls; only take the write lock when something is due
+    conn = db_utils.get_db_connection()
+    try:
+        due = conn.execute(f'SELECT 1 {due_sql} LIMIT 1', (now, now)).fetchone()
+    finally:
+        db_utils.close_connection(conn)
+    if not due:
+        return []
+
+    with db_utils.write_transaction() as conn:
+        # A claim that keeps expiring (its worker dies mid-send) must not be retried forever
+        conn.execute('''
+            UPDATE email_outbox
+            SET status = 'failed', claimed_until = NULL,
+                last_error = COALESCE(last_error, 'Claim expired before the email was sent')
+            WHERE status = 'sending' AND claimed_until < ? AND attempts >= ?
+        ''', (now, OUTBOX_MAX_ATTEMPTS))
+        rows = conn.execute(f'SELECT * {due_sql} ORDER BY next_attempt_at LIMIT ?',
+                            (now, now, limit)).fetchall()
+        conn.executemany('''
+            UPDATE email_outbox SET status = 'sending', claimed_until = ?, attempts = attempts + 1
+            WHERE id = ?
+        ''', [(now + OUTBOX_CLAIM_TIMEOUT, row['id']) for row in rows])
+    return [dict(row, attempts=row['attempts'] + 1) for row in rows]
+
+def build_message(email):
+    """Build the MIME message for an outbox row (a single HTML part, no multipart wrapper)"""
+    msg = MIMEText(email['body_html'], 'html')
+    msg['Subject'] = email['subject']
+    msg['From'] = EMAIL_FROM
+    msg['To'] = email['recipient_email']
+    return msg
+
+def open_smtp():
+    """Connect (and log in) to the SMTP server"""
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+    try:
+        if SMTP_STARTTLS:
+            server.starttls()
+        if SMTP_USERNAME:
+            server.login(SMTP_USERNAME, SMTP_PASSWORD)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+def send_batch(emails):
+    """Send claimed emails over one SMTP connection; returns (sent, retried, failed)"""
+    results = []  # (email, status, error)
+    server = None
+    try:
+        server = open_smtp()
+        for email in emails:
+            try:
+                server.send_message(build_message(email))
+                results.append((email, 'sent', None))
+            except smtplib.SMTPRecipientsRefused as e:
+                # Permanent for this address; the rest of the batch can still go
+                results.append((email, 'failed', str(e)))
+            except smtplib.SMTPResponseException as e:
+                results.append((email, 'failed' if 500 <= e.smtp_code < 600 else 'retry', str(e)))
+            except (smtplib.SMTPException, OSError):
+                raise
+            except Exception as e:
+                # Anything else (building the message, say) is this email's problem:
+                # back off and eventually fail it instead of leaving it claimed
+                logger.exception(f"Could not send email {email['id']}")
+                results.append((email, 'retry', str(e)))
+    except (smtplib.SMTPException, OSError) as e:
+        # Connection trouble: everything not sent yet is retried later
+        logger.warning(f"SMTP connection failed: {str(e)}")
+        done = {email['id'] for email, _, _ in results}
+        results.extend((email, 'retry', str(e)) for email in emails if email['id'] not in done)
+    finally:
+        if server is not None:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
+
+    counts = {'sent': 0, 'retry': 0, 'failed': 0}
+    updates = []
+    now = time.time()
+    for email, status, error in results:
+        if status == 'retry' and email['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+            status = 'failed'
+        counts[status] += 1
+
+        if status == 'sent':
+            updates.append(('sent', now, None, True, email['id']))
+        elif status == 'retry':
+            updates.append(('pending', now + retry_delay(email['attempts']), error, False, email['id']))
+        else:
+            logger.error(f"Giving up on email {email['id']} to {email['recipient_email']}: {error}")
+            updates.append(('failed', now, error, False, email['id']))
+
+    # Record the whole batch's outcomes in one transaction
+    with db_utils.write_transaction() as conn:
+        conn.executemany('''
+            UPDATE email_outbox
+            SET status = ?, next_attempt_at = ?, last_error = ?, claimed_until = NULL,
+                sent_at = CASE WHEN ? THEN CURRENT_TIMESTAMP END
+            WHERE id = ?
+        ''', updates)
+
+    return counts['sent'], counts['retry'], counts['failed']
+
+def process_outbox():
+    """Send every due email, batch by batch; returns (sent, retried, failed)"""
+    totals = [0, 0, 0]
+    while True:
+        emails = claim_batch()
+        if not emails:
+            return tuple(totals)
+        for i, count in enumerate(send_batch(emails)):
+            totals[i] += count
+
+def get_outbox_stats():
+    """Count outbox rows by status"""
+    conn = db_utils.get_db_connection()
+    try:
+        rows = conn.execute('SELECT status, COUNT(*) FROM email_outbox GROUP BY status').fetchall()
+    finally:
+        db_utils.close_connection(conn)
+    return {status: count for status, count in rows}
+
+def start_worker():
+    """Start the background thread that drains the outbox (once per process)
+
+    Every worker process may run one; claims keep them from sending the same
+    email twice.
+    """
+    global _worker_started
+    if _worker_started:
+        return
+    _worker_started = True
+
+    def run_worker():
+        while True:
+            try:
+                sent, retried, failed = process_outbox()
+                if sent or retried or failed:
+                    logger.info(f"Outbox: {sent} sent, {retried} to retry, {failed} failed")
+            except Exception as e:
+                logger.error(f"Outbox worker error: {str(e)}")
+            _wakeup.wait(OUTBOX_POLL_INTERVAL)
+            _wakeup.clear()
+
+    worker_thread = threading.Thread(target=run_worker)
+    worker_thread.daemon = True
+    worker_thread.start()
+    logger.info("Email outbox worker started")
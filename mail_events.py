@@ -0,0 +1,59 @@
+"""
+Live mail notifications
+
+A per-process publish/subscribe hub for the /mail/events Server-Sent Events
+stream. Code that changes a user's mail publishes an event for that user, and
+every open stream of theirs in this process receives it. Streams in other
+worker processes don't see the event; they pick the change up when they
+re-check the unread counter every STREAM_RECHECK_INTERVAL seconds.
+"""
+import json
+import queue
+import threading
+
+# Stream settings
+STREAM_RECHECK_INTERVAL = 15    # Seconds between unread-counter checks (and keepalives)
+STREAM_MAX_AGE = 300            # Seconds before the server ends a stream; the browser reconnects
+STREAM_RETRY_MS = 5000          # Reconnect delay sent to the browser
+SUBSCRIBER_QUEUE_SIZE = 100     # Events buffered per stream before new ones are dropped
+
+# user_id -> set of subscriber queues. Under gunicorn's gevent worker the
+# queues and lock are monkey patched, so waiting streams only park greenlets.
+_subscribers = {}
+_lock = threading.Lock()
+
+def subscribe(user_id):
+    """Register a stream for a user; returns the queue its events arrive on"""
+    subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    with _lock:
+        _subscribers.setdefault(int(user_id), set()).add(subscriber)
+    return subscriber
+
+def unsubscribe(user_id, subscriber):
+    """Remove a stream's queue"""
+    with _lock:
+        subscribers = _subscribers.get(int(user_id))
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del _subscribers[int(user_id)]
+
+def publish(user_id, event, data=None):
+    """Send an event to every stream the user has open in this process"""
+    with _lock:
+        subscribers = list(_subscribers.get(int(user_id), ()))
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait((event, data))
+        except queue.Full:
+            # Stalled client; its next counter check catches it up
+            pass
+
+def subscriber_count():
+    """Number of open streams in this process"""
+    with _lock:
+        return sum(len(subscribers) for subscribers in _subscribers.values())
+
+def format_event(event, data):
+    """Format one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,173 @@
+"""
+Mail retention
+
+Moves read mail older than MAIL_RETENTION_DAYS out of the mail table into
+mail_archive, a small batch per write transaction so requests keep getting
+the write lock in between, then hands the freed pages back to the file
+system with incremental_vacuum. Scheduled daily by the backup scheduler,
+so only the worker holding the scheduler lease runs it.
+
+Databases created before auto_vacuum=INCREMENTAL was the default need a
+one-time full VACUUM to switch modes. That blocks every writer while it
+runs, so the scheduled job never does it; run
+`python mail_retention.py --enable-incremental-vacuum` during maintenance.
+Until then the freed pages stay in the file and are reused by new rows.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+
+import db_utils
+
+logger = logging.getLogger('mail_retention')
+
+# Retention settings
+MAIL_RETENTION_DAYS = int(os.environ.get('MAIL_RETENTION_DAYS', 180))  # 0 keeps mail forever
+MAIL_RETENTION_TIME = "04:00"   # Daily run time (after the 03:00 backup)
+MAIL_RETENTION_BATCH = 500      # Messages moved per transaction
+MAIL_RETENTION_PAUSE = 0.2      # Seconds between batches, so other writers get the lock
+MAIL_VACUUM_STEP = 1000         # Free pages released per incremental_vacuum call
+
+_retention_lock = threading.Lock()
+
+def archive_old_mail(days=None, batch_size=None, pause=None):
+    """Move read mail older than `days` into mail_archive; returns the number moved"""
+    days = MAIL_RETENTION_DAYS if days is None else days
+    batch_size = batch_size or MAIL_RETENTION_BATCH
+    pause = MAIL_RETENTION_PAUSE if pause is None else pause
+    if days <= 0:
+        return 0
+
+    moved = 0
+    while True:
+        with db_utils.write_transaction() as conn:
+            # Oldest first through idx_mail_sent_at; unread mail always stays
+            rows = conn.execute('''
+                SELECT id FROM mail
+                WHERE sent_at < datetime('now', ?) AND is_read = 1
+                ORDER BY sent_at
+                LIMIT ?
+            ''', (f'-{days} days', batch_size)).fetchall()
+            if not rows:
+                break
+
+            ids = json.dumps([row['id'] for row in rows])
+            conn.execute(f'''
+                INSERT INTO mail_archive ({db_utils.MAIL_COLUMNS})
+                SELECT {db_utils.MAIL_COLUMNS} FROM mail WHERE id IN (SELECT value FROM json_each(?))
+            ''', (ids,))
+            conn.execute('DELETE FROM mail WHERE id IN (SELECT value FROM json_each(?))', (ids,))
+        moved += len(rows)
+
+        if len(rows) < batch_size:
+            break
+        time.sleep(pause)
+
+    return moved
+
+def incremental_vacuum_enabled():
+    """Whether the database is in auto_vacuum=INCREMENTAL mode"""
+    conn = db_utils.get_db_connection()
+    try:
+        return conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    finally:
+        db_utils.close_connection(conn)
+
+@db_utils.retry_on_busy
+def enable_incremental_vacuum():
+    """Switch the database to auto_vacuum=INCREMENTAL if it isn't already
+
+    Changing the mode of an existing database needs one full VACUUM, which
+    holds the write lock while it rewrites the file, so this is an admin
+    step (see the CLI below), never part of the scheduled job. Returns True
+    if the database was converted.
+    """
+    if incremental_vacuum_enabled():
+        return False
+
+    conn = db_utils.get_db_connection()
+    try:
+
+        logger.info("Converting database to incremental auto-vacuum (one-time VACUUM)")
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        return True
+    finally:
+        db_utils.close_connection(conn)
+
+def reclaim_space(step=None, pause=None):
+    """Release the database's free pages to the file system; returns the pages released"""
+    step = step or MAIL_VACUUM_STEP
+    pause = MAIL_RETENTION_PAUSE if pause is None else pause
+
+    released = 0
+    while True:
+        with db_utils.write_transaction() as conn:
+            free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if not free_pages:
+                break
+            # incremental_vacuum frees one page per step of the statement,
+            # so its result rows have to be consumed for it to do the work
+            conn.execute(f'PRAGMA incremental_vacuum({min(step, free_pages)})').fetchall()
+            remaining = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if remaining >= free_pages:
+            # Not in incremental mode, nothing can be released this way
+            break
+        released += free_pages - remaining
+        time.sleep(pause)
+
+    return released
+
+def run_retention(days=None):
+    """Archive old mail and compact the database; returns (moved, pages_released)"""
+    if not _retention_lock.acquire(blocking=False):
+        logger.info("Mail retention already running, skipping")
+        return 0, 0
+
+    try:
+        start = time.time()
+        moved = archive_old_mail(days)
+        released = 0
+        if incremental_vacuum_enabled():
+            released = reclaim_space()
+        else:
+            logger.info("Database is not in incremental auto-vacuum mode, leaving freed pages "
+                        "for reuse (run mail_retention.py --enable-incremental-vacuum to convert)")
+        logger.info(f"Mail retention: {moved} messages archived, {released} pages released "
+                    f"in {time.time() - start:.1f}s")
+        return moved, released
+    finally:
+        _retention_lock.release()
+
+def start_retention():
+    """Run mail retention in a background thread (called by the scheduler)"""
+    def run():
+        try:
+            run_retention()
+        except Exception as e:
+            logger.error(f"Mail retention failed: {str(e)}")
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Archive old read mail and compact the database")
+    parser.add_argument("--days", type=int, default=None,
+                        help=f"Archive read mail older than this many days (default: {MAIL_RETENTION_DAYS})")
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="Convert the database to incremental auto-vacuum first "
+                             "(one full VACUUM that blocks writers; run during maintenance)")
+    args = parser.parse_args()
+
+    if args.enable_incremental_vacuum and enable_incremental_vacuum():
+        print("Database converted to incremental auto-vacuum")
+
+    moved, released = run_retention(args.days)
+    print(f"Archived {moved} messages, released {released} pages")
+    sys.exit(0)
@@ -1,6 +1,9 @@
 -- Galaxy-themed Minecraft Website Database Schema
 -- This schema includes all necessary tables with proper relationships and indexes for optimal performance
 
+-- Free pages are released in small steps by the mail retention job (must be set before any table exists)
+PRAGMA auto_vacuum = INCREMENTAL;
+
 -- Users Table - Stores user information
 CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -65,6 +68,7 @@ CREATE TABLE IF NOT EXISTS teams (
 -- Create indexes for team queries
 CREATE INDEX IF NOT EXISTS idx_teams_name ON teams(name);
 CREATE INDEX IF NOT EXISTS idx_teams_points ON teams(points DESC);
+CREATE INDEX IF NOT EXISTS idx_teams_points_page ON teams(COALESCE(points, 0) DESC, id);
 
 -- Team Members Table - Relationship between users and teams
 CREATE TABLE IF NOT EXISTS team_members (
@@ -100,12 +104,79 @@ CREATE TABLE IF NOT EXISTS mail (
     FOREIGN KEY (recipient_id) REFERENCES users(id) ON DELETE CASCADE
 );
 
--- Create indexes for mail queries
-CREATE INDEX IF NOT EXISTS idx_mail_sender_id ON mail(sender_id);
-CREATE INDEX IF NOT EXISTS idx_mail_recipient_id ON mail(recipient_id);
+-- Create indexes for mail queries (inbox and sent pages are read newest first by (sent_at, id))
+CREATE INDEX IF NOT EXISTS idx_mail_recipient_sent ON mail(recipient_id, sent_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_mail_sender_sent ON mail(sender_id, sent_at DESC, id DESC);
 CREATE INDEX IF NOT EXISTS idx_mail_is_read ON mail(is_read);
 CREATE INDEX IF NOT EXISTS idx_mail_sent_at ON mail(sent_at DESC);
 
+-- Mail Archive Table - Mail moved out of the inbox (same columns, original ids)
+CREATE TABLE IF NOT EXISTS mail_archive (
+    id INTEGER PRIMARY KEY,
+    sender_id INTEGER,
+    recipient_id INTEGER NOT NULL,
+    subject TEXT,
+    content TEXT,
+    is_read INTEGER DEFAULT 0,
+    mail_type TEXT DEFAULT 'message',
+    related_id INTEGER,
+    sent_at TIMESTAMP,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_mail_archive_recipient_sent ON mail_archive(recipient_id, sent_at DESC);
+
+-- Unread mail counter per user, kept up to date by the triggers below
+CREATE TABLE IF NOT EXISTS mail_unread_counts (
+    user_id INTEGER PRIMARY KEY,
+    unread INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER IF NOT EXISTS mail_unread_insert AFTER INSERT ON mail
+WHEN NEW.is_read = 0
+BEGIN
+    INSERT INTO mail_unread_counts (user_id, unread) VALUES (NEW.recipient_id, 1)
+    ON CONFLICT(user_id) DO UPDATE SET unread = unread + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS mail_unread_delete AFTER DELETE ON mail
+WHEN OLD.is_read = 0
+BEGIN
+    UPDATE mail_unread_counts SET unread = unread - 1 WHERE user_id = OLD.recipient_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS mail_unread_update_old AFTER UPDATE OF is_read, recipient_id ON mail
+WHEN OLD.is_read = 0
+BEGIN
+    UPDATE mail_unread_counts SET unread = unread - 1 WHERE user_id = OLD.recipient_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS mail_unread_update_new AFTER UPDATE OF is_read, recipient_id ON mail
+WHEN NEW.is_read = 0
+BEGIN
+    INSERT INTO mail_unread_counts (user_id, unread) VALUES (NEW.recipient_id, 1)
+    ON CONFLICT(user_id) DO UPDATE SET unread = unread + 1;
+END;
+
+-- Email Outbox Table - Emails queued with their mail, sent by a background worker
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    mail_id INTEGER,
+    recipient_email TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    body_html TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending', -- pending, sending, sent, failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    claimed_until REAL,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP,
+    FOREIGN KEY (mail_id) REFERENCES mail(id) ON DELETE SET NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox(status, next_attempt_at);
+
 -- Competitions Table - For team competitions
 CREATE TABLE IF NOT EXISTS competitions (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -270,6 +341,26 @@ CREATE TABLE IF NOT EXISTS user_skills (
     UNIQUE(user_id, skill_type_id)
 );
 
+-- Materialized skill leaderboard - one row per ranked user skill, maintained by TierManager
+CREATE TABLE IF NOT EXISTS skill_leaderboard (
+    skill_type_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    tier_id INTEGER NOT NULL,
+    tier_value INTEGER NOT NULL,  -- LT1-LT5 = 1-5, HT1-HT5 = 6-10
+    PRIMARY KEY (skill_type_id, user_id)
+);
+
+-- Create index for leaderboard top-N and rank queries
+CREATE INDEX IF NOT EXISTS idx_skill_leaderboard_rank ON skill_leaderboard(skill_type_id, tier_value DESC, username);
+CREATE INDEX IF NOT EXISTS idx_skill_leaderboard_user ON skill_leaderboard(user_id);
+
+-- One-off data migrations that have been applied (see db_utils.run_migration_once)
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    name TEXT PRIMARY KEY,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Insert default tiers
 INSERT OR IGNORE INTO tiers (tier_name, display_name, description, color_class, category, level) VALUES
 ('LT1', 'Lower Tier 1', 'Beginner', 'lt1', 'LT', 1),
@@ -0,0 +1,83 @@
+// Live mail notifications
+//
+// Keeps the Mail badge up to date from the /mail/events stream and shows a
+// short notice for new team invitations. Falls back to polling the unread
+// count when the browser has no EventSource or the stream keeps failing.
+
+(function () {
+    const script = document.currentScript;
+    const eventsUrl = script.dataset.eventsUrl;
+    const countUrl = script.dataset.countUrl;
+    const inboxUrl = script.dataset.inboxUrl;
+
+    const POLL_INTERVAL = 30000;   // Fallback poll every 30 seconds
+    const MAX_STREAM_ERRORS = 3;   // Errors in a row before switching to polling
+
+    // Show the count on every link to the inbox (adding or removing the badge)
+    function updateBadges(count) {
+        document.querySelectorAll(`a[href="${inboxUrl}"]`).forEach(link => {
+            let badge = link.querySelector('.mail-badge');
+            if (count > 0) {
+                if (!badge) {
+                    badge = document.createElement('span');
+                    badge.className = 'mail-badge';
+                    link.appendChild(badge);
+                }
+                badge.textContent = count;
+            } else if (badge) {
+                badge.remove();
+            }
+        });
+    }
+
+    function showInviteNotice(invite) {
+        const notice = document.createElement('a');
+        notice.className = 'mail-notice';
+        notice.href = inboxUrl;
+        notice.innerHTML = '<i class="fas fa-users"></i> ';
+        notice.appendChild(document.createTextNode(
+            `${invite.sender} invited you to join ${invite.team_name}`));
+        document.body.appendChild(notice);
+        setTimeout(() => notice.remove(), 8000);
+    }
+
+    function startPolling() {
+        const poll = () => {
+            fetch(countUrl, { credentials: 'same-origin' })
+                .then(response => response.ok ? response.json() : null)
+                .then(data => { if (data) updateBadges(data.count); })
+                .catch(() => {});
+        };
+        poll();
+        setInterval(poll, POLL_INTERVAL);
+    }
+
+    function startStream() {
+        const source = new EventSource(eventsUrl);
+        let errors = 0;
+
+        source.addEventListener('unread', event => {
+            errors = 0;
+            updateBadges(JSON.parse(event.data).count);
+        });
+        source.addEventListener('invite', event => {
+            showInviteNotice(JSON.parse(event.data));
+        });
+        source.addEventListener('open', () => { errors = 0; });
+        source.addEventListener('error', () => {
+            // The server ends streams every few minutes and the browser
+            // reconnects; only give up if reconnecting keeps failing
+            errors += 1;
+            if (errors >= MAX_STREAM_ERRORS) {
+                source.close();
+                startPolling();
+            }
+        });
+    }
+
+    if (!eventsUrl || !window.EventSource) {
+        startPolling();
+    } else {
+        startStream();
+    }
+})();
@@ -1,6 +1,19 @@
 import os
 import sys
+import shutil
 import sqlite3
+import subprocess
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+import db_backup
+import db_utils
+import mail_retention
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
 
 def test_database_access():
     """Test that the application can access the database"""
@@ -58,6 +71,420 @@ def test_database_access():
         print(f"Database access test failed: {str(e)}")
         return False
 
+def run_in_app_copy(tmp_path, code):
+    """Run Python code next to a copy of the app, so it gets its own (empty) data and instance dirs"""
+    pytest.importorskip('flask')
+    pytest.importorskip('schedule')
+
+    for name in os.listdir(APP_ROOT):
+        source = os.path.join(APP_ROOT, name)
+        if name.endswith('.py') or name == 'schema.sql':
+            shutil.copy(source, tmp_path / name)
+        elif name in ('templates', 'static'):
+            shutil.copytree(source, tmp_path / name)
+
+    env = dict(os.environ)
+    env.pop('RENDER', None)
+    result = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=tmp_path, env=env, capture_output=True, text=True, timeout=60
+    )
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+def test_app_starts_on_empty_data_dir(tmp_path):
+    """The app imports and creates its schema when the data directory is empty"""
+    run_in_app_copy(tmp_path, 'import app')
+
+    conn = sqlite3.connect(tmp_path / 'data' / 'cosmic_teams.db')
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    conn.close()
+    assert {'users', 'mail', 'skill_leaderboard', 'mail_unread_counts'} <= tables
+
+def create_test_db(tmp_path, monkeypatch, users=3):
+    """Point db_utils at a new database built from schema.sql with a few users"""
+    db_utils.clear_pool()
+    monkeypatch.setattr(db_utils, 'DB_PATH', str(tmp_path / 'test.db'))
+    conn = db_utils.get_db_connection()
+    with open(os.path.join(APP_ROOT, 'schema.sql')) as f:
+        conn.executescript(f.read())
+    conn.executemany('INSERT INTO users (id, username, email, password) VALUES (?, ?, ?, ?)',
+                     [(i, f'user{i}', f'user{i}@example.com', 'x') for i in range(1, users + 1)])
+    conn.commit()
+    db_utils.close_connection(conn)
+    return db_utils.DB_PATH
+
+def test_mail_retention_archives_old_read_mail(tmp_path, monkeypatch):
+    """Old read mail moves to mail_archive in batches; without incremental vacuum nothing is compacted"""
+    create_test_db(tmp_path, monkeypatch)
+    try:
+        conn = db_utils.get_db_connection()
+        old = [(1, 2, 'old', 'x' * 500, 1, '2020-01-01 00:00:00')] * 25
+        conn.executemany('''
+            INSERT INTO mail (sender_id, recipient_id, subject, content, is_read, sent_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', old + [(1, 2, 'old unread', '', 0, '2020-01-01 00:00:00'),
+                    (1, 2, 'new read', '', 1, '2999-01-01 00:00:00')])
+        conn.commit()
+        # An older database, created before incremental auto-vacuum was the default
+        conn.execute('PRAGMA auto_vacuum = NONE')
+        conn.execute('VACUUM')
+        db_utils.close_connection(conn)
+
+        assert mail_retention.archive_old_mail(days=30, batch_size=10, pause=0) == 25
+        assert mail_retention.run_retention(days=30) == (0, 0)
+        assert not mail_retention.incremental_vacuum_enabled()
+
+        conn = db_utils.get_db_connection()
+        remaining = [row['subject'] for row in conn.execute('SELECT subject FROM mail ORDER BY id')]
+        archived = conn.execute("SELECT COUNT(*) FROM mail_archive WHERE subject = 'old'").fetchone()[0]
+        db_utils.close_connection(conn)
+        assert remaining == ['old unread', 'new read']
+        assert archived == 25
+
+        # The explicit conversion makes the freed pages reclaimable
+        assert mail_retention.enable_incremental_vacuum()
+        assert mail_retention.incremental_vacuum_enabled()
+    finally:
+        db_utils.clear_pool()
+
+def test_sql_statement_splitting():
+    """Semicolons in literals, quoted names, comments and trigger bodies don't split statements"""
+    script = [
+        "-- a comment; not a statement\n",
+        "CREATE TABLE \"odd;name\" (id INTEGER, body TEXT);\n",
+        "INSERT INTO \"odd;name\" VALUES(1,'a;b '' c;\n",
+        "still inside; the string');INSERT INTO \"odd;name\" VALUES(2,'&amp;');\n",
+        "/* block; comment */ CREATE TRIGGER t AFTER INSERT ON \"odd;name\" BEGIN\n",
+        "  UPDATE \"odd;name\" SET body = body || ';' WHERE id = new.id;\n",
+        "END;\n",
+    ]
+    statements = list(db_backup.iter_sql_statements(script))
+    assert len(statements) == 4
+    assert statements[0].endswith('CREATE TABLE "odd;name" (id INTEGER, body TEXT);')
+    assert statements[1] == "INSERT INTO \"odd;name\" VALUES(1,'a;b '' c;\nstill inside; the string');"
+    assert statements[3].startswith('/* block; comment */ CREATE TRIGGER') and statements[3].endswith('END;')
+
+def test_sql_dump_round_trip(tmp_path):
+    """A streamed SQL dump restores to the same tables, rows and triggers"""
+    source = str(tmp_path / 'source.db')
+    conn = sqlite3.connect(source)
+    conn.executescript('''
+        CREATE TABLE mail (id INTEGER PRIMARY KEY AUTOINCREMENT, subject TEXT, content TEXT, data BLOB, score REAL);
+        CREATE INDEX idx_mail_subject ON mail(subject);
+        CREATE TABLE counts (n INTEGER);
+        INSERT INTO counts VALUES (0);
+        CREATE TRIGGER mail_count AFTER INSERT ON mail BEGIN UPDATE counts SET n = n + 1; END;
+    ''')
+    conn.executemany('INSERT INTO mail (subject, content, data, score) VALUES (?, ?, ?, ?)', [
+        ('hi; there', "<p style='color: red; margin: 0'>&amp;&lt;</p>\n-- not a comment", b'\x00\x01;', 1.5),
+        ("it's", None, None, None),
+    ] * 50)
+    conn.commit()
+    conn.close()
+
+    dump_path = str(tmp_path / 'dump.sql.gz')
+    with open(dump_path, 'wb') as f:
+        for chunk in db_backup.iter_dump_chunks(source, compress=True):
+            f.write(chunk)
+
+    restored = str(tmp_path / 'restored.db')
+    executed, failed = db_backup.restore_sql_dump(dump_path, restored)
+    assert failed == 0 and executed > 100
+
+    def contents(path):
+        conn = sqlite3.connect(path)
+        rows = conn.execute('SELECT * FROM mail ORDER BY id').fetchall()
+        schema = conn.execute("SELECT type, name FROM sqlite_master ORDER BY name").fetchall()
+        conn.execute("INSERT INTO mail (subject) VALUES ('trigger check')")
+        count = conn.execute('SELECT n FROM counts').fetchone()[0]
+        conn.close()
+        return rows, schema, count
+
+    assert contents(restored) == contents(source)
+
+def test_bulk_mail_actions_keep_unread_counters(tmp_path, monkeypatch):
+    """Bulk actions respect ownership, and the triggers keep every affected unread counter right"""
+    create_test_db(tmp_path, monkeypatch)
+    try:
+        ids = {}
+        for key, sender, recipient in [('a', 1, 2), ('b', 1, 2), ('c', 1, 3), ('d', 2, 1)]:
+            ids[key] = db_utils.send_mail(sender, recipient, key, 'body')
+        assert [db_utils.get_unread_mail_count(user) for user in (1, 2, 3)] == [1, 2, 1]
+
+        # Other users' IDs are ignored
+        assert db_utils.bulk_mail_action(3, 'read', [ids['a'], ids['b']]) == (0, [])
+        assert db_utils.bulk_mail_action(2, 'read', [ids['a']]) == (1, [2])
+        assert db_utils.bulk_mail_action(2, 'archive', [ids['a'], ids['b']]) == (2, [2])
+        assert db_utils.get_unread_mail_count(2) == 0
+
+        # Deleting unread sent mail changes the recipient's count
+        assert db_utils.bulk_mail_action(1, 'delete', folder='sent') == (1, [3])
+        assert [db_utils.get_unread_mail_count(user) for user in (1, 2, 3)] == [1, 0, 0]
+
+        conn = db_utils.get_db_connection()
+        archived = [row['subject'] for row in conn.execute('SELECT subject FROM mail_archive ORDER BY id')]
+        recount = conn.execute('''
+            SELECT COUNT(*) FROM mail WHERE is_read = 0 AND recipient_id = 1
+        ''').fetchone()[0]
+        db_utils.close_connection(conn)
+        assert archived == ['a', 'b']
+        assert recount == 1
+    finally:
+        db_utils.clear_pool()
+
+def test_bulk_mail_route_and_archive_view(tmp_path):
+    """/mail/bulk only takes a list of ints, and archived mail shows up under /mail/archive"""
+    output = run_in_app_copy(tmp_path, """
+import app, db_utils
+conn = db_utils.get_db_connection()
+conn.executemany("INSERT INTO users (id, username, email, password) VALUES (?, ?, ?, 'x')",
+                 [(1, 'ann', 'ann@example.com'), (2, 'bo', 'bo@example.com')])
+conn.commit()
+db_utils.close_connection(conn)
+first = db_utils.send_mail(2, 1, 'first message', 'hello')
+second = db_utils.send_mail(2, 1, 'second message', 'hello again')
+
+client = app.app.test_client()
+with client.session_transaction() as session:
+    session['user_id'] = 1
+bad = client.post('/mail/bulk', json={'action': 'archive', 'mail_ids': str(first)})
+good = client.post('/mail/bulk', json={'action': 'archive', 'mail_ids': [first]})
+archive = client.get('/mail/archive').get_data(as_text=True)
+inbox = client.get('/mail').get_data(as_text=True)
+archived_view = client.get(f'/mail/archive/{first}').get_data(as_text=True)
+print(bad.status_code, good.get_json()['count'],
+      'first message' in archive, 'first message' in inbox, 'second message' in inbox,
+      'hello' in archived_view)
+""")
+    assert output.splitlines()[-1].split() == ['400', '1', 'True', 'False', 'True', 'True']
+
+def test_teams_pages_include_null_points(tmp_path):
+    """Walking the teams cursors visits every team once, NULL points sorting as 0"""
+    output = run_in_app_copy(tmp_path, """
+import app, db_utils
+conn = db_utils.get_db_connection()
+conn.executemany('INSERT INTO teams (id, name, points) VALUES (?, ?, ?)',
+                 [(i, f'team{i}', None if i == 7 else i % 4) for i in range(1, app.TEAMS_PER_PAGE + 10)])
+conn.commit()
+db_utils.close_connection(conn)
+
+seen, after, pages = [], None, 0
+with app.app.test_request_context():
+    while True:
+        teams, next_cursor = app.get_teams_page(after)
+        seen.extend((team['points'], team['id']) for team in teams)
+        pages += 1
+        if not next_cursor:
+            break
+        after = app.parse_teams_cursor(next_cursor)
+        assert after is not None
+print(pages, seen == sorted(seen, key=lambda row: (-row[0], row[1])),
+      len(seen) == len(set(seen)) == app.TEAMS_PER_PAGE + 9, (0, 7) in seen)
+""")
+    assert output.splitlines()[-1].split() == ['2', 'True', 'True', 'True']
+
+def test_unread_counters_follow_mail_changes(tmp_path, monkeypatch):
+    """Counters are backfilled for existing mail and kept equal to a recount by the triggers"""
+    create_test_db(tmp_path, monkeypatch)
+    try:
+        # A database from before the counters: mail already there, no triggers
+        conn = db_utils.get_db_connection()
+        conn.executescript('''
+            DROP TRIGGER mail_unread_insert;
+            DROP TRIGGER mail_unread_delete;
+            DROP TRIGGER mail_unread_update_old;
+            DROP TRIGGER mail_unread_update_new;
+            DROP TABLE mail_unread_counts;
+        ''')
+        conn.executemany('INSERT INTO mail (sender_id, recipient_id, subject, is_read) VALUES (?, ?, ?, ?)',
+                         [(1, 2, 'a', 0), (1, 2, 'b', 0), (1, 3, 'c', 1)])
+        conn.commit()
+        db_utils.close_connection(conn)
+
+        assert db_utils.initialize_mail_schema()
+        assert db_utils.get_unread_mail_count(2) == 2
+
+        db_utils.send_mail(2, 3, 'd', 'body')
+        with db_utils.write_transaction() as conn:
+            conn.execute("UPDATE mail SET is_read = 1 WHERE subject = 'a'")
+            conn.execute("UPDATE mail SET recipient_id = 1 WHERE subject = 'b'")
+            conn.execute("UPDATE mail SET is_read = 0 WHERE subject = 'c'")
+            conn.execute("DELETE FROM mail WHERE subject = 'd'")
+
+        conn = db_utils.get_db_connection()
+        recount = dict(conn.execute(
+            'SELECT recipient_id, COUNT(*) FROM mail WHERE is_read = 0 GROUP BY recipient_id').fetchall())
+        db_utils.close_connection(conn)
+        assert recount == {1: 1, 3: 1}
+        assert [db_utils.get_unread_mail_count(user) for user in (1, 2, 3)] == [1, 0, 1]
+    finally:
+        db_utils.clear_pool()
+
+def test_nested_write_transactions_share_one_commit(tmp_path, monkeypatch):
+    """Helpers called inside write_transaction join it instead of waiting on their own lock"""
+    create_test_db(tmp_path, monkeypatch)
+    try:
+        with pytest.raises(RuntimeError):
+            with db_utils.write_transaction() as conn:
+                conn.execute("UPDATE users SET bio = 'changed' WHERE id = 1")
+                assert db_utils.add_star_points(1, 60)
+                db_utils.log_user_activity(1, 'test')
+                raise RuntimeError('abort')
+
+        with db_utils.write_transaction() as conn:
+            assert db_utils.add_star_points(2, 60)
+            db_utils.log_user_activity(2, 'test')
+
+        conn = db_utils.get_db_connection()
+        users = conn.execute('SELECT id, star_points, galaxy_rank FROM users ORDER BY id').fetchall()
+        logged = [row[0] for row in conn.execute('SELECT user_id FROM user_activity')]
+        db_utils.close_connection(conn)
+        assert [tuple(row) for row in users[:2]] == [(1, 0, 'Novice Explorer'), (2, 60, 'Space Explorer')]
+        assert logged == [2]
+    finally:
+        db_utils.clear_pool()
+
+def use_backup_dir(tmp_path, monkeypatch, db_path):
+    """Point db_backup at db_path and keep every backup file under tmp_path"""
+    backup_dir = str(tmp_path / 'backups')
+    monkeypatch.setattr(db_backup, 'DB_PATH', db_path)
+    monkeypatch.setattr(db_backup, 'BACKUP_DIR', backup_dir)
+    monkeypatch.setattr(db_backup, 'CHUNK_STORE_DIR', os.path.join(backup_dir, 'chunks'))
+    monkeypatch.setattr(db_backup, 'CATALOG_DB_PATH', os.path.join(backup_dir, 'catalog.db'))
+    monkeypatch.setattr(db_backup, 'WAL_ARCHIVE_DIR', os.path.join(backup_dir, 'wal'))
+    monkeypatch.setattr(db_backup, 'BACKUP_RATE_LIMIT', 0)
+    monkeypatch.setattr(db_backup, 'BACKUP_STEP_SLEEP', 0)
+
+def test_incremental_backup_round_trip(tmp_path, monkeypatch):
+    """A second backup stores only the changed chunks, and both rebuild byte for byte"""
+    db_path = str(tmp_path / 'live.db')
+    use_backup_dir(tmp_path, monkeypatch, db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE files (id INTEGER PRIMARY KEY, data BLOB)')
+    conn.executemany('INSERT INTO files (data) VALUES (?)', [(os.urandom(8000),) for _ in range(100)])
+    conn.commit()
+
+    ok, first = db_backup.create_incremental_backup('manual')
+    assert ok
+    conn.execute('UPDATE files SET data = ? WHERE id = 1', (os.urandom(8000),))
+    conn.commit()
+    conn.close()
+    ok, second = db_backup.create_incremental_backup('daily')
+    assert ok
+
+    first_manifest = db_backup.read_manifest(first)
+    second_manifest = db_backup.read_manifest(second)
+    assert first_manifest['new_chunks'] == len(set(first_manifest['chunks']))
+    assert 0 < second_manifest['new_chunks'] < len(second_manifest['chunks']) // 4
+
+    for manifest_path, expected_first_row in ((first, False), (second, True)):
+        rebuilt = str(tmp_path / 'rebuilt.db')
+        db_backup.rebuild_from_manifest(manifest_path, rebuilt)
+        conn = sqlite3.connect(rebuilt)
+        rows = conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        first_row = conn.execute('SELECT data FROM files WHERE id = 1').fetchone()[0]
+        conn.close()
+        live = sqlite3.connect(db_path)
+        live_first_row = live.execute('SELECT data FROM files WHERE id = 1').fetchone()[0]
+        live.close()
+        assert rows == 100
+        assert (first_row == live_first_row) == expected_first_row
+        os.remove(rebuilt)
+
+    # A damaged chunk is caught instead of producing a bad database
+    chunk_path = db_backup._chunk_path(second_manifest['chunks'][0])
+    with open(chunk_path, 'wb') as f:
+        f.write(db_backup.compress_chunk(b'not the original chunk'))
+    with pytest.raises(ValueError):
+        db_backup.rebuild_from_manifest(second, str(tmp_path / 'rebuilt.db'))
+    assert not os.path.exists(tmp_path / 'rebuilt.db')
+
+def test_wal_point_in_time_rebuild(tmp_path, monkeypatch):
+    """Replaying archived WAL segments rebuilds the database as of a chosen time"""
+    db_path = str(tmp_path / 'live.db')
+    use_backup_dir(tmp_path, monkeypatch, db_path)
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA wal_autocheckpoint = 0')
+    conn.execute('CREATE TABLE events (name TEXT)')
+    try:
+        db_backup.archive_wal()  # Base snapshot
+        conn.execute("INSERT INTO events VALUES ('first')")
+        assert db_backup.archive_wal()
+        time.sleep(0.05)
+        between = datetime.now()
+        time.sleep(0.05)
+        conn.execute("INSERT INTO events VALUES ('second')")
+        assert db_backup.archive_wal()
+
+        def events_at(target):
+            rebuilt = str(tmp_path / 'pitr.db')
+            db_backup.build_point_in_time(target, rebuilt)
+            check = sqlite3.connect(rebuilt)
+            names = [row[0] for row in check.execute('SELECT name FROM events ORDER BY rowid')]
+            check.close()
+            db_backup.remove_database_files(rebuilt)
+            return names
+
+        assert events_at(between) == ['first']
+        assert events_at(datetime.now()) == ['first', 'second']
+        with pytest.raises(ValueError):
+            events_at(datetime(2000, 1, 1))
+    finally:
+        with db_backup._wal_lock:
+            db_backup._close_wal_archiver()
+        conn.close()
+
+def test_install_database_drains_and_bumps_generation(tmp_path, monkeypatch):
+    """Installing a restored database drains the workers, bumps the generation and reopens connections"""
+    db_path = create_test_db(tmp_path, monkeypatch)
+    use_backup_dir(tmp_path, monkeypatch, db_path)
+    monkeypatch.setattr(db_backup, 'RESTORE_DRAIN_GRACE', 0.3)
+    try:
+        db_utils.check_generation()
+        generation, _ = db_utils._read_generation()
+
+        # A database without the app's tables is refused before anything is drained
+        bad_path = str(tmp_path / 'bad.db')
+        sqlite3.connect(bad_path).close()
+        with pytest.raises(ValueError):
+            db_backup.install_database(bad_path)
+        assert db_utils._read_generation() == (generation, False)
+        assert not os.path.exists(bad_path)
+
+        # The replacement: same schema, different users
+        new_path = str(tmp_path / 'new.db')
+        conn = sqlite3.connect(new_path)
+        with open(os.path.join(APP_ROOT, 'schema.sql')) as f:
+            conn.executescript(f.read())
+        conn.execute("INSERT INTO users (id, username, email, password) VALUES (9, 'restored', 'r@example.com', 'x')")
+        conn.commit()
+        conn.close()
+
+        # Leave an idle pooled connection on the old contents
+        pooled = db_utils.get_db_connection()
+        assert pooled.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 3
+        db_utils.close_connection(pooled)
+
+        seen_draining = []
+        installer = threading.Thread(target=db_backup.install_database, args=(new_path,))
+        installer.start()
+        while installer.is_alive():
+            seen_draining.append(db_utils._read_generation()[1])
+            time.sleep(0.01)
+        installer.join()
+
+        assert True in seen_draining
+        assert db_utils._read_generation() == (generation + 1, False)
+        assert not os.path.exists(new_path)
+        conn = db_utils.get_db_connection()
+        users = [row['username'] for row in conn.execute('SELECT username FROM users')]
+        db_utils.close_connection(conn)
+        assert users == ['restored']
+    finally:
+        db_utils.clear_pool()
+
 if __name__ == '__main__':
     success = test_database_access()
     sys.exit(0 if success else 1) 
\ No newline at end of file
@@ -0,0 +1,212 @@
+import os
+import socket
+import socketserver
+import threading
+import time
+
+import db_utils
+import email_outbox
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """Minimal local SMTP server that records what it receives"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.connections = 0
+        self.messages = []  # (recipients, data)
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        self.server.connections += 1
+        recipients = []
+        self.reply('220 localhost stand-in')
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif command == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                # Addresses containing "reject" are refused permanently
+                if 'reject' in line:
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(line.split(':', 1)[1].strip('<> '))
+                    self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    data_line = self.rfile.readline().decode()
+                    if data_line in ('.\r\n', ''):
+                        break
+                    data.append(data_line)
+                self.server.messages.append((recipients, ''.join(data)))
+                self.reply('250 OK')
+            elif command in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+def setup_outbox(tmp_path, monkeypatch, port):
+    """Point the outbox at a fresh database and the given SMTP port"""
+    db_utils.clear_pool()
+    monkeypatch.setattr(db_utils, 'DB_PATH', str(tmp_path / 'test.db'))
+    monkeypatch.setattr(email_outbox, 'SMTP_SERVER', '127.0.0.1')
+    monkeypatch.setattr(email_outbox, 'SMTP_PORT', port)
+    monkeypatch.setattr(email_outbox, 'SMTP_STARTTLS', False)
+    monkeypatch.setattr(email_outbox, 'SMTP_USERNAME', '')
+    email_outbox.initialize_tables()
+
+def queue_emails(addresses):
+    with db_utils.write_transaction() as conn:
+        cursor = conn.cursor()
+        for address in addresses:
+            email_outbox.enqueue_email(cursor, address, 'Team Invitation', '<p>Hello</p>')
+
+def outbox_rows():
+    conn = db_utils.get_db_connection()
+    rows = conn.execute('SELECT * FROM email_outbox ORDER BY id').fetchall()
+    db_utils.close_connection(conn)
+    return rows
+
+def test_outbox_sends_batch_over_one_connection(tmp_path, monkeypatch):
+    """Queued emails are delivered in one SMTP session; refused addresses fail permanently"""
+    server = SMTPStandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        setup_outbox(tmp_path, monkeypatch, server.server_address[1])
+        queue_emails(['a@example.com', 'reject@example.com', 'b@example.com'])
+
+        assert email_outbox.process_outbox() == (2, 0, 1)
+        assert server.connections == 1
+        assert [recipients for recipients, _ in server.messages] == [['a@example.com'], ['b@example.com']]
+
+        rows = outbox_rows()
+        assert [row['status'] for row in rows] == ['sent', 'failed', 'sent']
+        assert rows[0]['sent_at'] is not None
+        assert '550' in rows[1]['last_error']
+
+        # Nothing is left to send
+        assert email_outbox.process_outbox() == (0, 0, 0)
+    finally:
+        server.shutdown()
+        server.server_close()
+        db_utils.clear_pool()
+
+def test_outbox_retries_when_server_is_down(tmp_path, monkeypatch):
+    """Unreachable SMTP server leaves emails pending with a backoff"""
+    # Reserve a port with nothing listening on it
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    try:
+        setup_outbox(tmp_path, monkeypatch, port)
+        queue_emails(['a@example.com'])
+
+        assert email_outbox.process_outbox() == (0, 1, 0)
+        row = outbox_rows()[0]
+        assert row['status'] == 'pending'
+        assert row['attempts'] == 1
+        assert row['next_attempt_at'] > time.time()
+    finally:
+        db_utils.clear_pool()
+
+def test_bulk_invitations_render_and_queue(tmp_path, monkeypatch):
+    """Bulk invites write one mail and one outbox row per known recipient"""
+    db_utils.clear_pool()
+    db_path = str(tmp_path / 'test.db')
+    monkeypatch.setattr(db_utils, 'DB_PATH', db_path)
+    conn = db_utils.get_db_connection()
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')) as f:
+        conn.executescript(f.read())
+    conn.executemany('INSERT INTO users (id, username, email, password) VALUES (?, ?, ?, ?)', [
+        (1, 'leader', 'leader@example.com', 'x'),
+        (2, 'alice', 'alice@example.com', 'x'),
+        (3, 'bob <b>', 'bob@example.com', 'x'),
+    ])
+    conn.execute("INSERT INTO teams (id, name, description) VALUES (1, 'Rockets', 'We fly')")
+    conn.commit()
+    db_utils.close_connection(conn)
+
+    try:
+        mail_ids = email_outbox.send_team_invitations(1, [2, 3, 3, 99], 1)
+        assert sorted(mail_ids) == [2, 3]
+
+        conn = db_utils.get_db_connection()
+        mail = conn.execute('SELECT * FROM mail WHERE id = ?', (mail_ids[3],)).fetchone()
+        assert mail['mail_type'] == 'team_invite'
+        assert 'Hello bob <b>,' in mail['content']
+
+        emails = conn.execute('SELECT * FROM email_outbox ORDER BY id').fetchall()
+        db_utils.close_connection(conn)
+        assert [email['mail_id'] for email in emails] == [mail_ids[2], mail_ids[3]]
+        assert emails[1]['subject'] == 'Team Invitation: Rockets'
+        assert 'Hello bob &lt;b&gt;,' in emails[1]['body_html']
+    finally:
+        db_utils.clear_pool()
+
+def test_outbox_backs_off_when_a_message_cannot_be_built(tmp_path, monkeypatch):
+    """A non-SMTP error for one email reschedules it instead of leaving it claimed"""
+    server = SMTPStandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        setup_outbox(tmp_path, monkeypatch, server.server_address[1])
+        queue_emails(['a@example.com', 'broken@example.com'])
+
+        build_message = email_outbox.build_message
+        def broken_build_message(email):
+            if email['recipient_email'] == 'broken@example.com':
+                raise ValueError('bad template')
+            return build_message(email)
+        monkeypatch.setattr(email_outbox, 'build_message', broken_build_message)
+
+        assert email_outbox.process_outbox() == (1, 1, 0)
+        rows = outbox_rows()
+        assert [row['status'] for row in rows] == ['sent', 'pending']
+        assert rows[1]['last_error'] == 'bad template'
+        assert rows[1]['claimed_until'] is None
+
+        # Out of attempts: the same error fails it for good
+        conn = db_utils.get_db_connection()
+        conn.execute('UPDATE email_outbox SET next_attempt_at = 0, attempts = ? WHERE id = ?',
+                     (email_outbox.OUTBOX_MAX_ATTEMPTS - 1, rows[1]['id']))
+        conn.commit()
+        db_utils.close_connection(conn)
+        assert email_outbox.process_outbox() == (0, 0, 1)
+        assert outbox_rows()[1]['status'] == 'failed'
+    finally:
+        server.shutdown()
+        server.server_close()
+        db_utils.clear_pool()
+
+def test_outbox_poll_skips_write_lock_when_idle(tmp_path, monkeypatch):
+    """Polling an outbox with nothing due never opens a write transaction"""
+    try:
+        setup_outbox(tmp_path, monkeypatch, 1)
+        queue_emails(['later@example.com'])
+        conn = db_utils.get_db_connection()
+        conn.execute('UPDATE email_outbox SET next_attempt_at = ?', (time.time() + 3600,))
+        conn.commit()
+        db_utils.close_connection(conn)
+
+        def no_writes():
+            raise AssertionError('write transaction opened')
+        monkeypatch.setattr(db_utils, 'write_transaction', no_writes)
+        assert email_outbox.claim_batch() == []
+    finally:
+        db_utils.clear_pool()
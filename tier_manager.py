@@ -2,6 +2,8 @@ import sqlite3
 from datetime import datetime
 import os
 
+import db_utils
+
 # Use the same path determination as app.py
 is_render = os.environ.get('RENDER') == 'true'
 if is_render:
@@ -15,15 +17,26 @@ os.makedirs(DB_DIR, exist_ok=True)
 
 DB_PATH = os.path.join(DB_DIR, 'cosmic_teams.db')
 
+# Numeric ordering of tiers: LT1-LT5 -> 1-5, HT1-HT5 -> 6-10
+TIER_VALUE_SQL = "CASE WHEN t.category = 'HT' THEN t.level + 5 ELSE t.level END"
+
+# Legacy per-skill tier columns on the users table
+LEGACY_TIER_COLUMNS = {
+    'npot': 'npot_tier',
+    'uhc': 'uhc_tier',
+    'cpvp': 'cpvp_tier',
+    'sword': 'sword_tier',
+    'axe': 'axe_tier',
+    'smp': 'smp_tier'
+}
+
 class TierManager:
     """Class to manage user skill tiers"""
     
     @staticmethod
     def get_db_connection():
-        """Get a database connection with row factory"""
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        return conn
+        """Get a database connection with row factory (pooled, shared per request)"""
+        return db_utils.get_db_connection()
     
     @staticmethod
     def initialize_tables():
@@ -115,68 +128,113 @@ class TierManager:
                 )
             ''')
         
-        conn.commit()
-        conn.close()
-    
-    @staticmethod
-    def migrate_existing_user_tiers():
-        """Migrate existing user tier data to the new table structure"""
-        conn = TierManager.get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get all users with tier data
+        # Materialized ranking of ranked user skills, kept in sync by
+        # update_user_skill and migrate_existing_user_tiers
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS skill_leaderboard (
+                skill_type_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                tier_id INTEGER NOT NULL,
+                tier_value INTEGER NOT NULL,
+                PRIMARY KEY (skill_type_id, user_id)
+            )
+        ''')
+        # Top-N and rank lookups become index range scans
         cursor.execute('''
-            SELECT id, npot_tier, uhc_tier, cpvp_tier, sword_tier, axe_tier, smp_tier 
-            FROM users
+            CREATE INDEX IF NOT EXISTS idx_skill_leaderboard_rank
+            ON skill_leaderboard(skill_type_id, tier_value DESC, username)
         ''')
-        users = cursor.fetchall()
         
-        # Get skill type IDs
-        cursor.execute('SELECT id, skill_code FROM skill_types')
-        skill_types = {row['skill_code']: row['id'] for row in cursor.fetchall()}
-        
-        # Get tier IDs
-        cursor.execute('SELECT id, tier_name FROM tiers')
-        tiers = {row['tier_name']: row['id'] for row in cursor.fetchall()}
+        # Backfill if the table is new (or was created empty by schema.sql).
+        # On a fresh database this runs before init_db has created users;
+        # there is nothing to rank yet, so the backfill waits for a later start
+        cursor.execute('SELECT 1 FROM skill_leaderboard LIMIT 1')
+        if not cursor.fetchone():
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
+            if cursor.fetchone():
+                TierManager.rebuild_leaderboard(cursor)
         
-        # Migrate each user's tier data
-        for user in users:
-            user_id = user['id']
-            
-            skill_mappings = [
-                ('npot', user['npot_tier']),
-                ('uhc', user['uhc_tier']),
-                ('cpvp', user['cpvp_tier']),
-                ('sword', user['sword_tier']),
-                ('axe', user['axe_tier']),
-                ('smp', user['smp_tier'])
-            ]
-            
-            for skill_code, tier_name in skill_mappings:
-                if tier_name and skill_code in skill_types and tier_name in tiers:
-                    # Check if entry already exists
-                    cursor.execute('''
-                        SELECT id FROM user_skills 
-                        WHERE user_id = ? AND skill_type_id = ?
-                    ''', (user_id, skill_types[skill_code]))
-                    
-                    if cursor.fetchone():
-                        # Update existing entry
-                        cursor.execute('''
-                            UPDATE user_skills 
-                            SET tier_id = ?, updated_at = ? 
-                            WHERE user_id = ? AND skill_type_id = ?
-                        ''', (tiers[tier_name], datetime.now(), user_id, skill_types[skill_code]))
-                    else:
-                        # Insert new entry
-                        cursor.execute('''
-                            INSERT INTO user_skills (user_id, skill_type_id, tier_id)
-                            VALUES (?, ?, ?)
-                        ''', (user_id, skill_types[skill_code], tiers[tier_name]))
+        # Lets get_user_ranks find a user's rows without scanning every skill
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_skill_leaderboard_user
+            ON skill_leaderboard(user_id)
+        ''')
         
         conn.commit()
         conn.close()
     
+    @staticmethod
+    def rebuild_leaderboard(cursor):
+        """Recompute the whole skill_leaderboard table from user_skills"""
+        cursor.execute('DELETE FROM skill_leaderboard')
+        cursor.execute(f'''
+            INSERT INTO skill_leaderboard (skill_type_id, user_id, username, tier_id, tier_value)
+            SELECT us.skill_type_id, us.user_id, u.username, t.id, {TIER_VALUE_SQL}
+            FROM user_skills us
+            JOIN users u ON us.user_id = u.id
+            JOIN tiers t ON us.tier_id = t.id
+        ''')
+    
+    @staticmethod
+    def refresh_leaderboard_entry(cursor, user_id, skill_type_id=None):
+        """Recompute a user's skill_leaderboard rows (one skill, or all of them) after a tier change"""
+        if skill_type_id is not None:
+            skill_filter = 'AND skill_type_id = ?'
+            params = (user_id, skill_type_id)
+        else:
+            skill_filter = ''
+            params = (user_id,)
+        
+        cursor.execute(f'DELETE FROM skill_leaderboard WHERE user_id = ? {skill_filter}', params)
+        cursor.execute(f'''
+            INSERT INTO skill_leaderboard (skill_type_id, user_id, username, tier_id, tier_value)
+            SELECT us.skill_type_id, us.user_id, u.username, t.id, {TIER_VALUE_SQL}
+            FROM user_skills us
+            JOIN users u ON us.user_id = u.id
+            JOIN tiers t ON us.tier_id = t.id
+            WHERE us.user_id = ? {skill_filter}
+        ''', params)
+    
+    @staticmethod
+    def sync_legacy_tiers(cursor, user_id=None):
+        """Copy tiers from the legacy users.*_tier columns into user_skills (one user, or everyone)"""
+        legacy_tier = ' '.join(
+            f"WHEN '{skill_code}' THEN u.{column}" for skill_code, column in LEGACY_TIER_COLUMNS.items()
+        )
+        user_filter = 'AND u.id = ?' if user_id is not None else ''
+        params = (datetime.now(),) if user_id is None else (user_id, datetime.now())
+        
+        # One set-based upsert instead of a SELECT + UPDATE/INSERT per user and skill;
+        # blank or unknown legacy values match no tier and are skipped
+        cursor.execute(f'''
+            INSERT INTO user_skills (user_id, skill_type_id, tier_id)
+            SELECT u.id, st.id, t.id
+            FROM users u
+            JOIN skill_types st
+            JOIN tiers t ON t.tier_name = CASE st.skill_code {legacy_tier} END
+            WHERE 1 {user_filter}
+            ON CONFLICT (user_id, skill_type_id) DO UPDATE
+            SET tier_id = excluded.tier_id, updated_at = ?
+            WHERE user_skills.tier_id IS NOT excluded.tier_id
+        ''', params)
+        
+        if user_id is not None:
+            TierManager.refresh_leaderboard_entry(cursor, user_id)
+        else:
+            TierManager.rebuild_leaderboard(cursor)
+    
+    @staticmethod
+    def migrate_existing_user_tiers():
+        """Migrate existing user tier data to the new table structure"""
+        with db_utils.write_transaction() as conn:
+            TierManager.sync_legacy_tiers(conn.cursor())
+    
+    @staticmethod
+    def migrate_existing_user_tiers_once():
+        """Run the legacy tier migration unless some process already has; returns True if it ran"""
+        return db_utils.run_migration_once('legacy_user_tiers', TierManager.sync_legacy_tiers)
+    
     @staticmethod
     def get_user_skills(user_id):
         """Get all skills and tiers for a user"""
@@ -237,52 +295,50 @@ class TierManager:
     @staticmethod
     def update_user_skill(user_id, skill_code, tier_name=None, notes=None):
         """Update a user's skill tier"""
-        conn = TierManager.get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get skill type ID
-        cursor.execute('SELECT id FROM skill_types WHERE skill_code = ?', (skill_code,))
-        skill_type = cursor.fetchone()
-        if not skill_type:
-            conn.close()
-            return False, f"Skill type {skill_code} not found"
-        
-        skill_type_id = skill_type['id']
-        
-        # Get tier ID if provided
-        tier_id = None
-        if tier_name:
-            cursor.execute('SELECT id FROM tiers WHERE tier_name = ?', (tier_name,))
-            tier = cursor.fetchone()
-            if not tier:
-                conn.close()
-                return False, f"Tier {tier_name} not found"
-            tier_id = tier['id']
-        
-        # Check if entry already exists
-        cursor.execute('''
-            SELECT id FROM user_skills 
-            WHERE user_id = ? AND skill_type_id = ?
-        ''', (user_id, skill_type_id))
-        
-        existing = cursor.fetchone()
-        
-        if existing:
-            # Update existing entry
-            cursor.execute('''
-                UPDATE user_skills 
-                SET tier_id = ?, notes = ?, updated_at = ? 
-                WHERE id = ?
-            ''', (tier_id, notes, datetime.now(), existing['id']))
-        else:
-            # Insert new entry
+        with db_utils.write_transaction() as conn:
+            cursor = conn.cursor()
+            
+            # Get skill type ID
+            cursor.execute('SELECT id FROM skill_types WHERE skill_code = ?', (skill_code,))
+            skill_type = cursor.fetchone()
+            if not skill_type:
+                return False, f"Skill type {skill_code} not found"
+            
+            skill_type_id = skill_type['id']
+            
+            # Get tier ID if provided
+            tier_id = None
+            if tier_name:
+                cursor.execute('SELECT id FROM tiers WHERE tier_name = ?', (tier_name,))
+                tier = cursor.fetchone()
+                if not tier:
+                    return False, f"Tier {tier_name} not found"
+                tier_id = tier['id']
+            
+            # Check if entry already exists
             cursor.execute('''
-                INSERT INTO user_skills (user_id, skill_type_id, tier_id, notes)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, skill_type_id, tier_id, notes))
+                SELECT id FROM user_skills 
+                WHERE user_id = ? AND skill_type_id = ?
+            ''', (user_id, skill_type_id))
+            
+            existing = cursor.fetchone()
+            
+            if existing:
+                # Update existing entry
+                cursor.execute('''
+                    UPDATE user_skills 
+                    SET tier_id = ?, notes = ?, updated_at = ? 
+                    WHERE id = ?
+                ''', (tier_id, notes, datetime.now(), existing['id']))
+            else:
+                # Insert new entry
+                cursor.execute('''
+                    INSERT INTO user_skills (user_id, skill_type_id, tier_id, notes)
+                    VALUES (?, ?, ?, ?)
+                ''', (user_id, skill_type_id, tier_id, notes))
+            
+            TierManager.refresh_leaderboard_entry(cursor, user_id, skill_type_id)
         
-        conn.commit()
-        conn.close()
         return True, "Skill updated successfully"
     
     @staticmethod
@@ -336,8 +392,8 @@ class TierManager:
         
         cursor.execute('''
             SELECT 
-                u.id AS user_id,
-                u.username,
+                lb.user_id,
+                lb.username,
                 u.profile_pic,
                 t.tier_name,
                 t.display_name AS tier_display_name,
@@ -346,17 +402,12 @@ class TierManager:
                 t.level,
                 st.skill_name,
                 st.skill_code
-            FROM user_skills us
-            JOIN users u ON us.user_id = u.id
-            JOIN skill_types st ON us.skill_type_id = st.id
-            JOIN tiers t ON us.tier_id = t.id
+            FROM skill_types st
+            JOIN skill_leaderboard lb ON lb.skill_type_id = st.id
+            JOIN users u ON lb.user_id = u.id
+            JOIN tiers t ON lb.tier_id = t.id
             WHERE st.skill_code = ?
-            ORDER BY 
-                CASE 
-                    WHEN t.category = 'HT' THEN t.level + 5
-                    ELSE t.level
-                END DESC,
-                u.username
+            ORDER BY lb.tier_value DESC, lb.username
             LIMIT ?
         ''', (skill_code, limit))
         
@@ -368,17 +419,72 @@ class TierManager:
     @staticmethod
     def get_all_leaderboards(limit=5):
         """Get leaderboards for all skills"""
-        skill_types = TierManager.get_all_skill_types()
-        result = {}
+        conn = TierManager.get_db_connection()
+        cursor = conn.cursor()
         
-        for skill in skill_types:
-            result[skill['skill_code']] = {
-                'skill_name': skill['skill_name'],
-                'skill_code': skill['skill_code'],
-                'description': skill['description'],
-                'icon_path': skill['icon_path'],
-                'leaderboard': TierManager.get_skill_leaderboard(skill['skill_code'], limit)
-            }
+        # Rank every skill's players in one pass and keep the top N of each;
+        # the LEFT JOIN keeps skills that have no ranked players yet
+        cursor.execute('''
+            WITH ranked AS (
+                SELECT 
+                    lb.skill_type_id,
+                    lb.user_id,
+                    lb.username,
+                    lb.tier_id,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY lb.skill_type_id
+                        ORDER BY lb.tier_value DESC, lb.username
+                    ) AS position
+                FROM skill_leaderboard lb
+            )
+            SELECT 
+                st.skill_code,
+                st.skill_name,
+                st.description,
+                st.icon_path,
+                r.user_id,
+                r.username,
+                u.profile_pic,
+                t.tier_name,
+                t.display_name AS tier_display_name,
+                t.color_class,
+                t.category,
+                t.level
+            FROM skill_types st
+            LEFT JOIN ranked r ON r.skill_type_id = st.id AND r.position <= ?
+            LEFT JOIN users u ON r.user_id = u.id
+            LEFT JOIN tiers t ON r.tier_id = t.id
+            ORDER BY st.skill_name, r.position
+        ''', (limit,))
+        
+        rows = cursor.fetchall()
+        conn.close()
+        
+        result = {}
+        for row in rows:
+            skill_code = row['skill_code']
+            if skill_code not in result:
+                result[skill_code] = {
+                    'skill_name': row['skill_name'],
+                    'skill_code': skill_code,
+                    'description': row['description'],
+                    'icon_path': row['icon_path'],
+                    'leaderboard': []
+                }
+            
+            if row['user_id'] is not None:
+                result[skill_code]['leaderboard'].append({
+                    'user_id': row['user_id'],
+                    'username': row['username'],
+                    'profile_pic': row['profile_pic'],
+                    'tier_name': row['tier_name'],
+                    'tier_display_name': row['tier_display_name'],
+                    'color_class': row['color_class'],
+                    'category': row['category'],
+                    'level': row['level'],
+                    'skill_name': row['skill_name'],
+                    'skill_code': skill_code
+                })
             
         return result
         
@@ -427,13 +533,13 @@ class TierManager:
         # First get the user's tier
         cursor.execute('''
             SELECT 
-                t.tier_name,
-                t.category,
-                t.level
-            FROM user_skills us
-            JOIN skill_types st ON us.skill_type_id = st.id
-            JOIN tiers t ON us.tier_id = t.id
-            WHERE us.user_id = ? AND st.skill_code = ?
+                lb.skill_type_id,
+                lb.tier_value,
+                t.tier_name
+            FROM skill_leaderboard lb
+            JOIN skill_types st ON lb.skill_type_id = st.id
+            JOIN tiers t ON lb.tier_id = t.id
+            WHERE lb.user_id = ? AND st.skill_code = ?
         ''', (user_id, skill_code))
         
         user_tier = cursor.fetchone()
@@ -445,40 +551,18 @@ class TierManager:
         # Now count how many users are at the same tier or higher
         cursor.execute('''
             SELECT COUNT(*) as rank_position
-            FROM (
-                SELECT 
-                    us.user_id,
-                    CASE 
-                        WHEN t.category = 'HT' THEN t.level + 5
-                        ELSE t.level
-                    END as tier_value
-                FROM user_skills us
-                JOIN skill_types st ON us.skill_type_id = st.id
-                JOIN tiers t ON us.tier_id = t.id
-                WHERE st.skill_code = ?
-            ) ranked_users
-            WHERE tier_value >= (
-                SELECT 
-                    CASE 
-                        WHEN t.category = 'HT' THEN t.level + 5
-                        ELSE t.level
-                    END as tier_value
-                FROM user_skills us
-                JOIN skill_types st ON us.skill_type_id = st.id
-                JOIN tiers t ON us.tier_id = t.id
-                WHERE us.user_id = ? AND st.skill_code = ?
-            )
-        ''', (skill_code, user_id, skill_code))
+            FROM skill_leaderboard
+            WHERE skill_type_id = ? AND tier_value >= ?
+        ''', (user_tier['skill_type_id'], user_tier['tier_value']))
         
         rank = cursor.fetchone()
         
         # Get total number of ranked users for this skill
         cursor.execute('''
             SELECT COUNT(*) as total
-            FROM user_skills us
-            JOIN skill_types st ON us.skill_type_id = st.id
-            WHERE st.skill_code = ? AND us.tier_id IS NOT NULL
-        ''', (skill_code,))
+            FROM skill_leaderboard
+            WHERE skill_type_id = ?
+        ''', (user_tier['skill_type_id'],))
         
         total = cursor.fetchone()
         
@@ -491,6 +575,47 @@ class TierManager:
             'percentile': round(((total['total'] - rank['rank_position']) / total['total']) * 100) if rank and total and total['total'] > 0 else 0
         }
         
+    @staticmethod
+    def get_user_ranks(user_id):
+        """Get a user's rank in every skill they are ranked in, keyed by skill code"""
+        conn = TierManager.get_db_connection()
+        cursor = conn.cursor()
+        
+        # Both counts are range scans on idx_skill_leaderboard_rank
+        cursor.execute('''
+            SELECT 
+                st.skill_code,
+                t.tier_name,
+                (
+                    SELECT COUNT(*)
+                    FROM skill_leaderboard other
+                    WHERE other.skill_type_id = lb.skill_type_id
+                      AND other.tier_value >= lb.tier_value
+                ) AS rank_position,
+                (
+                    SELECT COUNT(*)
+                    FROM skill_leaderboard other
+                    WHERE other.skill_type_id = lb.skill_type_id
+                ) AS total
+            FROM skill_leaderboard lb
+            JOIN skill_types st ON lb.skill_type_id = st.id
+            JOIN tiers t ON lb.tier_id = t.id
+            WHERE lb.user_id = ?
+        ''', (user_id,))
+        
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return {
+            row['skill_code']: {
+                'tier_name': row['tier_name'],
+                'rank': row['rank_position'],
+                'total': row['total'],
+                'percentile': round(((row['total'] - row['rank_position']) / row['total']) * 100) if row['total'] > 0 else 0
+            }
+            for row in rows
+        }
+    
     @staticmethod
     def get_tier_progression_path():
         """Get the progression path of tiers"""
@@ -513,9 +638,10 @@ class TierManager:
         }
         
     @staticmethod
-    def get_tier_recommendations(user_id):
+    def get_tier_recommendations(user_id, user_skills=None):
         """Get tier-based skill recommendations for a user"""
-        user_skills = TierManager.get_user_skills(user_id)
+        if user_skills is None:
+            user_skills = TierManager.get_user_skills(user_id)
         
         # Convert to dictionary for easier access
         skills_dict = {skill['skill_code']: skill for skill in user_skills if skill.get('tier_name')}